@@ -0,0 +1,355 @@
+"""Measures a complete import of a synthetic release, phase by phase.
+
+Generates a git repo with two release tags, a release package and a
+plastic workspace, where the second release adds, deletes, modifies and
+moves a configurable share of the files of the first one. The real
+ueimporter main() then imports the second release into the workspace,
+with fake_cm.py standing in for the plastic cm executable. Time spent
+in each phase and job is reported, and the workspace is verified to be
+identical to the release afterwards.
+
+    $ python benchmarks/bench_import.py --files 100000
+    $ python benchmarks/bench_import.py --files 20000 -- --cm-shell
+
+Arguments after -- are passed on to ueimporter.
+"""
+import argparse
+import collections
+import contextlib
+import functools
+import os
+import random
+import shutil
+import stat
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+
+from pathlib import Path
+
+# Run as-is from a checkout, without installing ueimporter
+sys.path.insert(0, str(Path(__file__).absolute().parent.parent))
+
+import ueimporter.git as git
+import ueimporter.job
+import ueimporter.main as main
+import ueimporter.verify as verify
+
+FROM_RELEASE_TAG = '4.27.1-release'
+TO_RELEASE_TAG = '4.27.2-release'
+BUILD_VERSION_FILENAME = 'Engine/Build/Build.version'
+FILES_PER_DIR = 50
+DIRS_PER_MODULE = 4
+MODULES_PER_PLUGIN = 5
+
+
+def create_build_version(release_tag):
+    (major, minor, patch) = release_tag.split('-')[0].split('.')
+    return f'{{"MajorVersion": {major}, "MinorVersion": {minor},' \
+        f' "PatchVersion": {patch}}}\n'.encode('utf-8')
+
+
+def create_content(index, size):
+    line = f'// File {index}\n'.encode('utf-8')
+    return (line * (size // len(line) + 1))[:size]
+
+
+def generate_dir(dir_index, prefix='Plugin'):
+    plugin = dir_index // (DIRS_PER_MODULE * MODULES_PER_PLUGIN)
+    module = (dir_index // DIRS_PER_MODULE) % MODULES_PER_PLUGIN
+    return f'Engine/Plugins/{prefix}{plugin}/Source/Module{module}' \
+        f'/Private{dir_index % DIRS_PER_MODULE}'
+
+
+class Release:
+    """Files of a synthetic release, mapped to (mode, content)"""
+
+    def __init__(self, release_tag, files):
+        self.release_tag = release_tag
+        self.files = files
+
+
+def generate_releases(args):
+    rng = random.Random(args.seed)
+    from_files = {}
+    for i in range(0, args.files):
+        filename = f'{generate_dir(i // FILES_PER_DIR)}/File{i}.cpp'
+        mode = '100755' if i % 101 == 0 else '100644'
+        from_files[filename] = (mode, create_content(i, args.file_size))
+    from_files[BUILD_VERSION_FILENAME] = \
+        ('100644', create_build_version(FROM_RELEASE_TAG))
+
+    to_files = dict(from_files)
+    to_files[BUILD_VERSION_FILENAME] = \
+        ('100644', create_build_version(TO_RELEASE_TAG))
+    filenames = sorted(f for f in from_files if f != BUILD_VERSION_FILENAME)
+    rng.shuffle(filenames)
+
+    def take(count):
+        taken = filenames[:count]
+        del filenames[:count]
+        return taken
+
+    for filename in take(int(args.files * args.modify_share)):
+        (mode, content) = to_files[filename]
+        to_files[filename] = (mode, content + b'// Modified\n')
+    # Half of the deletes and moves affect whole directories, the rest
+    # single files
+    delete_count = int(args.files * args.delete_share)
+    move_count = int(args.files * args.move_share)
+    dirs = sorted(set(os.path.dirname(f) for f in filenames))
+    rng.shuffle(dirs)
+    dir_delete_count = delete_count // 2 // FILES_PER_DIR
+    deleted_dirs = set(dirs[:dir_delete_count])
+    for filename in list(to_files.keys()):
+        if os.path.dirname(filename) in deleted_dirs:
+            del to_files[filename]
+            delete_count -= 1
+    filenames = [f for f in filenames
+                 if os.path.dirname(f) not in deleted_dirs]
+    for filename in take(max(0, delete_count)):
+        del to_files[filename]
+    moved_dirs = set(dirs[dir_delete_count:
+                          dir_delete_count + move_count // 2 // FILES_PER_DIR])
+    for filename in list(to_files.keys()):
+        if os.path.dirname(filename) in moved_dirs:
+            to_files[filename.replace('/Private', '/Renamed')] = \
+                to_files.pop(filename)
+            move_count -= 1
+    filenames = [f for f in filenames
+                 if os.path.dirname(f) not in moved_dirs]
+    for filename in take(max(0, move_count)):
+        to_files[filename.replace('/File', '/Moved')] = \
+            to_files.pop(filename)
+    # Half of the adds go into existing directories, the rest into new
+    # plugins
+    add_count = int(args.files * args.add_share)
+    for i in range(args.files, args.files + add_count):
+        if i % 2 == 0:
+            directory = generate_dir(rng.randrange(
+                0, args.files // FILES_PER_DIR + 1))
+        else:
+            directory = generate_dir(i // FILES_PER_DIR, prefix='NewPlugin')
+        to_files[f'{directory}/Added{i}.cpp'] = \
+            ('100644', create_content(i, args.file_size))
+
+    return (Release(FROM_RELEASE_TAG, from_files),
+            Release(TO_RELEASE_TAG, to_files))
+
+
+def write_fast_import_stream(stream, releases):
+    # Each release is a commit that replaces the whole tree
+    for (mark, release) in enumerate(releases, start=1):
+        message = f'Release {release.release_tag}'.encode('utf-8')
+        stream.write(f'commit refs/heads/release\n'
+                     f'mark :{mark}\n'
+                     f'committer Bench <bench@localhost> {mark} +0000\n'
+                     f'data {len(message)}\n'.encode('utf-8') + message +
+                     b'\ndeleteall\n')
+        for (filename, (mode, content)) in sorted(release.files.items()):
+            stream.write(f'M {mode} inline {filename}\n'
+                         f'data {len(content)}\n'.encode('utf-8'))
+            stream.write(content)
+            stream.write(b'\n')
+        stream.write(f'reset refs/tags/{release.release_tag}\n'
+                     f'from :{mark}\n\n'.encode('utf-8'))
+
+
+def run_git(repo_root, *arguments, **kwargs):
+    return subprocess.run(['git'] + list(arguments), cwd=repo_root,
+                          check=True, capture_output=True, **kwargs)
+
+
+def create_git_repo(repo_root, releases):
+    repo_root.mkdir(parents=True)
+    run_git(repo_root, 'init', '-q')
+    # Git warns on STDERR when there are more renames than it will look
+    # for, which ueimporter treats as an error
+    file_count = max(len(r.files) for r in releases)
+    run_git(repo_root, 'config', 'diff.renameLimit', str(file_count))
+    process = subprocess.Popen(['git', 'fast-import', '--quiet'],
+                               cwd=repo_root, stdin=subprocess.PIPE)
+    write_fast_import_stream(process.stdin, releases)
+    process.stdin.close()
+    if process.wait() != 0:
+        raise RuntimeError('git fast-import failed')
+
+
+def extract_release(repo_root, release_tag, target_root):
+    # Release packages are created from the repo, just like Epic does
+    target_root.mkdir(parents=True)
+    process = subprocess.Popen(['git', 'archive', '--format=tar',
+                                release_tag],
+                               cwd=repo_root, stdout=subprocess.PIPE)
+    with tarfile.open(fileobj=process.stdout, mode='r|') as archive:
+        for member in archive:
+            target = target_root.joinpath(member.name)
+            if member.isdir():
+                target.mkdir(parents=True, exist_ok=True)
+            elif member.isfile():
+                target.parent.mkdir(parents=True, exist_ok=True)
+                with archive.extractfile(member) as f:
+                    target.write_bytes(f.read())
+                os.chmod(target, member.mode)
+    if process.wait() != 0:
+        raise RuntimeError('git archive failed')
+
+
+def create_fake_cm(bin_dir):
+    bin_dir.mkdir(parents=True)
+    fake_cm = Path(__file__).absolute().parent.joinpath('fake_cm.py')
+    if os.name == 'nt':
+        bin_dir.joinpath('cm.bat').write_text(
+            f'@"{sys.executable}" "{fake_cm}" %*\n')
+    else:
+        cm = bin_dir.joinpath('cm')
+        cm.write_text(f'#!/bin/sh\nexec "{sys.executable}" "{fake_cm}"'
+                      f' "$@"\n')
+        os.chmod(cm, os.stat(cm).st_mode | stat.S_IXUSR)
+
+
+class PhaseTimer:
+    """Accumulates the time spent in instrumented functions, per phase"""
+
+    def __init__(self):
+        self.elapsed_times = collections.OrderedDict()
+
+    def add(self, phase, elapsed_time):
+        self.elapsed_times[phase] = \
+            self.elapsed_times.get(phase, 0.0) + elapsed_time
+
+    def wrap(self, phase, fn):
+        @functools.wraps(fn)
+        def timed(*args, **kwargs):
+            start_timestamp = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.add(phase, time.perf_counter() - start_timestamp)
+        return timed
+
+
+@contextlib.contextmanager
+def instrument(timer):
+    # Main looks these up as module attributes, so replacing them is enough
+    patches = [
+        (main, 'index_file_systems', 'index file systems'),
+        (main, 'extract_source_files', 'extract release package'),
+        (git, 'read_changes', 'diff parse'),
+        (ueimporter.job, 'create_jobs', 'planning'),
+        (main, 'skip_invalid_ops', 'validation'),
+    ]
+    originals = []
+    for (module, name, phase) in patches:
+        original = getattr(module, name)
+        originals.append((module, name, original))
+        setattr(module, name, timer.wrap(phase, original))
+
+    original_process = ueimporter.job.Job.process
+
+    def process(job, *args, **kwargs):
+        return timer.wrap(f'job: {job.desc}', original_process)(
+            job, *args, **kwargs)
+
+    ueimporter.job.Job.process = process
+    try:
+        yield
+    finally:
+        ueimporter.job.Job.process = original_process
+        for (module, name, original) in originals:
+            setattr(module, name, original)
+
+
+def run_import(work_dir, ueimporter_args, timer):
+    workspace_root = work_dir.joinpath('workspace')
+    argv = ['ueimporter',
+            '--git-repo-root', str(work_dir.joinpath('git')),
+            '--from-release-tag', FROM_RELEASE_TAG,
+            '--to-release-tag', TO_RELEASE_TAG,
+            '--zip-package-root', str(work_dir.joinpath('releases')),
+            '--plastic-workspace-root', str(workspace_root),
+            '--log-file', str(work_dir.joinpath('ueimporter.log')),
+            '--journal-file', str(work_dir.joinpath('journal.jsonl')),
+            '--log-level', 'error',
+            '--skip-invalid-ops'] + ueimporter_args
+    previous_argv = sys.argv
+    sys.argv = argv
+    start_timestamp = time.perf_counter()
+    try:
+        with instrument(timer):
+            returncode = main.main()
+    finally:
+        sys.argv = previous_argv
+    timer.add('total', time.perf_counter() - start_timestamp)
+    return returncode
+
+
+def main_():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--files', type=int, default=20000,
+                        help='Number of files in the first release')
+    parser.add_argument('--file-size', type=int, default=512,
+                        help='Size of each file in bytes')
+    parser.add_argument('--add-share', type=float, default=0.1,
+                        help='Files added, as a share of --files')
+    parser.add_argument('--delete-share', type=float, default=0.1,
+                        help='Files deleted, as a share of --files')
+    parser.add_argument('--modify-share', type=float, default=0.2,
+                        help='Files modified, as a share of --files')
+    parser.add_argument('--move-share', type=float, default=0.1,
+                        help='Files moved, as a share of --files')
+    parser.add_argument('--cm-latency', type=float, default=0.0,
+                        help='Seconds each fake cm process waits at start')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed of the random choice of changed files')
+    parser.add_argument('--work-dir', type=lambda p: Path(p).absolute(),
+                        help='Directory to generate everything in, must not'
+                        ' exist. Default is a temporary directory')
+    parser.add_argument('--keep', action='store_true',
+                        help='Keep the work directory afterwards')
+    parser.add_argument('ueimporter_args', nargs='*',
+                        help='Arguments passed on to ueimporter')
+    args = parser.parse_args()
+
+    work_dir = args.work_dir or \
+        Path(tempfile.mkdtemp(prefix='ueimporter-bench-'))
+    try:
+        start_timestamp = time.perf_counter()
+        releases = generate_releases(args)
+        repo_root = work_dir.joinpath('git')
+        create_git_repo(repo_root, releases)
+        extract_release(repo_root, TO_RELEASE_TAG, work_dir.joinpath(
+            'releases', f'UnrealEngine-{TO_RELEASE_TAG}'))
+        workspace_root = work_dir.joinpath('workspace')
+        extract_release(repo_root, FROM_RELEASE_TAG, workspace_root)
+        workspace_root.joinpath('.plastic').mkdir()
+        create_fake_cm(work_dir.joinpath('bin'))
+        print(f'Generated {len(releases[0].files)} files in {work_dir}'
+              f' in {time.perf_counter() - start_timestamp:.2f}s')
+
+        os.environ['PATH'] = \
+            f'{work_dir.joinpath("bin")}{os.pathsep}{os.environ["PATH"]}'
+        os.environ['FAKE_CM_LATENCY'] = str(args.cm_latency)
+        timer = PhaseTimer()
+        returncode = run_import(work_dir, args.ueimporter_args, timer)
+
+        max_desc_length = max(len(p) for p in timer.elapsed_times)
+        for (phase, elapsed_time) in timer.elapsed_times.items():
+            print(f'{phase:>{max_desc_length}}: {elapsed_time:8.2f}s')
+        print(f'ueimporter returned {returncode}')
+
+        result = verify.verify(
+            work_dir.joinpath('releases', f'UnrealEngine-{TO_RELEASE_TAG}'),
+            workspace_root, verify.default_worker_count(),
+            main.Logger(None, main.LogLevel.ERROR))
+        print(f'Workspace is identical to release: {result.is_identical}')
+        return 0 if returncode == 0 and result.is_identical else 1
+    finally:
+        if not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    sys.exit(main_())
@@ -0,0 +1,97 @@
+"""Measures the memory used by changes and ops for a synthetic diff.
+
+Compares the current representation against a replica of the original one,
+where each change held PurePosixPath objects in an instance __dict__.
+
+    $ python benchmarks/bench_memory.py --count 200000
+"""
+import argparse
+import gc
+import sys
+import tracemalloc
+
+from pathlib import Path, PurePosixPath
+
+# Run as-is from a checkout, without installing ueimporter
+sys.path.insert(0, str(Path(__file__).absolute().parent.parent))
+
+import ueimporter.git as git
+import ueimporter.op as op
+
+
+class LegacyChange:
+    def __init__(self, filename):
+        self._filename = PurePosixPath(filename)
+
+
+class LegacyMove(LegacyChange):
+    def __init__(self, source_filename, target_filename):
+        LegacyChange.__init__(self, source_filename)
+        self._target_filename = PurePosixPath(target_filename)
+
+
+class LegacyOp:
+    def __init__(self, change):
+        self._change = change
+
+
+def generate_filenames(count):
+    for i in range(0, count):
+        yield f'Engine/Plugins/Plugin{i % 97}/Source/Module{i % 13}' \
+            f'/Private/File{i}.cpp'
+
+
+def create_legacy(count):
+    ops = []
+    for i, filename in enumerate(generate_filenames(count)):
+        if i % 4 == 0:
+            change = LegacyMove(filename, filename.replace('Plugin', 'Plug'))
+        else:
+            change = LegacyChange(filename)
+        # Paths were created on demand, and then kept alive by the change
+        str(change._filename)
+        ops.append(LegacyOp(change))
+    return ops
+
+
+def create_current(count):
+    ops = []
+    for i, filename in enumerate(generate_filenames(count)):
+        if i % 4 == 0:
+            ops.append(op.MoveOp(
+                git.Move(filename, filename.replace('Plugin', 'Plug'))))
+        else:
+            ops.append(op.ModifyOp(git.Modify(filename)))
+    return ops
+
+
+def measure(create, count):
+    gc.collect()
+    tracemalloc.start()
+    ops = create(count)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del ops
+    return current, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--count', type=int, default=200000,
+                        help='Number of changes to create')
+    args = parser.parse_args()
+
+    results = []
+    for (desc, create) in [('original', create_legacy),
+                           ('current', create_current)]:
+        current, peak = measure(create, args.count)
+        results.append(current)
+        print(f'{desc:>10}: {current / 2**20:8.1f} MiB retained'
+              f' ({current / args.count:6.1f} bytes/change),'
+              f' {peak / 2**20:8.1f} MiB peak')
+
+    print(f'Reduction: {100 * (1 - results[1] / results[0]):.1f}%')
+
+
+if __name__ == '__main__':
+    main()
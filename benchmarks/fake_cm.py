@@ -0,0 +1,207 @@
+"""Stand-in for the plastic 'cm' executable, used by bench_import.py.
+
+Implements the commands ueimporter runs, including 'cm shell', on top of
+the plain files of the workspace. The set of controlled items is kept in
+.plastic/fake_cm.state, which is created from the workspace content the
+first time it is needed. Commands holding a lock on .plastic/fake_cm.lock
+load, update and save it, so that concurrent cm processes do not
+overwrite each other's updates. Set FAKE_CM_LATENCY to a number of seconds to
+wait whenever a process starts, to mimic the startup cost of cm.
+"""
+import contextlib
+import os
+import shlex
+import shutil
+import sys
+import time
+
+STATE_FILENAME = os.path.join('.plastic', 'fake_cm.state')
+LOCK_FILENAME = os.path.join('.plastic', 'fake_cm.lock')
+
+if os.name == 'nt':
+    import msvcrt
+
+    def lock_file(f):
+        f.seek(0)
+        while True:
+            try:
+                msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                return
+            except OSError:
+                pass
+
+    def unlock_file(f):
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+else:
+    import fcntl
+
+    def lock_file(f):
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+
+    def unlock_file(f):
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+class Workspace:
+    def __init__(self, root):
+        self.root = root
+        self.controlled = None
+        self.is_dirty = False
+
+    @contextlib.contextmanager
+    def locked(self):
+        # The state is loaded again within the lock, another process might
+        # have changed it since this one last read it
+        with open(os.path.join(self.root, LOCK_FILENAME), 'a+b') as f:
+            lock_file(f)
+            try:
+                self.load()
+                yield
+                self.save()
+            finally:
+                unlock_file(f)
+
+    def load(self):
+        filename = os.path.join(self.root, STATE_FILENAME)
+        if os.path.isfile(filename):
+            with open(filename, encoding='utf-8') as f:
+                self.controlled = set(f.read().split('\n'))
+            self.controlled.discard('')
+            return
+        # Everything already in the workspace is controlled
+        self.controlled = set()
+        for (dirpath, dirnames, filenames) in os.walk(self.root):
+            if dirpath == self.root:
+                dirnames[:] = [d for d in dirnames if d != '.plastic']
+            for name in dirnames + filenames:
+                self.controlled.add(self.to_key(os.path.join(dirpath, name)))
+        self.is_dirty = True
+
+    def save(self):
+        if not self.is_dirty:
+            return
+        filename = os.path.join(self.root, STATE_FILENAME)
+        with open(filename, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(sorted(self.controlled)))
+        self.is_dirty = False
+
+    def to_key(self, path):
+        path = os.path.relpath(os.path.join(self.root, path), self.root)
+        return path.replace(os.sep, '/')
+
+    def add(self, paths, recursive=False):
+        for path in paths:
+            if not os.path.exists(os.path.join(self.root, path)):
+                return fail(f'{path} does not exist')
+        if recursive:
+            paths = list(paths)
+            for path in list(paths):
+                for (dirpath, dirnames, filenames) in os.walk(
+                        os.path.join(self.root, path)):
+                    paths += [os.path.join(dirpath, name)
+                              for name in dirnames + filenames]
+        for path in paths:
+            # Parents of added items are controlled implicitly
+            key = self.to_key(path)
+            while key not in self.controlled and key != '.':
+                self.controlled.add(key)
+                key = os.path.dirname(key) or '.'
+        self.is_dirty = True
+        return 0
+
+    def checkout(self, paths):
+        for path in paths:
+            if self.to_key(path) not in self.controlled:
+                return fail(f'{path} is not controlled')
+        return 0
+
+    def remove(self, paths):
+        for path in paths:
+            key = self.to_key(path)
+            if key not in self.controlled:
+                return fail(f'{path} is not controlled')
+            full_path = os.path.join(self.root, path)
+            if os.path.isdir(full_path):
+                shutil.rmtree(full_path)
+                self.controlled = set(
+                    k for k in self.controlled
+                    if k != key and not k.startswith(f'{key}/'))
+            else:
+                if os.path.exists(full_path):
+                    os.remove(full_path)
+                self.controlled.discard(key)
+        self.is_dirty = True
+        return 0
+
+    def move(self, from_path, to_path):
+        from_key = self.to_key(from_path)
+        to_key = self.to_key(to_path)
+        if from_key not in self.controlled:
+            return fail(f'{from_path} is not controlled')
+        to_full_path = os.path.join(self.root, to_path)
+        if not os.path.isdir(os.path.dirname(to_full_path)):
+            return fail(f'Parent of {to_path} does not exist')
+        os.rename(os.path.join(self.root, from_path), to_full_path)
+        moved = set(k for k in self.controlled
+                    if k == from_key or k.startswith(f'{from_key}/'))
+        self.controlled -= moved
+        self.controlled |= set(to_key + k[len(from_key):] for k in moved)
+        self.is_dirty = True
+        return 0
+
+
+def fail(message):
+    sys.stderr.write(f'{message}\n')
+    return 1
+
+
+def execute(workspace, arguments, input_paths):
+    command = arguments[0]
+    paths = [a for a in arguments[1:] if a != '-' and not a.startswith('-')]
+    paths += input_paths
+    if command == 'version':
+        print('fake_cm 1.0')
+        return 0
+    if command == 'status':
+        print('STATUS 1 fake@localhost')
+        return 0
+
+    with workspace.locked():
+        if command == 'add':
+            return workspace.add(paths, recursive='-R' in arguments)
+        if command == 'checkout':
+            return workspace.checkout(paths)
+        if command == 'remove':
+            return workspace.remove(paths)
+        if command == 'move' and len(paths) == 2:
+            return workspace.move(paths[0], paths[1])
+    return fail(f'Unsupported command: {" ".join(arguments)}')
+
+
+def main():
+    latency = float(os.environ.get('FAKE_CM_LATENCY', '0'))
+    if latency > 0:
+        time.sleep(latency)
+
+    arguments = sys.argv[1:]
+    workspace = Workspace(os.getcwd())
+    if arguments[:1] == ['shell']:
+        for line in sys.stdin:
+            arguments = shlex.split(line)
+            if not arguments:
+                continue
+            if arguments[0] == 'exit':
+                break
+            returncode = execute(workspace, arguments, [])
+            sys.stdout.write(f'CommandResult {returncode}\n')
+            sys.stdout.flush()
+        return 0
+
+    input_paths = [line.rstrip('\n') for line in sys.stdin] \
+        if '-' in arguments else []
+    return execute(workspace, arguments, input_paths)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
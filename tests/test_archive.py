@@ -0,0 +1,84 @@
+import os
+import stat
+import tarfile
+import zipfile
+
+import pytest
+
+from pathlib import PurePosixPath
+
+import ueimporter.archive as archive
+import ueimporter.copy_engine as copy_engine
+from ueimporter import Logger
+from ueimporter import LogLevel
+
+PREFIX = 'UnrealEngine-4.27.2-release'
+FILES = {
+    'Engine/Build/Build.version': ('{}', 0o644),
+    'Engine/Build/BatchFiles/Linux/Setup.sh': ('#!/bin/sh', 0o755),
+    'Engine/Source/Unchanged.cpp': ('unchanged', 0o644),
+}
+
+
+def create_release(root):
+    for (filename, (content, mode)) in FILES.items():
+        path = root.joinpath(PREFIX, filename)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(content)
+        os.chmod(path, mode)
+
+
+def create_archive(tmp_path, suffix):
+    release_root = tmp_path.joinpath('release')
+    create_release(release_root)
+    filename = tmp_path.joinpath(f'{PREFIX}{suffix}')
+    if suffix == '.zip':
+        with zipfile.ZipFile(filename, 'w') as f:
+            for (dirpath, _, filenames) in os.walk(release_root):
+                for name in filenames:
+                    path = os.path.join(dirpath, name)
+                    f.write(path, os.path.relpath(path, release_root))
+    else:
+        with tarfile.open(filename, 'w:gz') as f:
+            f.add(release_root.joinpath(PREFIX), PREFIX)
+    return filename
+
+
+@pytest.mark.parametrize('suffix', ['.zip', '.tar.gz'])
+def test_archive_source_will_only_extract_wanted_files(tmp_path, suffix):
+    filename = create_archive(tmp_path, suffix)
+    assert archive.find_archive(tmp_path, PREFIX) == filename
+
+    staging_root = tmp_path.joinpath('staging')
+    source = archive.ArchiveSource(filename, staging_root, prefix=PREFIX)
+    wanted = [PurePosixPath('Engine/Build/Build.version'),
+              PurePosixPath('Engine/Build/BatchFiles/Linux/Setup.sh'),
+              PurePosixPath('Engine/Source/Missing.cpp')]
+    source.extract(wanted, copy_engine.CopyEngine(2),
+                   Logger(None, LogLevel.ERROR))
+
+    for filename in FILES.keys():
+        assert source.tree.is_file(PurePosixPath(filename))
+    assert source.tree.is_dir(PurePosixPath('Engine/Build/BatchFiles'))
+    assert not source.tree.is_file(PurePosixPath('Engine/Source/Missing.cpp'))
+    assert source.extracted_count == 2
+
+    setup = staging_root.joinpath('Engine/Build/BatchFiles/Linux/Setup.sh')
+    assert setup.read_text() == '#!/bin/sh'
+    assert stat.S_IMODE(setup.stat().st_mode) == 0o755
+    assert not staging_root.joinpath('Engine/Source/Unchanged.cpp').exists()
+
+    source.close()
+    assert not staging_root.exists()
+
+
+def test_archive_source_will_skip_members_outside_of_root(tmp_path):
+    source = archive.ArchiveSource(tmp_path.joinpath('a.zip'),
+                                   tmp_path, prefix=PREFIX)
+    assert source.to_relative_name(f'{PREFIX}/Engine/a.txt') == 'Engine/a.txt'
+    assert source.to_relative_name(f'./{PREFIX}/Engine/') == 'Engine'
+    assert source.to_relative_name('Engine/a.txt') == 'Engine/a.txt'
+    assert source.to_relative_name(f'{PREFIX}/') == ''
+    assert source.to_relative_name('../a.txt') is None
+    assert source.to_relative_name('/etc/passwd') is None
+    assert source.to_relative_name('C:/a.txt') is None
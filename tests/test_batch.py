@@ -0,0 +1,66 @@
+import ueimporter.batch as batch
+
+
+class OpMock:
+    def __init__(self, input_size):
+        self.input_size = input_size
+
+
+def simulate(batcher, op_count, call_latency, path_latency):
+    processed = 0
+    while processed < op_count:
+        size = min(batcher.size, op_count - processed)
+        batcher.record_batch(size, call_latency + path_latency * size)
+        processed += size
+
+
+def test_batches_will_grow_while_call_latency_dominates():
+    limits = batch.BatchSizeLimits(min_size=1, initial_size=20,
+                                   max_size=2000)
+    batcher = batch.AdaptiveBatcher(limits)
+    simulate(batcher, 100000, call_latency=1.0, path_latency=0.001)
+    assert batcher.size == 2000
+    assert batcher.batch_sizes[0:4] == [20, 40, 80, 160]
+
+
+def test_batches_will_settle_where_call_overhead_is_small():
+    limits = batch.BatchSizeLimits(min_size=1, initial_size=20,
+                                   max_size=100000)
+    batcher = batch.AdaptiveBatcher(limits)
+    simulate(batcher, 200000, call_latency=1.0, path_latency=0.01)
+    # Overhead of 5% is reached at 1.0 * 0.95 / (0.05 * 0.01) = 1900 ops
+    assert 1000 <= batcher.size <= 3800
+
+
+def test_batches_will_shrink_after_failures():
+    limits = batch.BatchSizeLimits(min_size=1, initial_size=64,
+                                   max_size=2000)
+    batcher = batch.AdaptiveBatcher(limits)
+    assert batcher.record_failure()
+    assert batcher.size == 32
+    assert batcher.record_failure()
+    assert batcher.size == 16
+    assert not batcher.record_failure()
+    assert batcher.failure_count == 3
+
+    # Growth is capped by the failing size until a few batches succeed
+    batcher.record_batch(8, 1.0)
+    batcher.record_batch(8, 1.0)
+    assert batcher.size <= 8
+
+
+def test_batches_will_respect_input_byte_budget():
+    limits = batch.BatchSizeLimits(min_size=1, initial_size=20,
+                                   max_size=2000)
+    batcher = batch.AdaptiveBatcher(limits, input_byte_budget=100)
+    ops = [OpMock(30) for _ in range(0, 20)]
+    assert batcher.next_batch_size(ops) == 3
+    assert batcher.next_batch_size([OpMock(1000)]) == 1
+    assert batcher.next_batch_size(ops[0:2]) == 2
+
+
+def test_fixed_batches_will_not_adapt():
+    batcher = batch.AdaptiveBatcher.fixed(20)
+    simulate(batcher, 1000, call_latency=1.0, path_latency=0.001)
+    assert batcher.size == 20
+    assert set(batcher.batch_sizes) == {20}
@@ -0,0 +1,85 @@
+import os
+
+import ueimporter.command_cache as command_cache
+
+
+def test_command_cache_will_round_trip_entries(tmp_path):
+    cache = command_cache.CommandCache(tmp_path)
+    command = ['git', 'diff', '--name-status', '-z', 'a', 'b']
+    assert cache.read_entry(command) is None
+
+    stdout = 'M\0Engine/Source/File.cpp\0' * 1000
+    cache.write_entry(command, stdout)
+    assert cache.has_entry(command)
+    assert cache.read_entry(command) == stdout
+    assert b''.join(cache.read_entry_chunks(command, 100)) == \
+        stdout.encode('utf-8')
+
+    # Entries are compressed, and named by a hash of the command
+    filename = cache.get_entry_filename(command)
+    assert filename.stat().st_size < len(stdout)
+    assert len(filename.name) == 64 + len('.gz')
+    assert cache.stats.hit_count == 2
+    assert cache.stats.miss_count == 1
+    assert cache.stats.write_count == 1
+
+
+def test_command_cache_will_not_keep_interrupted_entries(tmp_path):
+    cache = command_cache.CommandCache(tmp_path)
+    command = ['git', 'diff']
+
+    def failing_chunks():
+        yield b'partial'
+        raise RuntimeError('Interrupted')
+
+    try:
+        for _ in cache.write_entry_chunks(command, failing_chunks()):
+            pass
+    except RuntimeError:
+        pass
+    assert not cache.has_entry(command)
+    assert not any(f.name.endswith('.tmp') for f in tmp_path.iterdir())
+
+
+def test_command_cache_will_remove_corrupt_entries(tmp_path):
+    cache = command_cache.CommandCache(tmp_path)
+    command = ['git', 'diff']
+    cache.write_entry(command, os.urandom(64 * 1024).hex())
+    filename = cache.get_entry_filename(command)
+    filename.write_bytes(filename.read_bytes()[:1024])
+
+    chunks = cache.read_entry_chunks(command, 100)
+    try:
+        for _ in chunks:
+            pass
+        assert False, 'Expected CorruptEntryError'
+    except command_cache.CorruptEntryError:
+        pass
+    assert not cache.has_entry(command)
+    assert cache.stats.hit_count == 0
+    assert cache.stats.miss_count == 1
+
+    cache.write_entry(command, 'stdout')
+    filename.write_bytes(filename.read_bytes()[:10])
+    assert cache.read_entry(command) is None
+    assert not cache.has_entry(command)
+
+
+def test_command_cache_will_evict_least_recently_used(tmp_path):
+    cache = command_cache.CommandCache(tmp_path, max_size=1)
+    commands = [['git', 'diff', str(i)] for i in range(0, 3)]
+    for (i, command) in enumerate(commands):
+        cache.write_entry(command, os.urandom(256).hex())
+        # Make sure entries get distinct modification times
+        os.utime(cache.get_entry_filename(command), (i, i))
+
+    # The entry just written is always kept
+    assert [cache.has_entry(c) for c in commands] == [False, False, True]
+    assert cache.stats.evicted_count == 2
+
+    cache.max_size = 1024 * 1024
+    cache.write_entry(commands[0], 'first')
+    os.utime(cache.get_entry_filename(commands[0]), (10, 10))
+    cache.max_size = cache.get_entry_filename(commands[0]).stat().st_size
+    cache.evict()
+    assert [cache.has_entry(c) for c in commands] == [True, False, False]
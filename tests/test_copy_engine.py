@@ -0,0 +1,75 @@
+import os
+
+import ueimporter.copy_engine as copy_engine
+
+
+def create_source_files(source_dir, count):
+    source_dir.mkdir()
+    filenames = []
+    for i in range(0, count):
+        filename = source_dir.joinpath(f'file{i}.txt')
+        filename.write_text(f'content {i}')
+        os.chmod(filename, 0o755 if i % 2 else 0o644)
+        filenames.append(filename)
+    return filenames
+
+
+def test_copy_files_will_copy_content_mode_and_timestamps(tmp_path):
+    source_filenames = create_source_files(tmp_path.joinpath('source'), 50)
+    target_dir = tmp_path.joinpath('target')
+    target_dir.mkdir()
+    pairs = [(f, target_dir.joinpath(f.name)) for f in source_filenames]
+
+    engine = copy_engine.CopyEngine(worker_count=4)
+    errors = engine.copy_files(pairs)
+    engine.close()
+
+    assert errors == []
+    for (source, target) in pairs:
+        assert target.read_text() == source.read_text()
+        source_stat = source.stat()
+        target_stat = target.stat()
+        assert target_stat.st_mode == source_stat.st_mode
+        assert target_stat.st_mtime == source_stat.st_mtime
+
+
+def test_copy_files_will_collect_errors_per_file(tmp_path):
+    source_filenames = create_source_files(tmp_path.joinpath('source'), 3)
+    target_dir = tmp_path.joinpath('target')
+    target_dir.mkdir()
+    missing = tmp_path.joinpath('source', 'missing.txt')
+    pairs = [(f, target_dir.joinpath(f.name)) for f in source_filenames]
+    pairs.append((missing, target_dir.joinpath(missing.name)))
+
+    for worker_count in [1, 2]:
+        engine = copy_engine.CopyEngine(worker_count=worker_count)
+        errors = engine.copy_files(pairs)
+        engine.close()
+
+        assert len(errors) == 1
+        assert errors[0].source_filename == missing
+        for (source, target) in pairs[:-1]:
+            assert target.is_file()
+
+
+def test_is_identical_file(tmp_path):
+    source = tmp_path.joinpath('source.txt')
+    target = tmp_path.joinpath('target.txt')
+    source.write_bytes(b'line\n' * 1000)
+    target.write_bytes(b'line\n' * 1000)
+    os.chmod(source, 0o644)
+    os.chmod(target, 0o644)
+    assert copy_engine.is_identical_file((source, target))
+
+    target.write_bytes(b'line\r\n' * 1000)
+    assert not copy_engine.is_identical_file((source, target))
+
+    target.write_bytes(b'line\n' * 999 + b'lime\n')
+    assert not copy_engine.is_identical_file((source, target))
+
+    target.write_bytes(b'line\n' * 1000)
+    os.chmod(target, 0o755)
+    assert not copy_engine.is_identical_file((source, target))
+
+    missing = tmp_path.joinpath('missing.txt')
+    assert not copy_engine.is_identical_file((source, missing))
@@ -0,0 +1,72 @@
+from pathlib import PurePosixPath
+
+import ueimporter.fs_index as fs_index
+
+
+def create_files(root, filenames):
+    for filename in filenames:
+        path = root.joinpath(filename)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(filename)
+
+
+def test_build_will_index_files_and_dirs(tmp_path):
+    create_files(tmp_path, ['Engine/Build/Build.version',
+                            'Engine/Source/Runtime/Core/Core.Build.cs',
+                            'README.md',
+                            '.plastic/plastic.workspace'])
+    tmp_path.joinpath('Engine/Empty').mkdir()
+
+    for worker_count in [1, 4]:
+        index = fs_index.FileSystemIndex.build(tmp_path, worker_count,
+                                               skip_names=['.plastic'])
+        assert index.file_count == 3
+        assert index.is_file(PurePosixPath('README.md'))
+        assert index.is_file(PurePosixPath('Engine/Build/Build.version'))
+        assert not index.is_file(PurePosixPath('Engine/Build'))
+        assert index.is_dir(PurePosixPath('Engine/Source/Runtime'))
+        assert not index.is_dir(PurePosixPath('README.md'))
+        assert not index.is_dir(PurePosixPath('.plastic'))
+        assert index.is_empty_dir(PurePosixPath('Engine/Empty'))
+        assert not index.is_empty_dir(PurePosixPath('Engine'))
+        assert sorted(index.iter_files(PurePosixPath('Engine'))) == [
+            PurePosixPath('Engine/Build/Build.version'),
+            PurePosixPath('Engine/Source/Runtime/Core/Core.Build.cs')]
+
+
+def test_updates_will_be_reflected_in_queries(tmp_path):
+    index = fs_index.FileSystemIndex(tmp_path)
+
+    index.add_file(PurePosixPath('A/B/C/file.txt'))
+    assert index.is_file(PurePosixPath('A/B/C/file.txt'))
+    assert index.is_dir(PurePosixPath('A/B'))
+    assert not index.is_empty_dir(PurePosixPath('A/B/C'))
+
+    index.move_file(PurePosixPath('A/B/C/file.txt'),
+                    PurePosixPath('A/D/file.txt'))
+    assert not index.is_file(PurePosixPath('A/B/C/file.txt'))
+    assert index.is_file(PurePosixPath('A/D/file.txt'))
+    assert index.is_empty_dir(PurePosixPath('A/B/C'))
+
+    index.remove_dir(PurePosixPath('A/B'))
+    assert not index.is_dir(PurePosixPath('A/B/C'))
+    assert not index.is_dir(PurePosixPath('A/B'))
+
+    assert index.child_count(PurePosixPath('A')) == 1
+    assert index.child_count(PurePosixPath('A/B')) == 0
+
+    index.remove_file(PurePosixPath('A/D/file.txt'))
+    assert index.is_empty_dir(PurePosixPath('A/D'))
+    assert index.file_count == 0
+
+
+def test_disk_tree_will_query_the_disc(tmp_path):
+    create_files(tmp_path, ['A/file.txt'])
+    tmp_path.joinpath('B').mkdir()
+    tree = fs_index.DiskTree(tmp_path)
+    assert tree.is_file(PurePosixPath('A/file.txt'))
+    assert tree.is_dir(PurePosixPath('A'))
+    assert not tree.is_empty_dir(PurePosixPath('A'))
+    assert tree.is_empty_dir(PurePosixPath('B'))
+    assert tree.child_count(PurePosixPath('A')) == 1
+    assert tree.child_count(PurePosixPath('C')) == 0
@@ -0,0 +1,178 @@
+import subprocess
+
+import pytest
+
+from pathlib import PurePosixPath
+
+import ueimporter.git as git
+from ueimporter import Logger
+from ueimporter import LogLevel
+
+DIFF_OUTPUT = \
+    'M\0Engine/Build/Build.version\0' \
+    'A\0Engine/Source/New File.cpp\0' \
+    'D\0Engine/Source/Old\tTab.cpp\0' \
+    'R087\0Engine/Plugins/A/a.uplugin\0Engine/Plugins/B/b.uplugin\0' \
+    'A\0Engine/Content/Ünicode.uasset\0'
+
+
+def split_into_chunks(data, chunk_size):
+    return [data[i:i+chunk_size] for i in range(0, len(data), chunk_size)]
+
+
+def test_parse_changes_is_independent_of_chunk_size():
+    data = DIFF_OUTPUT.encode('utf-8')
+    for chunk_size in range(1, len(data) + 1):
+        changes = list(git.parse_changes(
+            split_into_chunks(data, chunk_size)))
+        assert [type(c) for c in changes] == \
+            [git.Modify, git.Add, git.Delete, git.Move, git.Add]
+        assert changes[1].filename == \
+            PurePosixPath('Engine/Source/New File.cpp')
+        assert changes[2].filename == \
+            PurePosixPath('Engine/Source/Old\tTab.cpp')
+        assert changes[3].filename == \
+            PurePosixPath('Engine/Plugins/A/a.uplugin')
+        assert changes[3].target_filename == \
+            PurePosixPath('Engine/Plugins/B/b.uplugin')
+        assert changes[4].filename == \
+            PurePosixPath('Engine/Content/Ünicode.uasset')
+
+
+def test_parse_changes_will_fail_on_unknown_mode():
+    with pytest.raises(git.ParseError):
+        list(git.parse_changes([b'X\0Engine/file.txt\0']))
+
+
+def test_parse_changes_will_fail_on_truncated_output():
+    with pytest.raises(git.ParseError):
+        list(git.parse_changes([b'R100\0Engine/file.txt\0']))
+
+
+def test_parse_changes_will_read_raw_output():
+    old_id = '1' * 40
+    new_id = '2' * 40
+    null_id = '0' * 40
+    data = (f':100644 100755 {old_id} {new_id} M\0Engine/run.sh\0'
+            f':000000 100644 {null_id} {new_id} A\0Engine/New.cpp\0'
+            f':100644 100644 {old_id} {old_id} R100\0Engine/A.h\0'
+            f'Engine/B.h\0').encode('utf-8')
+    changes = list(git.parse_changes(split_into_chunks(data, 7)))
+    assert [type(c) for c in changes] == [git.Modify, git.Add, git.Move]
+    assert changes[0].raw.old_mode == '100644'
+    assert changes[0].raw.new_mode == '100755'
+    assert changes[0].raw.old_object_id == old_id
+    assert changes[0].raw.new_object_id == new_id
+    assert changes[0].raw.is_new_executable
+    assert changes[1].raw.is_new_regular_file
+    assert changes[2].target_filename == PurePosixPath('Engine/B.h')
+    assert changes[2].raw.new_object_id == old_id
+
+
+def run_git(repo_root, *arguments):
+    subprocess.run(['git'] + list(arguments), cwd=repo_root, check=True,
+                   capture_output=True)
+
+
+def create_git_repo(repo_root):
+    repo_root.mkdir()
+    run_git(repo_root, 'init', '-q')
+    run_git(repo_root, 'config', 'user.email', 'test@example.com')
+    run_git(repo_root, 'config', 'user.name', 'Test')
+    for name in ['modified.txt', 'deleted.txt', 'moved.txt']:
+        repo_root.joinpath(name).write_text(f'{name}\n' * 20)
+    run_git(repo_root, 'add', '-A')
+    run_git(repo_root, 'commit', '-q', '-m', 'from')
+    run_git(repo_root, 'tag', 'from')
+
+    repo_root.joinpath('modified.txt').write_text('modified\n')
+    repo_root.joinpath('deleted.txt').unlink()
+    repo_root.joinpath('Sub Dir').mkdir()
+    repo_root.joinpath('moved.txt').rename(
+        repo_root.joinpath('Sub Dir', 'moved.txt'))
+    repo_root.joinpath('added "quoted".txt').write_text('added\n')
+    run_git(repo_root, 'add', '-A')
+    run_git(repo_root, 'commit', '-q', '-m', 'to')
+    run_git(repo_root, 'tag', 'to')
+
+
+@pytest.mark.parametrize('use_cache', [False, True])
+def test_read_changes(tmp_path, use_cache):
+    repo_root = tmp_path.joinpath('repo')
+    create_git_repo(repo_root)
+    cache_dir = tmp_path.joinpath('cache') if use_cache else None
+    logger = Logger(None, LogLevel.ERROR)
+
+    # Second iteration reads from the command cache, if enabled
+    for _ in range(0, 2):
+        repo = git.Repo(repo_root, cache_dir)
+        changes = git.read_changes(repo, 'from', 'to', logger)
+
+        assert [str(c.filename) for c in changes.modifications] == \
+            ['modified.txt']
+        assert [str(c.filename) for c in changes.adds] == \
+            ['added "quoted".txt']
+        assert [str(c.filename) for c in changes.deletes] == \
+            ['deleted.txt']
+        assert [(str(c.filename), str(c.target_filename))
+                for c in changes.moves] == \
+            [('moved.txt', 'Sub Dir/moved.txt')]
+
+    # Blob ids of changes are the ids of the file content
+    modify = changes.modifications[0]
+    assert modify.raw.new_object_id == \
+        git.hash_file(repo_root.joinpath('modified.txt'),
+                      modify.raw.new_object_id)
+    assert changes.moves[0].raw.old_object_id == \
+        changes.moves[0].raw.new_object_id
+
+
+def test_read_changes_will_run_git_on_corrupt_cache_entries(tmp_path):
+    repo_root = tmp_path.joinpath('repo')
+    create_git_repo(repo_root)
+    logger = Logger(None, LogLevel.ERROR)
+    repo = git.Repo(repo_root, tmp_path.joinpath('cache'))
+    expected_changes = git.read_changes(repo, 'from', 'to', logger)
+
+    diff_command = ['git', 'diff', '--raw', '-z', '--no-abbrev', 'from',
+                    'to']
+    filename = repo.command_cache.get_entry_filename(diff_command)
+    filename.write_bytes(filename.read_bytes()[:-8])
+
+    changes = git.read_changes(repo, 'from', 'to', logger)
+
+    assert [str(c.filename) for c in changes.adds] == \
+        [str(c.filename) for c in expected_changes.adds]
+    assert repo.command_cache.read_entry(diff_command) is not None
+
+
+def test_resolve_refs_will_resolve_tags_once(tmp_path):
+    repo_root = tmp_path.joinpath('repo')
+    create_git_repo(repo_root)
+    cache_dir = tmp_path.joinpath('cache')
+    logger = Logger(None, LogLevel.ERROR)
+    expected_hash = subprocess.run(['git', 'rev-parse', 'from^{commit}'],
+                                   cwd=repo_root, check=True,
+                                   capture_output=True,
+                                   encoding='utf-8').stdout.strip()
+
+    repo = git.Repo(repo_root, cache_dir)
+    resolved_refs = repo.resolve_refs(['from', 'to', 'unknown'], logger)
+    assert resolved_refs['from'] == expected_hash
+    assert len(resolved_refs['to']) == 40
+    assert resolved_refs['unknown'] is None
+    assert repo.rev_list('from', logger) == expected_hash
+    assert repo.command_cache.stats.miss_count == 1
+
+    # A new process reads the refs from the command cache
+    repo = git.Repo(repo_root, cache_dir)
+    assert repo.resolve_refs(['from', 'to', 'unknown'], logger) == \
+        resolved_refs
+    assert repo.command_cache.stats.hit_count == 1
+
+    # Until the tags change
+    run_git(repo_root, 'tag', '-f', 'from', 'to')
+    repo = git.Repo(repo_root, cache_dir)
+    assert repo.resolve_refs(['from', 'to', 'unknown'], logger)['from'] == \
+        resolved_refs['to']
+    assert repo.command_cache.stats.miss_count == 1
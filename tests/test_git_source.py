@@ -0,0 +1,93 @@
+import os
+import stat
+import subprocess
+
+import pytest
+
+from pathlib import PurePosixPath
+
+import ueimporter.copy_engine as copy_engine
+import ueimporter.git as git
+import ueimporter.git_source as git_source
+from ueimporter import Logger
+from ueimporter import LogLevel
+
+FILES = {
+    'Engine/Build/Build.version': (b'{\n}\n', 0o644),
+    'Engine/Build/BatchFiles/Linux/Setup.sh': (b'#!/bin/sh\necho\n', 0o755),
+    'Engine/Content/Binary.uasset': (b'\0\n\n', 0o644),
+    'Engine/Source/Unchanged.cpp': (b'unchanged\n', 0o644),
+}
+
+
+def run_git(repo_root, *arguments):
+    return subprocess.run(['git'] + list(arguments), cwd=repo_root,
+                          check=True, capture_output=True,
+                          encoding='utf-8').stdout
+
+
+def create_git_repo(repo_root):
+    repo_root.mkdir()
+    run_git(repo_root, 'init', '-q')
+    run_git(repo_root, 'config', 'user.email', 'test@example.com')
+    run_git(repo_root, 'config', 'user.name', 'Test')
+    run_git(repo_root, 'config', 'core.autocrlf', 'false')
+    for (filename, (content, mode)) in FILES.items():
+        path = repo_root.joinpath(filename)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(content)
+        os.chmod(path, mode)
+    run_git(repo_root, 'add', '-A')
+    run_git(repo_root, 'commit', '-q', '-m', 'release')
+    return run_git(repo_root, 'rev-parse', 'HEAD').strip()
+
+
+@pytest.mark.parametrize('eol', git_source.EOLS)
+def test_git_source_will_only_extract_wanted_files(tmp_path, eol):
+    repo_root = tmp_path.joinpath('repo')
+    commit_hash = create_git_repo(repo_root)
+
+    staging_root = tmp_path.joinpath('staging')
+    source = git_source.GitSource(git.Repo(repo_root, None), commit_hash,
+                                  staging_root, eol=eol)
+    wanted = [PurePosixPath('Engine/Build/Build.version'),
+              PurePosixPath('Engine/Build/BatchFiles/Linux/Setup.sh'),
+              PurePosixPath('Engine/Content/Binary.uasset'),
+              PurePosixPath('Engine/Source/Missing.cpp')]
+    source.extract(wanted, copy_engine.CopyEngine(1),
+                   Logger(None, LogLevel.ERROR))
+
+    for filename in FILES.keys():
+        assert source.tree.is_file(filename)
+    assert source.tree.is_dir('Engine/Build/BatchFiles')
+    assert not source.tree.is_file('Engine/Source/Missing.cpp')
+    assert source.extracted_count == 3
+
+    assert not staging_root.joinpath('Engine/Source/Unchanged.cpp').exists()
+    for filename in wanted[:3]:
+        (content, mode) = FILES[str(filename)]
+        if eol == 'crlf' and b'\0' not in content:
+            content = content.replace(b'\n', b'\r\n')
+        staged = staging_root.joinpath(filename)
+        assert staged.read_bytes() == content
+        assert stat.S_IMODE(os.stat(staged).st_mode) == mode
+
+    source.close()
+    assert not staging_root.exists()
+
+
+def test_blob_reader_will_fail_on_missing_object(tmp_path):
+    repo_root = tmp_path.joinpath('repo')
+    create_git_repo(repo_root)
+    object_id = run_git(repo_root, 'rev-parse',
+                        'HEAD:Engine/Build/Build.version').strip()
+
+    reader = git.BlobReader(repo_root)
+    reader.start(Logger(None, LogLevel.ERROR))
+    try:
+        blobs = reader.read_blobs([object_id, '0' * 40])
+        assert next(blobs) == (object_id, b'{\n}\n')
+        with pytest.raises(git.ParseError):
+            next(blobs)
+    finally:
+        reader.close()
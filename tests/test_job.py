@@ -0,0 +1,605 @@
+import json
+import os
+import time
+
+from pathlib import PurePosixPath
+
+import ueimporter
+import ueimporter.fs_index as fs_index
+import ueimporter.git as git
+import ueimporter.job as job
+import ueimporter.op as op
+import ueimporter.plastic as plastic
+from ueimporter import Logger
+from ueimporter import LogLevel
+
+
+def create_logger():
+    return Logger(None, LogLevel.ERROR)
+
+
+def create_job(job_class, source_root, workspace_root):
+    return job_class(logger=create_logger(),
+                     plastic_repo=plastic.Repo(workspace_root, pretend=True),
+                     source_root_path=source_root,
+                     pretend=True)
+
+
+def create_files(root, filenames):
+    for filename in filenames:
+        path = root.joinpath(filename)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(filename)
+
+
+def test_find_invalid_ops_is_ordered_for_any_worker_count(tmp_path):
+    source_root = tmp_path.joinpath('source')
+    workspace_root = tmp_path.joinpath('workspace')
+    filenames = [f'Engine/Dir{i % 7}/File{i}.txt' for i in range(0, 200)]
+    create_files(source_root, filenames)
+    create_files(workspace_root, filenames[0::3])
+
+    add_job = create_job(job.AddJob, source_root, workspace_root)
+    for filename in filenames:
+        add_job.add_change(git.Add(filename))
+
+    expected = [PurePosixPath(f) for f in filenames[0::3]]
+    for worker_count in [1, 4]:
+        invalid_ops = add_job.find_invalid_ops(worker_count)
+        assert [op.filename for (op, _) in invalid_ops] == expected
+        assert all(not validation for (_, validation) in invalid_ops)
+
+
+def test_ops_view_will_slice_without_copying():
+    ops = list(range(0, 10))
+    view = job.OpsView(ops, 2, 8)
+    assert len(view) == 6
+    assert list(view) == [2, 3, 4, 5, 6, 7]
+    assert view[0] == 2
+    assert view[-1] == 7
+    assert list(view[1:3]) == [3, 4]
+    assert list(view[4:100]) == [6, 7]
+    assert len(view[5:2]) == 0
+
+
+def create_index(filenames):
+    index = fs_index.FileSystemIndex(PurePosixPath('/workspace'))
+    for filename in filenames:
+        index.add_file(PurePosixPath(filename))
+    return index
+
+
+def create_changes(adds=[], deletes=[], modifications=[], moves=[]):
+    return git.Changes({},
+                       [git.Modify(f) for f in modifications],
+                       [git.Add(f) for f in adds],
+                       [git.Delete(f) for f in deletes],
+                       [git.Move(f, t) for (f, t) in moves])
+
+
+def test_find_directory_moves_will_coalesce_whole_directories():
+    workspace_tree = create_index([
+        'Plugins/Old/Source/A.cpp',
+        'Plugins/Old/Source/B.cpp',
+        'Plugins/Old/Old.uplugin',
+        'Plugins/Other/C.cpp'])
+    changes = create_changes(moves=[
+        ('Plugins/Old/Source/A.cpp', 'Plugins/New/Source/A.cpp'),
+        ('Plugins/Old/Source/B.cpp', 'Plugins/New/Source/B.cpp'),
+        ('Plugins/Old/Old.uplugin', 'Plugins/New/Old.uplugin'),
+        ('Plugins/Other/C.cpp', 'Plugins/Other/D.cpp')])
+
+    dir_moves = job.find_directory_moves(changes, workspace_tree)
+    assert len(dir_moves) == 1
+    assert dir_moves[0].filename == PurePosixPath('Plugins/Old')
+    assert dir_moves[0].target_filename == PurePosixPath('Plugins/New')
+    assert len(dir_moves[0].moves) == 3
+
+
+def test_find_directory_moves_will_skip_partial_directories():
+    workspace_tree = create_index([
+        'Plugins/Old/Source/A.cpp',
+        'Plugins/Old/Source/B.cpp',
+        'Plugins/Old/Old.uplugin'])
+    changes = create_changes(moves=[
+        ('Plugins/Old/Source/A.cpp', 'Plugins/New/Source/A.cpp'),
+        ('Plugins/Old/Source/B.cpp', 'Plugins/New/Source/B.cpp')])
+
+    # Plugins/Old/Old.uplugin stays, but Source moves in its entirety
+    dir_moves = job.find_directory_moves(changes, workspace_tree)
+    assert [(str(m.filename), str(m.target_filename)) for m in dir_moves] == \
+        [('Plugins/Old/Source', 'Plugins/New/Source')]
+
+
+def test_find_directory_moves_will_skip_directories_touched_by_others():
+    workspace_tree = create_index([
+        'Plugins/Old/A.cpp',
+        'Plugins/Old/B.cpp',
+        'Plugins/Existing/C.cpp'])
+    moves = [('Plugins/Old/A.cpp', 'Plugins/New/A.cpp'),
+             ('Plugins/Old/B.cpp', 'Plugins/New/B.cpp')]
+
+    changes = create_changes(moves=moves, adds=['Plugins/New/D.cpp'])
+    assert job.find_directory_moves(changes, workspace_tree) == []
+
+    changes = create_changes(moves=moves, modifications=['Plugins/Old/A.cpp'])
+    assert job.find_directory_moves(changes, workspace_tree) == []
+
+    # Target directory already exists in workspace
+    changes = create_changes(moves=[
+        ('Plugins/Old/A.cpp', 'Plugins/Existing/A.cpp'),
+        ('Plugins/Old/B.cpp', 'Plugins/Existing/B.cpp')])
+    assert job.find_directory_moves(changes, workspace_tree) == []
+
+    # Files are renamed, not only relocated
+    changes = create_changes(moves=[
+        ('Plugins/Old/A.cpp', 'Plugins/New/A2.cpp'),
+        ('Plugins/Old/B.cpp', 'Plugins/New/B.cpp')])
+    assert job.find_directory_moves(changes, workspace_tree) == []
+
+
+def test_find_directory_adds_will_coalesce_new_directories():
+    workspace_tree = create_index(['Plugins/Existing/A.cpp'])
+    adds = ['Plugins/New/Source/B.cpp',
+            'Plugins/New/Source/C.cpp',
+            'Plugins/New/New.uplugin',
+            'Plugins/Existing/D.cpp',
+            'Plugins/Existing/Source/E.cpp',
+            'Plugins/Existing/Source/F.cpp']
+    changes = create_changes(adds=adds)
+    ignore_rules = plastic.IgnoreRules()
+
+    dir_adds = job.find_directory_adds(changes, workspace_tree, ignore_rules)
+    assert [(str(a.filename), len(a.adds)) for a in dir_adds] == \
+        [('Plugins/New', 3), ('Plugins/Existing/Source', 2)]
+
+    # Recursive adds skip ignored files
+    ignore_rules = plastic.IgnoreRules(['*.uplugin'])
+    dir_adds = job.find_directory_adds(changes, workspace_tree, ignore_rules)
+    assert [str(a.filename) for a in dir_adds] == \
+        ['Plugins/Existing/Source', 'Plugins/New/Source']
+
+    changes = create_changes(adds=adds, moves=[
+        ('Plugins/Existing/A.cpp', 'Plugins/New/A.cpp')])
+    dir_adds = job.find_directory_adds(changes, workspace_tree,
+                                       plastic.IgnoreRules())
+    assert [str(a.filename) for a in dir_adds] == \
+        ['Plugins/Existing/Source', 'Plugins/New/Source']
+
+
+def test_find_directory_deletes_will_coalesce_whole_directories():
+    workspace_tree = create_index([
+        'Plugins/Old/Source/A.cpp',
+        'Plugins/Old/Source/B.cpp',
+        'Plugins/Old/Old.uplugin',
+        'Plugins/Part/C.cpp',
+        'Plugins/Part/D.cpp'])
+    changes = create_changes(deletes=[
+        'Plugins/Old/Source/A.cpp',
+        'Plugins/Old/Source/B.cpp',
+        'Plugins/Old/Old.uplugin',
+        'Plugins/Part/C.cpp'])
+
+    dir_deletes = job.find_directory_deletes(changes, workspace_tree)
+    assert len(dir_deletes) == 1
+    assert dir_deletes[0].filename == PurePosixPath('Plugins/Old')
+    assert len(dir_deletes[0].deletes) == 3
+
+
+def test_find_directory_deletes_will_skip_directories_touched_by_others():
+    workspace_tree = create_index([
+        'Plugins/Old/A.cpp',
+        'Plugins/Old/B.cpp',
+        'Plugins/Other/C.cpp'])
+    deletes = ['Plugins/Old/A.cpp', 'Plugins/Old/B.cpp']
+
+    changes = create_changes(deletes=deletes, adds=['Plugins/Old/D.cpp'])
+    assert job.find_directory_deletes(changes, workspace_tree) == []
+
+    changes = create_changes(deletes=deletes, moves=[
+        ('Plugins/Other/C.cpp', 'Plugins/Old/C.cpp')])
+    assert job.find_directory_deletes(changes, workspace_tree) == []
+
+    # Files in the workspace that are not part of the diff
+    workspace_tree.add_file(PurePosixPath('Plugins/Old/Private.txt'))
+    changes = create_changes(deletes=deletes)
+    assert job.find_directory_deletes(changes, workspace_tree) == []
+
+
+def test_find_dirs_to_create_will_include_all_missing_ancestors():
+    workspace_tree = create_index(['Engine/A.cpp'])
+    filenames = [PurePosixPath(f) for f in [
+        'Engine/A.cpp', 'Engine/New/Deep/B.cpp', 'Engine/New/C.cpp']]
+    assert job.find_dirs_to_create(workspace_tree, filenames) == [
+        PurePosixPath('Engine/New'), PurePosixPath('Engine/New/Deep')]
+
+
+def test_find_emptied_dirs_will_return_outermost_emptied_dirs():
+    workspace_tree = create_index([
+        'Engine/Keep.cpp',
+        'Engine/Old/Deep/A.cpp',
+        'Engine/Old/B.cpp',
+        'Engine/Part/C.cpp',
+        'Engine/Part/Sub/D.cpp',
+        'Engine/Private/Deep/E.cpp'])
+    workspace_tree.add_dir(PurePosixPath('Engine/Private/Empty'))
+    filenames = [PurePosixPath(f) for f in [
+        'Engine/Old/Deep/A.cpp', 'Engine/Old/B.cpp', 'Engine/Part/Sub/D.cpp',
+        'Engine/Private/Deep/E.cpp']]
+    for filename in filenames:
+        workspace_tree.remove_file(filename)
+
+    # Engine/Private/Empty was empty to begin with, and is left as is
+    (empty_dirs, emptied_count) = job.find_emptied_dirs(workspace_tree,
+                                                        filenames)
+    assert empty_dirs == [PurePosixPath('Engine/Old'),
+                          PurePosixPath('Engine/Part/Sub'),
+                          PurePosixPath('Engine/Private/Deep')]
+    assert emptied_count == 4
+
+
+class RecordingRepo(plastic.Repo):
+    def __init__(self, workspace_root, fail_count=0):
+        plastic.Repo.__init__(self, workspace_root, pretend=False)
+        self.commands = []
+        self._fail_count = fail_count
+
+    def run_cmd(self, arguments, logger, paths=None):
+        if self._fail_count > 0:
+            self._fail_count -= 1
+            raise ueimporter.CommandError(['cm'] + arguments, 1, 'failed')
+        self.commands.append(
+            (arguments[0], [str(p) for p in paths] if paths else []))
+        return ''
+
+
+def create_pipelined_add_job(tmp_path, filenames, fail_count=0):
+    source_root = tmp_path.joinpath('source')
+    workspace_root = tmp_path.joinpath('workspace')
+    workspace_root.mkdir()
+    create_files(source_root, filenames)
+    add_job = job.AddJob(logger=create_logger(),
+                         plastic_repo=RecordingRepo(workspace_root,
+                                                    fail_count),
+                         source_root_path=source_root,
+                         pretend=False,
+                         batch_size=2,
+                         pipelined=True)
+    for filename in filenames:
+        add_job.add_change(git.Add(filename))
+    return add_job
+
+
+def test_pipelined_add_job_will_add_files_and_dirs_in_order(tmp_path):
+    filenames = ['A/1.txt', 'A/2.txt', 'A/B/3.txt', 'C/4.txt', 'C/5.txt']
+    add_job = create_pipelined_add_job(tmp_path, filenames)
+    assert add_job.pipelined
+
+    add_job.process(-1, job.JobProgressListener())
+
+    assert add_job.processed_op_count == len(filenames)
+    for filename in filenames:
+        assert add_job.plastic_repo.to_workspace_path(filename).is_file()
+    assert add_job.plastic_repo.commands == [
+        ('add', ['A', 'A/1.txt', 'A/2.txt']),
+        ('add', ['A/B', 'A/B/3.txt', 'C', 'C/4.txt']),
+        ('add', ['C/5.txt'])]
+
+
+def test_adds_of_interrupted_batches_are_always_processed_again():
+    # Copied files might never have been added to plastic
+    workspace_tree = create_index(['A/1.txt', 'B/2.txt'])
+    assert not op.AddOp(git.Add('A/1.txt')).is_applied(workspace_tree)
+    assert not op.AddDirOp(git.AddDir('B', [git.Add('B/2.txt')])) \
+        .is_applied(workspace_tree)
+
+
+def test_pipelined_add_job_will_add_new_directories_recursively(tmp_path):
+    filenames = ['A/1.txt', 'B/C/2.txt', 'B/C/D/3.txt', 'B/4.txt']
+    add_job = create_pipelined_add_job(tmp_path, [])
+    create_files(add_job.source_root_path, filenames)
+    add_job.add_change(git.Add('A/1.txt'))
+    add_job.add_change(git.AddDir('B/C', [git.Add('B/C/2.txt'),
+                                         git.Add('B/C/D/3.txt')]))
+    add_job.add_change(git.Add('B/4.txt'))
+
+    add_job.process(-1, job.JobProgressListener())
+
+    assert add_job.processed_op_count == 3
+    for filename in filenames:
+        assert add_job.plastic_repo.to_workspace_path(filename).is_file()
+    assert add_job.plastic_repo.commands == [
+        ('add', ['A', 'A/1.txt', 'B']),
+        ('add', ['B/C']),
+        ('add', ['B/4.txt'])]
+
+
+def test_modify_job_will_skip_files_matching_their_new_blob(tmp_path):
+    source_root = tmp_path.joinpath('source')
+    workspace_root = tmp_path.joinpath('workspace')
+    filenames = ['same.txt', 'mode.sh', 'modified.txt', 'no_blob.txt']
+    create_files(source_root, filenames)
+    create_files(workspace_root, filenames)
+    workspace_root.joinpath('modified.txt').write_text('old content')
+    # Source files differ, so that copies can be told apart
+    source_root.joinpath('same.txt').write_text('source')
+    source_root.joinpath('mode.sh').write_text('source')
+
+    def to_object_id(filename):
+        return git.hash_file(workspace_root.joinpath(filename), '0' * 40)
+
+    modify_job = job.ModifyJob(logger=create_logger(),
+                               plastic_repo=RecordingRepo(workspace_root),
+                               source_root_path=source_root,
+                               pretend=False)
+    for (filename, mode) in [('same.txt', '100644'),
+                             ('mode.sh', '100755'),
+                             ('modified.txt', '100644')]:
+        object_id = to_object_id(filename)
+        if filename == 'modified.txt':
+            object_id = to_object_id('same.txt')
+        modify_job.add_change(git.Modify(filename, git.RawDiff(
+            '100644', mode, '1' * 40, object_id)))
+    modify_job.add_change(git.Modify('no_blob.txt'))
+
+    modify_job.process(-1, job.JobProgressListener())
+
+    assert modify_job.plastic_repo.commands == [
+        ('checkout', ['mode.sh', 'modified.txt'])]
+    assert modify_job.elided_op_count == 2
+    assert workspace_root.joinpath('same.txt').read_text() == 'same.txt'
+    assert workspace_root.joinpath('mode.sh').read_text() == 'mode.sh'
+    assert os.access(workspace_root.joinpath('mode.sh'), os.X_OK)
+    assert workspace_root.joinpath('modified.txt').read_text() == \
+        'modified.txt'
+
+
+def test_modify_job_will_count_elided_ops_of_retried_batches_once(tmp_path):
+    source_root = tmp_path.joinpath('source')
+    workspace_root = tmp_path.joinpath('workspace')
+    filenames = ['same.txt', 'modified.txt']
+    create_files(source_root, filenames)
+    create_files(workspace_root, filenames)
+    workspace_root.joinpath('modified.txt').write_text('old content')
+
+    modify_job = job.ModifyJob(logger=create_logger(),
+                               plastic_repo=RecordingRepo(workspace_root,
+                                                          fail_count=1),
+                               source_root_path=source_root,
+                               pretend=False,
+                               pipelined=True)
+    for filename in filenames:
+        modify_job.add_change(git.Modify(filename))
+
+    modify_job.process(-1, job.JobProgressListener())
+
+    assert modify_job.batcher.failure_count == 1
+    assert modify_job.plastic_repo.commands == [
+        ('checkout', ['modified.txt'])]
+    assert modify_job.elided_op_count == 1
+
+
+def test_pipelined_add_job_will_add_dirs_when_retrying(tmp_path):
+    filenames = ['A/1.txt', 'A/2.txt', 'B/3.txt', 'B/4.txt']
+    add_job = create_pipelined_add_job(tmp_path, filenames, fail_count=1)
+
+    add_job.process(-1, job.JobProgressListener())
+
+    assert add_job.processed_op_count == len(filenames)
+    assert add_job.batcher.failure_count == 1
+    added_paths = [p for (_, paths) in add_job.plastic_repo.commands
+                   for p in paths]
+    assert sorted(added_paths) == sorted(['A', 'B'] + filenames)
+
+
+class MovingRepo(RecordingRepo):
+    # Moves files on disc, and fails the first failing_command passed
+    # failing_path
+    def __init__(self, workspace_root, failing_path,
+                 failing_command='move'):
+        RecordingRepo.__init__(self, workspace_root)
+        self._failing_path = failing_path
+        self._failing_command = failing_command
+
+    def run_cmd(self, arguments, logger, paths=None):
+        command_paths = [str(p) for p in (paths or arguments[1:])]
+        if arguments[0] == self._failing_command and \
+                self._failing_path in command_paths:
+            self._failing_path = None
+            raise ueimporter.CommandError(['cm'] + arguments, 1, 'failed')
+        if arguments[0] == 'move':
+            self.workspace_root.joinpath(arguments[2]).parent.mkdir(
+                parents=True, exist_ok=True)
+            self.workspace_root.joinpath(arguments[1]).rename(
+                self.workspace_root.joinpath(arguments[2]))
+        return RecordingRepo.run_cmd(self, arguments, logger, paths)
+
+
+def test_move_job_will_not_repeat_moves_of_failed_batches(tmp_path):
+    source_root = tmp_path.joinpath('source')
+    workspace_root = tmp_path.joinpath('workspace')
+    filenames = ['A/1.txt', 'A/2.txt', 'A/3.txt']
+    create_files(workspace_root, filenames)
+    create_files(source_root, [f.replace('A/', 'B/') for f in filenames])
+    move_job = job.MoveJob(logger=create_logger(),
+                           plastic_repo=MovingRepo(workspace_root,
+                                                   'A/2.txt'),
+                           source_root_path=source_root,
+                           pretend=False,
+                           workspace_tree=create_index(filenames))
+    for filename in filenames:
+        move_job.add_change(git.Move(filename,
+                                     filename.replace('A/', 'B/')))
+
+    move_job.process(-1, job.JobProgressListener())
+
+    assert move_job.processed_op_count == len(filenames)
+    assert move_job.batcher.failure_count == 1
+    moves = [c for c in move_job.plastic_repo.commands if c[0] == 'move']
+    assert len(moves) == len(filenames)
+    for filename in filenames:
+        target_filename = filename.replace('A/', 'B/')
+        assert move_job.workspace_tree.is_file(target_filename)
+        assert workspace_root.joinpath(target_filename).read_text() == \
+            target_filename
+
+
+def test_move_job_will_add_parent_dirs_of_failed_batches(tmp_path):
+    source_root = tmp_path.joinpath('source')
+    workspace_root = tmp_path.joinpath('workspace')
+    filenames = ['A/1.txt', 'A/2.txt']
+    create_files(workspace_root, filenames)
+    create_files(source_root, ['New/Dir/1.txt', 'New/Dir/2.txt'])
+    move_job = job.MoveJob(logger=create_logger(),
+                           plastic_repo=MovingRepo(workspace_root, 'New',
+                                                   failing_command='add'),
+                           source_root_path=source_root,
+                           pretend=False,
+                           workspace_tree=create_index(filenames))
+    for filename in filenames:
+        move_job.add_change(git.Move(filename,
+                                     filename.replace('A/', 'New/Dir/')))
+
+    move_job.process(-1, job.JobProgressListener())
+
+    assert move_job.batcher.failure_count == 1
+    assert move_job.plastic_repo.commands[0] == ('add', ['New', 'New/Dir'])
+    assert move_job.plastic_repo.commands[1:] == [
+        ('move', []), ('move', []), ('remove', ['A'])]
+
+
+def test_delete_job_will_remove_whole_directories(tmp_path):
+    workspace_tree = create_index([
+        'Plugins/Old/Source/A.cpp',
+        'Plugins/Old/Old.uplugin',
+        'Plugins/Part/C.cpp',
+        'Plugins/Part/D.cpp'])
+    delete_job = job.DeleteJob(logger=create_logger(),
+                               plastic_repo=RecordingRepo(tmp_path),
+                               source_root_path=tmp_path,
+                               pretend=False,
+                               workspace_tree=workspace_tree)
+    delete_job.add_change(git.DeleteDir('Plugins/Old', [
+        git.Delete('Plugins/Old/Source/A.cpp'),
+        git.Delete('Plugins/Old/Old.uplugin')]))
+    delete_job.add_change(git.Delete('Plugins/Part/C.cpp'))
+
+    dir_op = delete_job.ops[0]
+    assert [str(d.filename) for d in
+            op.from_record(dir_op.to_record()).deletes] == \
+        ['Plugins/Old/Source/A.cpp', 'Plugins/Old/Old.uplugin']
+
+    delete_job.process(-1, job.JobProgressListener())
+
+    assert delete_job.plastic_repo.commands == [
+        ('remove', ['Plugins/Old', 'Plugins/Part/C.cpp'])]
+    assert not workspace_tree.is_dir('Plugins/Old')
+    assert dir_op.is_applied(workspace_tree)
+    assert workspace_tree.is_file('Plugins/Part/D.cpp')
+
+
+def test_op_records_will_keep_modes_and_blob_ids():
+    def raw(index):
+        return git.RawDiff('100644', '100755', str(index) * 40,
+                           str(index + 1) * 40)
+
+    ops = [op.AddOp(git.Add('A.txt', raw(1))),
+           op.AddDirOp(git.AddDir('New', [git.Add('New/A.txt', raw(2))])),
+           op.DeleteOp(git.Delete('B.txt', raw(3))),
+           op.DeleteDirOp(git.DeleteDir('Old', [
+               git.Delete('Old/B.txt', raw(4))])),
+           op.ModifyOp(git.Modify('C.txt', raw(5))),
+           op.ModifyOp(git.Modify('D.txt')),
+           op.MoveOp(git.Move('E.txt', 'F.txt', raw(6))),
+           op.MoveDirOp(git.MoveDir('From', 'To', [
+               git.Move('From/G.txt', 'To/G.txt', raw(7))]))]
+
+    def to_fields(change):
+        fields = [type(change).__name__, str(change.filename),
+                  str(getattr(change, 'target_filename', ''))]
+        if change.raw:
+            fields += [change.raw.old_mode, change.raw.new_mode,
+                       change.raw.old_object_id, change.raw.new_object_id]
+        for sub_change in getattr(change, 'adds', []) + \
+                getattr(change, 'deletes', []) + \
+                getattr(change, 'moves', []):
+            fields.append(to_fields(sub_change))
+        return fields
+
+    for original_op in ops:
+        record = json.loads(json.dumps(original_op.to_record()))
+        resumed_op = op.from_record(record)
+        assert type(resumed_op) == type(original_op)
+        assert to_fields(resumed_op.change) == to_fields(original_op.change)
+    assert op.from_record(ops[4].to_record()).change.raw.is_new_executable
+
+
+def create_large_changes(change_count):
+    # A quarter of the changes of each type, in directories of 50 files
+    def filename(i, name='File'):
+        return f'Engine/Module{i // 1000}/Dir{i // 50 % 20}/{name}{i}.cpp'
+
+    quarter = change_count // 4
+    workspace_filenames = [filename(i) for i in range(0, 3 * quarter)]
+    changes = create_changes(
+        modifications=[filename(i) for i in range(0, quarter)],
+        deletes=[filename(i) for i in range(quarter, 2 * quarter)],
+        moves=[(filename(i), filename(i, 'Moved'))
+               for i in range(2 * quarter, 3 * quarter)],
+        adds=[filename(i) for i in range(3 * quarter, 4 * quarter)])
+    for change_list in [changes.modifications, changes.deletes,
+                        changes.moves, changes.adds]:
+        change_list.sort(key=lambda c: c.sort_key)
+    # Every tenth move has already been applied in the workspace
+    for i in range(2 * quarter, 3 * quarter, 10):
+        workspace_filenames[i] = filename(i, 'Moved')
+    # Files that are deleted and added again with another case
+    for i in range(0, quarter, 100):
+        lower_filename = filename(i, 'Case').lower()
+        changes.per_file_changes[lower_filename] = [
+            git.Delete(filename(i, 'Case')), git.Add(filename(i, 'CASE'))]
+        workspace_filenames.append(filename(i, 'Case'))
+    return (changes, create_index(workspace_filenames))
+
+
+def plan_large_changes(tmp_path, change_count):
+    # Returns the planned jobs, and the time it took to plan them
+    (changes, workspace_tree) = create_large_changes(change_count)
+
+    start_time = time.perf_counter()
+    jobs = job.create_jobs(changes,
+                           plastic_repo=plastic.Repo(tmp_path, pretend=True),
+                           source_root_path=tmp_path,
+                           pretend=True,
+                           logger=create_logger(),
+                           workspace_tree=workspace_tree)
+    modify_job = [j for j in jobs if j.desc == 'Modify'][0]
+    modify_job.remove_ops(modify_job.ops[0::2])
+    return (jobs, time.perf_counter() - start_time)
+
+
+def test_create_jobs_will_plan_large_diffs_in_time(tmp_path):
+    change_count = 80000
+    # The best of two runs, to not be thrown off by a single slow run
+    small_elapsed_time = min(
+        plan_large_changes(tmp_path, change_count // 4)[1]
+        for _ in range(0, 2))
+    (jobs, elapsed_time) = min(
+        [plan_large_changes(tmp_path, change_count) for _ in range(0, 2)],
+        key=lambda r: r[1])
+    desc_to_job = {j.desc: j for j in jobs}
+    modify_job = desc_to_job['Modify']
+
+    # Planning is O(n log n), four times the changes take a little more
+    # than four times as long, where a quadratic planner takes sixteen
+    assert elapsed_time < 8 * small_elapsed_time
+    for planned_job in jobs:
+        sort_keys = [o.change.sort_key for o in planned_job.ops]
+        assert sort_keys == sorted(sort_keys)
+    quarter = change_count // 4
+    assert len(desc_to_job['Move'].ops) == quarter - quarter // 10 + \
+        quarter // 100
+    assert len(modify_job.ops) == (quarter + quarter // 10 + 1) // 2
+    # Deletes and adds cover whole modules of 1000 files
+    assert len(desc_to_job['Delete'].ops) == quarter // 1000
+    assert len(desc_to_job['Add'].ops) == quarter // 1000
@@ -0,0 +1,126 @@
+from pathlib import PurePosixPath
+
+import ueimporter.batch as batch
+import ueimporter.git as git
+import ueimporter.job as job
+import ueimporter.journal as journal
+import ueimporter.plastic as plastic
+from ueimporter import Logger
+from ueimporter import LogLevel
+
+
+def create_jobs(tmp_path):
+    kwargs = {
+        'logger': Logger(None, LogLevel.ERROR),
+        'plastic_repo': plastic.Repo(tmp_path, pretend=True),
+        'source_root_path': tmp_path,
+        'pretend': True
+    }
+    add_job = job.AddJob(**kwargs)
+    for i in range(0, 10):
+        add_job.add_change(git.Add(f'Engine/Added{i}.txt'))
+    move_job = job.MoveJob(**kwargs)
+    move_job.add_change(git.Move('Engine/A.txt', 'Engine/B.txt'))
+    move_job.add_change(git.MoveDir('Engine/Old', 'Engine/New', [
+        git.Move('Engine/Old/C.txt', 'Engine/New/C.txt')]))
+    return [add_job, move_job]
+
+
+def test_journal_will_restore_plan_and_progress(tmp_path):
+    filename = tmp_path.joinpath('journal', 'journal.jsonl')
+    jobs = create_jobs(tmp_path)
+    add_job = jobs[0]
+
+    recorder = journal.Journal.create(filename, '4.27.1-release',
+                                      '4.27.2-release', jobs)
+    recorder.record_batch_start(add_job, 0, 4)
+    recorder.record_batch_end(add_job, 4)
+    recorder.record_batch_start(add_job, 4, 8)
+    recorder.close()
+
+    state = journal.read(filename)
+    assert state.from_release_tag == '4.27.1-release'
+    assert state.to_release_tag == '4.27.2-release'
+    assert not state.is_done
+    assert [j.desc for j in state.jobs] == ['Add', 'Move']
+    assert state.jobs[0].processed_op_count == 4
+    assert state.jobs[0].interrupted_batch == (4, 8)
+    assert state.jobs[1].processed_op_count == 0
+    assert state.jobs[1].interrupted_batch is None
+
+    assert [str(o) for o in state.jobs[0].ops] == \
+        [str(o) for o in add_job.ops]
+    move_ops = state.jobs[1].ops
+    assert move_ops[0].target_filename == PurePosixPath('Engine/B.txt')
+    assert move_ops[1].target_filenames == [PurePosixPath('Engine/New/C.txt')]
+
+
+def test_journal_will_ignore_truncated_last_record(tmp_path):
+    filename = tmp_path.joinpath('journal.jsonl')
+    jobs = create_jobs(tmp_path)
+    recorder = journal.Journal.create(filename, 'from', 'to', jobs)
+    recorder.record_batch_start(jobs[0], 0, 4)
+    recorder.record_batch_end(jobs[0], 4)
+    recorder.close()
+    with open(filename, 'a') as f:
+        f.write('{"record":"batch_st')
+
+    state = journal.read(filename)
+    assert state.jobs[0].processed_op_count == 4
+    assert state.jobs[0].interrupted_batch is None
+
+
+def test_journal_will_record_done(tmp_path):
+    filename = tmp_path.joinpath('journal.jsonl')
+    jobs = create_jobs(tmp_path)
+    journal.Journal.create(filename, 'from', 'to', jobs).close()
+    recorder = journal.Journal.reopen(filename, jobs)
+    recorder.record_done()
+    recorder.close()
+    assert journal.read(filename).is_done
+
+
+class NullListener(job.JobProgressListener):
+    pass
+
+
+def test_job_process_will_write_batches_to_journal(tmp_path):
+    filename = tmp_path.joinpath('journal.jsonl')
+    jobs = create_jobs(tmp_path)
+    add_job = jobs[0]
+    add_job.batcher = batch.AdaptiveBatcher.fixed(3)
+    recorder = journal.Journal.create(filename, 'from', 'to', jobs)
+    add_job.process(7, NullListener(), recorder)
+    recorder.close()
+
+    state = journal.read(filename)
+    assert state.jobs[0].processed_op_count == 7
+    assert state.jobs[0].interrupted_batch is None
+
+    restored_jobs = job.restore_jobs(
+        state.jobs,
+        plastic_repo=plastic.Repo(tmp_path, pretend=True),
+        source_root_path=tmp_path,
+        pretend=True,
+        logger=Logger(None, LogLevel.ERROR))
+    assert len(restored_jobs[0].unprocessed_ops) == 3
+
+
+def test_journal_will_cover_overlapping_batches(tmp_path):
+    filename = tmp_path.joinpath('journal.jsonl')
+    jobs = create_jobs(tmp_path)
+    add_job = jobs[0]
+
+    # Pipelined jobs start a batch before the previous one has ended
+    recorder = journal.Journal.create(filename, '4.27.1-release',
+                                      '4.27.2-release', jobs)
+    recorder.record_batch_start(add_job, 0, 3)
+    recorder.record_batch_start(add_job, 3, 6)
+    recorder.record_batch_end(add_job, 3)
+    recorder.record_batch_start(add_job, 6, 9)
+    recorder.record_batch_end(add_job, 6)
+    recorder.close()
+
+    state = journal.read(filename)
+    assert state.jobs[0].processed_op_count == 6
+    assert state.jobs[0].interrupted_batch == (6, 9)
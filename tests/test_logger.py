@@ -0,0 +1,84 @@
+import concurrent.futures
+import gzip
+
+from ueimporter import Logger
+from ueimporter import LogLevel
+
+
+def test_logger_will_not_format_filtered_lines(tmp_path):
+    log_filename = tmp_path.joinpath('logs', 'ueimporter.log')
+    logger = Logger(log_filename, LogLevel.ERROR,
+                    log_file_level=LogLevel.VERBOSE)
+    formatted = []
+
+    def format_line(line):
+        formatted.append(line)
+        return line
+
+    logger.log(lambda: format_line('normal'))
+    logger.indent()
+    logger.log_verbose(lambda: format_line('verbose'))
+    logger.log_debug(lambda: format_line('debug'))
+    logger.deindent()
+    assert not logger.is_enabled(LogLevel.DEBUG)
+    logger.log_debug_lines(['debug'])
+    logger.close()
+
+    assert formatted == ['normal', 'verbose']
+    assert log_filename.read_text() == 'normal\n  verbose\n'
+
+
+def test_logger_will_rotate_and_compress_log_file(tmp_path):
+    log_filename = tmp_path.joinpath('ueimporter.log')
+    logger = Logger(log_filename, LogLevel.ERROR,
+                    log_file_max_size=18, log_file_backup_count=2,
+                    compress_log_files=True)
+    lines = [f'line {i:03}' for i in range(0, 10)]
+    for line in lines:
+        logger.log(line)
+    logger.close()
+
+    # Each file holds two lines, only the two most recent backups are kept
+    assert log_filename.read_text() == ''
+    assert gzip.open(f'{log_filename}.1.gz', 'rt').read() == \
+        'line 008\nline 009\n'
+    assert gzip.open(f'{log_filename}.2.gz', 'rt').read() == \
+        'line 006\nline 007\n'
+    assert not tmp_path.joinpath('ueimporter.log.3.gz').exists()
+
+
+def test_logger_will_keep_captured_lines_in_order(tmp_path):
+    log_filename = tmp_path.joinpath('ueimporter.log')
+    logger = Logger(log_filename, LogLevel.ERROR)
+    with logger.capture() as records:
+        logger.log('captured')
+        logger.log_debug_lines(['a', 'b'])
+    logger.log('first')
+    logger.replay(records)
+    logger.close()
+
+    assert log_filename.read_text() == 'first\ncaptured\na\nb\n'
+
+
+def test_logger_will_indent_replayed_lines_once(tmp_path):
+    log_filename = tmp_path.joinpath('ueimporter.log')
+    logger = Logger(log_filename, LogLevel.ERROR)
+
+    def capture_lines():
+        # Indentation left behind by earlier work of the thread is not kept
+        logger.indent()
+        with logger.capture() as records:
+            logger.log('step')
+            logger.indent()
+            logger.log('file')
+            logger.log_error('error')
+        return records
+
+    with concurrent.futures.ThreadPoolExecutor(1) as executor:
+        records = executor.submit(capture_lines).result()
+    logger.log('stage')
+    logger.indent()
+    logger.replay(records)
+    logger.close()
+
+    assert log_filename.read_text() == 'stage\n  step\n    file\nerror\n'
@@ -0,0 +1,102 @@
+import os
+import shlex
+import sys
+import time
+
+import pytest
+
+import ueimporter
+import ueimporter.plastic as plastic
+from ueimporter import Logger, LogLevel
+
+# A 'cm' that understands just enough of 'cm shell' for the tests. Errors
+# of 'late' are written after its CommandResult line, and commands passed
+# 'die.txt' terminate the shell.
+FAKE_CM = f'''#!{sys.executable}
+import shlex
+import sys
+import time
+
+if sys.argv[1:] != ['shell']:
+    sys.exit(0)
+for line in sys.stdin:
+    arguments = shlex.split(line)
+    if 'die.txt' in arguments:
+        sys.exit(1)
+    returncode = 1 if arguments[0] == 'late' else 0
+    sys.stdout.write(f'CommandResult {{returncode}}\\n')
+    sys.stdout.flush()
+    if returncode:
+        time.sleep(0.002)
+        sys.stderr.write('late failed\\n')
+        sys.stderr.flush()
+'''
+
+
+@pytest.fixture
+def fake_cm(tmp_path, monkeypatch):
+    bin_path = tmp_path.joinpath('bin')
+    bin_path.mkdir()
+    cm_path = bin_path.joinpath('cm')
+    cm_path.write_text(FAKE_CM)
+    cm_path.chmod(0o755)
+    monkeypatch.setenv('PATH', f'{bin_path}{os.pathsep}{os.environ["PATH"]}')
+
+
+def create_logger():
+    return Logger(None, LogLevel.ERROR)
+
+
+def test_quote_shell_argument_will_round_trip_arguments():
+    for argument in ['Engine/File.cpp', 'With Space.txt', 'Quote"d.txt',
+                     'Back\\slash.txt', 'Trailing\\', 'Both \\" .txt', '']:
+        quoted = plastic.quote_shell_argument(argument)
+        assert shlex.split(quoted) == [argument]
+
+
+@pytest.mark.skipif(sys.platform == 'win32', reason='needs a script as cm')
+def test_shell_will_pair_commands_with_their_errors(tmp_path, fake_cm):
+    shell = plastic.Shell(tmp_path)
+    logger = create_logger()
+    assert shell.start(logger)
+    try:
+        # Failing commands are not held up by checks of the shell
+        start_time = time.perf_counter()
+        with pytest.raises(ueimporter.CommandError) as e:
+            shell.run(['late'], logger)
+        assert time.perf_counter() - start_time < 0.5
+        assert e.value.stderr == 'late failed\n'
+        assert shell.run(['status'], logger) == ''
+    finally:
+        shell.close()
+
+
+@pytest.mark.skipif(sys.platform == 'win32', reason='needs a script as cm')
+def test_repo_will_stop_using_a_terminated_shell(tmp_path, fake_cm):
+    repo = plastic.Repo(tmp_path, pretend=False, use_shell=True)
+    logger = create_logger()
+    repo.start_shell(logger)
+    assert repo.input_byte_budget == plastic.Repo.SHELL_ARGUMENT_BYTE_BUDGET
+
+    # Checkouts can be repeated, and are run again without the shell
+    assert repo.run_cmd(['checkout'], logger, ['die.txt']) == ''
+
+    assert not repo.use_shell
+    assert repo.input_byte_budget == plastic.Repo.STDIN_BYTE_BUDGET
+    repo.close()
+
+
+@pytest.mark.skipif(sys.platform == 'win32', reason='needs a script as cm')
+def test_repo_will_not_repeat_moves_of_a_terminated_shell(tmp_path,
+                                                         fake_cm):
+    repo = plastic.Repo(tmp_path, pretend=False, use_shell=True)
+    logger = create_logger()
+    repo.start_shell(logger)
+
+    start_time = time.perf_counter()
+    with pytest.raises(plastic.ShellTerminatedError):
+        repo.move('die.txt', 'moved.txt', logger)
+    assert time.perf_counter() - start_time < 0.5
+
+    assert not repo.use_shell
+    repo.close()
@@ -0,0 +1,92 @@
+from pathlib import PurePosixPath
+
+import ueimporter.fs_index as fs_index
+import ueimporter.git as git
+import ueimporter.job as job
+import ueimporter.path_util as path_util
+import ueimporter.plastic as plastic
+import ueimporter.scheduler as scheduler
+from ueimporter import Logger
+from ueimporter import LogLevel
+
+
+def create_index(filenames):
+    index = fs_index.FileSystemIndex(PurePosixPath('/workspace'))
+    for filename in filenames:
+        index.add_file(PurePosixPath(filename))
+    return index
+
+
+def create_job(job_class, changes, workspace_tree):
+    created_job = job_class(logger=Logger(None, LogLevel.ERROR),
+                            plastic_repo=plastic.Repo(
+                                PurePosixPath('/workspace'), pretend=True),
+                            source_root_path=PurePosixPath('/source'),
+                            pretend=True,
+                            workspace_tree=workspace_tree,
+                            batch_size=1)
+    for change in changes:
+        created_job.add_change(change)
+    return created_job
+
+
+def test_find_removed_region_will_cover_emptied_directories():
+    file_counts = path_util.count_per_ancestor(
+        ['A/B/1.txt', 'A/B/2.txt', 'A/3.txt'])
+    removed_counts = path_util.count_per_ancestor(
+        ['A/B/1.txt', 'A/B/2.txt'])
+    assert scheduler.find_removed_region(
+        'A/B/1.txt', removed_counts, file_counts) == 'A/B'
+
+    removed_counts = path_util.count_per_ancestor(['A/B/1.txt'])
+    assert scheduler.find_removed_region(
+        'A/B/1.txt', removed_counts, file_counts) == 'A/B/1.txt'
+
+
+def test_find_created_region_will_cover_created_directories():
+    workspace_tree = create_index(['A/1.txt'])
+    assert scheduler.find_created_region(
+        'A/B/C/2.txt', workspace_tree) == 'A/B'
+    assert scheduler.find_created_region(
+        'A/2.txt', workspace_tree) == 'A/2.txt'
+
+
+def test_scheduler_will_only_hold_back_overlapping_ops():
+    workspace_tree = create_index(['Gone/1.txt', 'Gone/2.txt', 'Kept/3.txt'])
+    add_job = create_job(job.AddJob,
+                         [git.Add('Gone/4.txt'), git.Add('New/5.txt')],
+                         workspace_tree)
+    delete_job = create_job(job.DeleteJob,
+                            [git.Delete('Kept/3.txt'),
+                             git.Delete('Gone/1.txt'),
+                             git.Delete('Gone/2.txt')],
+                            workspace_tree)
+    job_scheduler = scheduler.JobScheduler([add_job, delete_job],
+                                           workspace_tree, 2)
+
+    # Gone is emptied by the deletes, and must not be removed before
+    # the add puts a new file into it
+    assert job_scheduler.dependent_op_count == 2
+    assert job_scheduler.ready_op_count(add_job, 0, 2) == 2
+    assert job_scheduler.ready_op_count(delete_job, 0, 3) == 1
+
+    add_job.mark_processed(1)
+    assert job_scheduler.ready_op_count(delete_job, 0, 3) == 3
+
+
+def test_scheduler_will_process_all_jobs():
+    workspace_tree = create_index(['A/1.txt', 'B/2.txt', 'C/3.txt'])
+    jobs = [create_job(job.AddJob,
+                       [git.Add(f'A/New{i}.txt') for i in range(0, 5)],
+                       workspace_tree),
+            create_job(job.DeleteJob,
+                       [git.Delete('A/1.txt'), git.Delete('B/2.txt')],
+                       workspace_tree),
+            create_job(job.ModifyJob, [git.Modify('C/3.txt')],
+                       workspace_tree)]
+    job_scheduler = scheduler.JobScheduler(jobs, workspace_tree, 3)
+    job_scheduler.run(job.JobProgressListener())
+
+    assert [j.processed_op_count for j in jobs] == [5, 2, 1]
+    assert workspace_tree.is_dir('A')
+    assert not workspace_tree.is_dir('B')
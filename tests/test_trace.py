@@ -0,0 +1,45 @@
+import json
+import threading
+
+import ueimporter
+import ueimporter.trace as trace
+from ueimporter import Logger
+from ueimporter import LogLevel
+
+
+def test_trace_will_record_spans_of_all_threads(tmp_path):
+    filename = tmp_path.joinpath('trace', 'trace.json')
+    trace.start(filename)
+    try:
+        with trace.span('Phase', 'phase', op_count=2):
+            ueimporter.run(['git', '--version'],
+                           Logger(None, LogLevel.ERROR))
+            thread = threading.Thread(
+                target=lambda: trace.complete('Step', 'step',
+                                              trace.timestamp()),
+                name='worker')
+            thread.start()
+            thread.join()
+    finally:
+        trace.stop()
+
+    events = json.loads(filename.read_text())
+    spans = {e['name']: e for e in events if e['ph'] == 'X'}
+    assert set(spans.keys()) == {'Phase', 'git --version', 'Step'}
+    assert spans['Phase']['args'] == {'op_count': 2}
+    assert spans['git --version']['args'] == \
+        {'command': 'git --version', 'path_count': 0}
+    # Spans nest within each other on a thread
+    assert spans['Phase']['ts'] <= spans['git --version']['ts']
+    assert spans['Phase']['dur'] >= spans['git --version']['dur']
+    assert spans['Step']['tid'] != spans['Phase']['tid']
+    thread_names = [e['args']['name'] for e in events if e['ph'] == 'M']
+    assert 'worker' in thread_names
+
+
+def test_trace_is_a_no_op_unless_started():
+    with trace.span('Phase', 'phase'):
+        pass
+    assert trace.timestamp() is None
+    trace.complete('Step', 'step', trace.timestamp())
+    assert trace.command_args(['cm', 'add']) == {}
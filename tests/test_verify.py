@@ -0,0 +1,85 @@
+import os
+
+import pytest
+
+import ueimporter.plastic as plastic
+import ueimporter.verify as verify
+from ueimporter import Logger
+from ueimporter import LogLevel
+
+
+def write_files(root, files):
+    for (filename, (content, mode)) in files.items():
+        path = root.joinpath(filename)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(content)
+        os.chmod(path, mode)
+
+
+def test_ignore_rules():
+    rules = plastic.IgnoreRules([
+        '# Comment',
+        '/Engine/Binaries',
+        'Intermediate/',
+        '*.pdb',
+        '!/Engine/Binaries/ThirdParty',
+    ])
+    assert rules.is_ignored('Engine/Binaries/Win64/UE4.dll', is_dir=False)
+    assert not rules.is_ignored('Engine/Binaries/ThirdParty/a.dll',
+                                is_dir=False)
+    assert rules.is_ignored('Engine/Plugins/A/Intermediate/a.obj',
+                            is_dir=False)
+    # Directory rules do not match files
+    assert not rules.is_ignored('Engine/Source/Intermediate', is_dir=False)
+    assert rules.is_ignored('Engine/Source/a.pdb', is_dir=False)
+    assert not rules.is_ignored('Engine/Source/a.cpp', is_dir=False)
+    assert not rules.is_ignored('Binaries/a.dll', is_dir=False)
+
+
+@pytest.mark.parametrize('worker_count', [1, 2])
+def test_verify_will_report_differences(tmp_path, worker_count):
+    source_root = tmp_path.joinpath('release')
+    workspace_root = tmp_path.joinpath('workspace')
+    write_files(source_root, {
+        'Engine/Same.cpp': ('same', 0o644),
+        'Engine/Content.cpp': ('release', 0o644),
+        'Engine/Size.cpp': ('release', 0o644),
+        'Engine/Setup.sh': ('#!/bin/sh', 0o755),
+        'Engine/Missing.cpp': ('missing', 0o644),
+    })
+    write_files(workspace_root, {
+        'Engine/Same.cpp': ('same', 0o644),
+        'Engine/Content.cpp': ('changed', 0o644),
+        'Engine/Size.cpp': ('longer content', 0o644),
+        'Engine/Setup.sh': ('#!/bin/sh', 0o644),
+        'Engine/Extra.cpp': ('extra', 0o644),
+        'Engine/Intermediate/Ignored.obj': ('ignored', 0o644),
+        '.plastic/plastic.workspace': ('workspace', 0o644),
+        'ignore.conf': ('Intermediate/\nignore.conf\n', 0o644),
+    })
+
+    result = verify.verify(source_root, workspace_root, worker_count,
+                           Logger(None, LogLevel.ERROR))
+    assert not result.is_identical
+    assert result.missing == ['Engine/Missing.cpp']
+    assert result.extra == ['Engine/Extra.cpp']
+    assert result.content_mismatches == ['Engine/Content.cpp',
+                                         'Engine/Size.cpp']
+    if os.name != 'nt':
+        assert result.mode_mismatches == ['Engine/Setup.sh']
+    assert result.compared_count == 4
+
+
+def test_verify_will_accept_identical_trees(tmp_path):
+    files = {
+        'Engine/Build/Build.version': ('{}', 0o644),
+        'Engine/Setup.sh': ('#!/bin/sh', 0o755),
+    }
+    write_files(tmp_path.joinpath('release'), files)
+    write_files(tmp_path.joinpath('workspace'), files)
+
+    result = verify.verify(tmp_path.joinpath('release'),
+                           tmp_path.joinpath('workspace'), 2,
+                           Logger(None, LogLevel.ERROR))
+    assert result.is_identical
+    assert result.compared_count == 2
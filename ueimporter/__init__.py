@@ -1,7 +1,15 @@
+import atexit
+import contextlib
+import gzip
 import os
+import queue
+import shutil
 import sys
 import subprocess
 import enum
+import threading
+
+from ueimporter import trace
 
 
 class OrderedEnum(enum.Enum):
@@ -54,15 +62,97 @@ class LogLevel(OrderedEnum):
             raise ValueError()
 
 
+class LogFile:
+    """Log file that is rotated once it grows beyond max_size characters.
+    Rotated files are named <filename>.1 for the most recent one, up to
+    <filename>.<backup_count>, and are gzip compressed if compress is set.
+    A max_size of 0 lets the file grow forever."""
+
+    def __init__(self, filename, max_size=0, backup_count=5,
+                 compress=False):
+        self.filename = filename
+        self.max_size = max_size
+        self.backup_count = backup_count
+        self.compress = compress
+        if not filename.parent.is_dir():
+            os.makedirs(filename.parent)
+        self._file = open(filename, 'w', encoding='utf-8')
+        self._size = 0
+
+    def write(self, text):
+        self._file.write(text)
+        self._size += len(text)
+        if self.max_size and self._size >= self.max_size:
+            self._rotate()
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+    def get_backup_filename(self, index):
+        suffix = '.gz' if self.compress else ''
+        return self.filename.with_name(
+            f'{self.filename.name}.{index}{suffix}')
+
+    def _rotate(self):
+        self._file.close()
+        if self.backup_count > 0:
+            for index in range(self.backup_count - 1, 0, -1):
+                backup_filename = self.get_backup_filename(index)
+                if backup_filename.is_file():
+                    os.replace(backup_filename,
+                               self.get_backup_filename(index + 1))
+            if self.compress:
+                with open(self.filename, 'rb') as f, \
+                        gzip.open(self.get_backup_filename(1), 'wb') as gz:
+                    shutil.copyfileobj(f, gz)
+            else:
+                os.replace(self.filename, self.get_backup_filename(1))
+        self._file = open(self.filename, 'w', encoding='utf-8')
+        self._size = 0
+
+
 class Logger:
+    """Writes log lines to STDOUT and an optional log file.
+
+    Lines are handed over to a background thread that does the actual
+    writing, through a bounded queue, so that slow terminals and discs do
+    not hold back the threads doing the work. Lines below the levels of
+    both STDOUT and the log file are dropped before they are formatted,
+    and callers may pass a function returning the line, to not even build
+    it unless it is logged. Call close() to make sure all lines have been
+    written."""
     INDENTATION = ' ' * 2
+    # Max number of lines waiting to be written, before logging blocks
+    QUEUE_SIZE = 10000
+    # Max number of lines written in one go
+    WRITE_BATCH_SIZE = 1000
 
-    def __init__(self, log_filename, log_level):
-        self.indentation = ''
-        if log_filename and not log_filename.parent.is_dir():
-            os.makedirs(log_filename.parent)
-        self._logfile = open(log_filename, 'w') if log_filename else None
+    def __init__(self, log_filename, log_level, log_file_level=None,
+                 log_file_max_size=0, log_file_backup_count=5,
+                 compress_log_files=False):
+        # Indentation and captures are per thread, so that threads working
+        # on different stages of a job do not mess up each others output
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._logfile = LogFile(log_filename, log_file_max_size,
+                                log_file_backup_count,
+                                compress_log_files) \
+            if log_filename else None
         self._log_level = log_level
+        # All levels end up in the log file by default
+        self._log_file_level = log_file_level \
+            if log_file_level is not None else LogLevel.DEBUG
+        self._max_log_level = max(self._log_level, self._log_file_level) \
+            if self._logfile else self._log_level
+        self._queue = queue.Queue(Logger.QUEUE_SIZE)
+        self._writer_thread = None
+
+    def is_enabled(self, log_level):
+        """Returns True if lines of log_level end up anywhere"""
+        return log_level <= self._max_log_level
 
     def log(self, line, new_line=True):
         self.print(LogLevel.NORMAL, line, new_line)
@@ -73,12 +163,53 @@ class Logger:
     def log_debug(self, line, new_line=True):
         self.print(LogLevel.DEBUG, line, new_line)
 
+    def log_debug_lines(self, lines):
+        self.print_lines(LogLevel.DEBUG, lines)
+
     def log_warning(self, line, new_line=True):
         self.print(LogLevel.WARNING, line, new_line)
 
     def log_error(self, line, new_line=True):
         self.print(LogLevel.ERROR, line, new_line)
 
+    @property
+    def indentation(self):
+        return getattr(self._local, 'indentation', '')
+
+    @indentation.setter
+    def indentation(self, value):
+        self._local.indentation = value
+
+    def start_capture(self):
+        """Collects all lines logged by the calling thread from now on,
+        instead of writing them. Returns the list lines are collected in,
+        they can be written later with replay()."""
+        records = []
+        if not hasattr(self._local, 'captures'):
+            self._local.captures = []
+        # Lines keep the indentation added after the capture started, they
+        # are indented by the replaying thread when written
+        self._local.captures.append((records, self.indentation))
+        return records
+
+    def stop_capture(self):
+        (records, _) = self._local.captures.pop()
+        return records
+
+    @contextlib.contextmanager
+    def capture(self):
+        records = self.start_capture()
+        try:
+            yield records
+        finally:
+            self.stop_capture()
+
+    def replay(self, records):
+        for (log_level, indentation, line, new_line) in records:
+            self._put(log_level, self._format(
+                log_level, f'{self.indentation}{indentation}', line,
+                new_line))
+
     def indent(self):
         self.indentation += Logger.INDENTATION
 
@@ -87,29 +218,185 @@ class Logger:
             self.indentation = self.indentation[:-len(Logger.INDENTATION)]
 
     def print(self, log_level, line, new_line):
-        indentation = self.indentation \
-            if log_level > LogLevel.ERROR and line \
-            else ''
+        if log_level > self._max_log_level:
+            return
+        if callable(line):
+            line = line()
+        captures = getattr(self._local, 'captures', None)
+        if captures:
+            (records, capture_indentation) = captures[-1]
+            records.append((log_level,
+                            self.indentation[len(capture_indentation):],
+                            line, new_line))
+            return
+
+        self._put(log_level,
+                  self._format(log_level, self.indentation, line, new_line))
+
+    def print_lines(self, log_level, lines):
+        """Logs each of lines, as a single write"""
+        if log_level > self._max_log_level:
+            return
+        indentation = self.indentation
+        if getattr(self._local, 'captures', None):
+            for line in lines:
+                self.print(log_level, line, True)
+            return
+        self._put(log_level, ''.join([f'{indentation}{line}\n'
+                                      for line in lines]))
+
+    def _format(self, log_level, indentation, line, new_line):
+        # Errors are never indented
+        if log_level <= LogLevel.ERROR or not line:
+            indentation = ''
         log_line = f'{indentation}{line}'
         if new_line:
             log_line += '\n'
-        if log_level <= self._log_level:
-            stream = sys.stderr if log_level == LogLevel.ERROR else sys.stdout
-            stream.write(log_line)
+        return log_line
+
+    def flush(self):
+        """Blocks until all lines logged so far have been written"""
+        if self._writer_thread:
+            self._queue.join()
+
+    def close(self):
+        with self._lock:
+            writer_thread = self._writer_thread
+            self._writer_thread = None
+        if writer_thread:
+            self._queue.put(None)
+            writer_thread.join()
         if self._logfile:
-            self._logfile.write(log_line)
+            self._logfile.close()
+            self._logfile = None
+
+    def _put(self, log_level, text):
+        if not self._writer_thread:
+            self._start_writer()
+        self._queue.put((log_level, text))
+
+    def _start_writer(self):
+        with self._lock:
+            if self._writer_thread:
+                return
+            self._writer_thread = threading.Thread(
+                target=self._write_lines, name='ueimporter-log',
+                daemon=True)
+            self._writer_thread.start()
+        # Write what is left, should the owner never call close()
+        atexit.register(self.close)
+
+    def _write_lines(self):
+        while True:
+            records = [self._queue.get()]
+            while len(records) < Logger.WRITE_BATCH_SIZE:
+                try:
+                    records.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            is_closing = False
+            for record in records:
+                if record is None:
+                    is_closing = True
+                    continue
+                (log_level, text) = record
+                if log_level <= self._log_level:
+                    stream = sys.stderr \
+                        if log_level == LogLevel.ERROR \
+                        else sys.stdout
+                    stream.write(text)
+                if self._logfile and log_level <= self._log_file_level:
+                    self._logfile.write(text)
+            sys.stdout.flush()
+            sys.stderr.flush()
+            if self._logfile:
+                self._logfile.flush()
+            for _ in records:
+                self._queue.task_done()
+            if is_closing:
+                return
+
+
+class CommandError(Exception):
+    def __init__(self, command, returncode, stderr):
+        self.command = command
+        self.returncode = returncode
+        self.stderr = stderr
+
+    def __str__(self):
+        return f'{" ".join([str(s) for s in self.command])}' \
+            f' failed with returncode {self.returncode}'
+
+
+def get_child_process_kwargs():
+    # Run child processes in their own process group, so that pressing
+    # Ctrl-C only interrupts ueimporter, which can then let the current
+    # batch of commands finish before exiting
+    if os.name == 'nt':
+        return {'creationflags': subprocess.CREATE_NEW_PROCESS_GROUP}
+    return {'start_new_session': True}
 
 
 def run(command, logger, input_lines=None, cwd=None):
     input = ('\n'.join(input_lines) + '\n') if input_lines else None
-    res = subprocess.run(command,
-                         capture_output=True,
-                         input=input,
-                         encoding='utf-8', cwd=cwd)
+    with trace.span(trace.command_name(command), 'subprocess',
+                    **trace.command_args(command, len(input_lines or []))):
+        res = subprocess.run(command,
+                             capture_output=True,
+                             input=input,
+                             encoding='utf-8', cwd=cwd,
+                             **get_child_process_kwargs())
 
     if res.returncode != 0 or res.stderr:
         logger.log_error(f'Error: returncode {res.returncode}')
         logger.log_error(res.stderr)
-        sys.exit(res.returncode)
+        raise CommandError(command, res.returncode, res.stderr)
 
     return res.stdout
+
+
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+def run_streamed(command, logger, cwd=None):
+    """Runs command and yields its STDOUT as chunks of bytes as soon as
+    they are produced, instead of waiting for the process to finish"""
+    # Spans the whole life time of the process, including the time spent
+    # by the caller on each chunk
+    with trace.span(trace.command_name(command), 'subprocess',
+                    **trace.command_args(command)):
+        yield from _run_streamed(command, logger, cwd)
+
+
+def _run_streamed(command, logger, cwd):
+    process = subprocess.Popen(command,
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE,
+                               cwd=cwd,
+                               **get_child_process_kwargs())
+
+    # Drain STDERR on a separate thread, a full STDERR pipe would otherwise
+    # block the process while we are waiting for STDOUT
+    stderr_chunks = []
+    stderr_thread = threading.Thread(
+        target=lambda: stderr_chunks.append(process.stderr.read()),
+        daemon=True)
+    stderr_thread.start()
+
+    try:
+        while True:
+            chunk = process.stdout.read(STREAM_CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        process.stdout.close()
+        returncode = process.wait()
+        stderr_thread.join()
+
+    stderr = b''.join(stderr_chunks).decode('utf-8', errors='replace')
+    if returncode != 0 or stderr:
+        logger.log_error(f'Error: returncode {returncode}')
+        logger.log_error(stderr)
+        raise CommandError(command, returncode, stderr)
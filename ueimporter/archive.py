@@ -0,0 +1,169 @@
+import datetime
+import os
+import shutil
+import stat
+import tarfile
+import zipfile
+
+from pathlib import PurePosixPath
+
+import ueimporter.fs_index as fs_index
+
+# Suffixes of the archives a release package can be read from, in order of
+# preference
+ARCHIVE_SUFFIXES = ['.zip', '.tar.gz', '.tgz', '.tar.bz2', '.tar.xz', '.tar']
+COPY_BUFFER_SIZE = 1024 * 1024
+DEFAULT_FILE_MODE = 0o644
+
+
+class ArchiveError(Exception):
+    def __init__(self, message):
+        self._message = message
+
+    def __str__(self):
+        return self._message
+
+
+def find_archive(directory, name):
+    for suffix in ARCHIVE_SUFFIXES:
+        filename = directory.joinpath(f'{name}{suffix}')
+        if filename.is_file():
+            return filename
+    return None
+
+
+def is_zip_archive(filename):
+    return filename.name.lower().endswith('.zip')
+
+
+class ArchiveSource:
+    """Release package read straight from a .zip or tar archive.
+
+    The archive is indexed once, and the index answers the same existence
+    queries as a FileSystemIndex of an extracted package. Only the files
+    that ops actually copy are extracted, into a staging directory that
+    then serves as the source root path of jobs. Tar archives can not be
+    read out of order, so indexing and extraction happen in a single pass.
+
+    Members below a top level directory named prefix, as in the archives
+    of a release, are treated as if they were in the root."""
+
+    def __init__(self, filename, staging_root, prefix=None):
+        self.filename = filename
+        self.staging_root = staging_root
+        self.prefix = prefix
+        self.tree = fs_index.FileSystemIndex(filename)
+        self.extracted_count = 0
+        self.extracted_byte_count = 0
+
+    @property
+    def desc(self):
+        return str(self.filename)
+
+    def extract(self, filenames, copier, logger):
+        """Indexes the archive and extracts filenames, which are paths
+        relative to the release root, into the staging directory. Names
+        not in the archive are ignored, validation reports them later."""
+        wanted_names = set([str(f) for f in filenames])
+        os.makedirs(self.staging_root, exist_ok=True)
+        try:
+            if is_zip_archive(self.filename):
+                self._extract_zip(wanted_names, copier, logger)
+            else:
+                self._extract_tar(wanted_names, logger)
+        except (OSError, tarfile.TarError, zipfile.BadZipFile) as e:
+            raise ArchiveError(f'Failed to read {self.filename}: {e}')
+
+    def close(self):
+        shutil.rmtree(self.staging_root, ignore_errors=True)
+
+    def to_relative_name(self, member_name):
+        # Returns the path of a member relative to the release root, or
+        # None for members that would end up outside of it
+        name = member_name.replace('\\', '/').rstrip('/')
+        while name.startswith('./'):
+            name = name[2:]
+        if self.prefix:
+            if name == self.prefix:
+                return ''
+            if name.startswith(f'{self.prefix}/'):
+                name = name[len(self.prefix) + 1:]
+        parts = name.split('/')
+        if not name or name.startswith('/') or '..' in parts or \
+                ':' in parts[0]:
+            return None
+        return name
+
+    def _extract_zip(self, wanted_names, copier, logger):
+        with zipfile.ZipFile(self.filename) as archive:
+            infos_to_extract = []
+            for info in archive.infolist():
+                name = self.to_relative_name(info.filename)
+                if not name:
+                    continue
+                if info.is_dir():
+                    self.tree.add_dir(PurePosixPath(name))
+                    continue
+                self.tree.add_file(PurePosixPath(name))
+                if name in wanted_names:
+                    infos_to_extract.append((name, info))
+
+            def extract_member(name_info_pair):
+                (name, info) = name_info_pair
+                with archive.open(info) as member_file:
+                    self._write_staged_file(name, member_file,
+                                            get_zip_mode(info),
+                                            get_zip_mtime(info))
+                return info.file_size
+
+            # Members of zip archives can be read in any order, and on
+            # several threads at once
+            for size in copier.map(extract_member, infos_to_extract):
+                self.extracted_count += 1
+                self.extracted_byte_count += size
+
+    def _extract_tar(self, wanted_names, logger):
+        # Stream mode, as compressed tar archives can not be read out of
+        # order without decompressing them over and over
+        with tarfile.open(self.filename, mode='r|*') as archive:
+            for member in archive:
+                name = self.to_relative_name(member.name)
+                if not name:
+                    continue
+                if member.isdir():
+                    self.tree.add_dir(PurePosixPath(name))
+                    continue
+                if not member.isfile():
+                    logger.log_verbose(f'Skipping {member.name} in'
+                                       f' {self.filename}, it is not a'
+                                       f' regular file')
+                    continue
+                self.tree.add_file(PurePosixPath(name))
+                if name not in wanted_names:
+                    continue
+                member_file = archive.extractfile(member)
+                with member_file:
+                    self._write_staged_file(name, member_file,
+                                            stat.S_IMODE(member.mode),
+                                            member.mtime)
+                self.extracted_count += 1
+                self.extracted_byte_count += member.size
+
+    def _write_staged_file(self, name, member_file, mode, mtime):
+        filename = self.staging_root.joinpath(name)
+        os.makedirs(filename.parent, exist_ok=True)
+        with open(filename, 'wb') as f:
+            shutil.copyfileobj(member_file, f, COPY_BUFFER_SIZE)
+        os.chmod(filename, mode)
+        os.utime(filename, (mtime, mtime))
+
+
+def get_zip_mode(info):
+    # Archives created on unix store the file mode in the upper bits of
+    # the external attributes
+    mode = stat.S_IMODE(info.external_attr >> 16)
+    return mode if mode else DEFAULT_FILE_MODE
+
+
+def get_zip_mtime(info):
+    return datetime.datetime(*info.date_time).timestamp()
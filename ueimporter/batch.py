@@ -0,0 +1,168 @@
+import collections
+import math
+
+
+class BatchSizeLimits:
+    def __init__(self, min_size, initial_size, max_size):
+        assert 1 <= min_size <= initial_size <= max_size
+        self.min_size = min_size
+        self.initial_size = initial_size
+        self.max_size = max_size
+
+
+class AdaptiveBatcher:
+    """Picks the number of ops to process in each batch of a job.
+
+    Every batch pays a fixed cost per cm invocation, on top of a cost per
+    path. Batch times are fitted to the line
+        elapsed = call_latency + path_latency * op_count
+    and batches are sized so that the fixed cost is a small fraction of
+    the batch time. Sizes grow at most by GROWTH_FACTOR per batch, and
+    only while throughput keeps improving. After a failure the size is
+    halved, and is not allowed to grow past the failing size again until
+    a few batches have succeeded."""
+
+    GROWTH_FACTOR = 2.0
+    TARGET_CALL_OVERHEAD = 0.05
+    SAMPLE_COUNT = 8
+    THROUGHPUT_TOLERANCE = 0.9
+    MAX_CONSECUTIVE_FAILURES = 3
+    SUCCESSES_TO_RAISE_CEILING = 4
+
+    def __init__(self, limits, input_byte_budget=None, adaptive=True):
+        self.limits = limits
+        self.input_byte_budget = input_byte_budget
+        self.adaptive = adaptive
+        self._size = limits.initial_size
+        self._ceiling = limits.max_size
+        self._samples = collections.deque(
+            maxlen=AdaptiveBatcher.SAMPLE_COUNT)
+        self._best_throughput = 0.0
+        self._consecutive_failures = 0
+        self._successes_since_failure = 0
+
+        self.batch_sizes = []
+        self.failure_count = 0
+        self.processed_op_count = 0
+        self.elapsed_time = 0.0
+
+    @classmethod
+    def fixed(cls, size, input_byte_budget=None):
+        return AdaptiveBatcher(BatchSizeLimits(size, size, size),
+                               input_byte_budget=input_byte_budget,
+                               adaptive=False)
+
+    @property
+    def size(self):
+        return self._size
+
+    @property
+    def ops_per_second(self):
+        if self.elapsed_time <= 0:
+            return 0.0
+        return self.processed_op_count / self.elapsed_time
+
+    def next_batch_size(self, ops):
+        """Returns the number of leading ops to process in the next batch.
+        ops is a sequence of the remaining ops, each with an input_size
+        estimating how many bytes it adds to the cm input."""
+        size = min(self._size, len(ops))
+        if self.input_byte_budget and size > 1:
+            byte_count = 0
+            for i in range(0, size):
+                byte_count += ops[i].input_size
+                if byte_count > self.input_byte_budget:
+                    size = max(1, i)
+                    break
+        return size
+
+    def record_batch(self, op_count, elapsed_time):
+        self.batch_sizes.append(op_count)
+        self.processed_op_count += op_count
+        self.elapsed_time += elapsed_time
+        self._consecutive_failures = 0
+        self._successes_since_failure += 1
+        if self._successes_since_failure >= \
+                AdaptiveBatcher.SUCCESSES_TO_RAISE_CEILING:
+            self._ceiling = self.limits.max_size
+
+        if not self.adaptive or op_count <= 0:
+            return
+
+        self._samples.append((op_count, max(elapsed_time, 1e-6)))
+        throughput = op_count / max(elapsed_time, 1e-6)
+
+        # Batches smaller than the current size, typically the tail of a
+        # job, tell us nothing about whether larger batches would help
+        if op_count < self._size:
+            return
+
+        if throughput < self._best_throughput * \
+                AdaptiveBatcher.THROUGHPUT_TOLERANCE:
+            # Larger batches made things worse, step back
+            self._size = self._clamp(
+                self._size / AdaptiveBatcher.GROWTH_FACTOR)
+            self._best_throughput = throughput
+            return
+
+        self._best_throughput = max(self._best_throughput, throughput)
+        target_size = self._estimate_target_size()
+        max_size = self._size * AdaptiveBatcher.GROWTH_FACTOR
+        self._size = self._clamp(min(target_size, max_size))
+
+    def record_failure(self):
+        """Shrinks batches after a failed batch. Returns False once batches
+        have failed too many times in a row to keep retrying."""
+        self.failure_count += 1
+        self._consecutive_failures += 1
+        self._successes_since_failure = 0
+        self._ceiling = max(self.limits.min_size, self._size // 2)
+        self._size = self._clamp(self._size / 2)
+        self._best_throughput = 0.0
+        return self._consecutive_failures < \
+            AdaptiveBatcher.MAX_CONSECUTIVE_FAILURES
+
+    def _estimate_target_size(self):
+        (call_latency, path_latency) = self._fit_latency()
+        if call_latency is None:
+            # Not enough data for a fit yet, keep growing
+            return math.inf
+        if path_latency <= 0:
+            # Time does not depend on batch size, bigger is better
+            return math.inf
+        overhead = AdaptiveBatcher.TARGET_CALL_OVERHEAD
+        return call_latency * (1 - overhead) / (overhead * path_latency)
+
+    def _fit_latency(self):
+        # Least squares fit of elapsed = call_latency + path_latency * n
+        if len(self._samples) < 2:
+            return (None, None)
+        sample_count = len(self._samples)
+        mean_n = sum(n for (n, _) in self._samples) / sample_count
+        mean_t = sum(t for (_, t) in self._samples) / sample_count
+        variance = sum((n - mean_n) ** 2 for (n, _) in self._samples)
+        if variance == 0:
+            return (None, None)
+        covariance = sum((n - mean_n) * (t - mean_t)
+                         for (n, t) in self._samples)
+        path_latency = covariance / variance
+        call_latency = max(0.0, mean_t - path_latency * mean_n)
+        return (call_latency, path_latency)
+
+    def _clamp(self, size):
+        if size == math.inf:
+            size = self.limits.max_size
+        size = min(int(size), self._ceiling, self.limits.max_size)
+        return max(size, self.limits.min_size)
+
+    def __str__(self):
+        if not self.batch_sizes:
+            return 'No batches processed'
+        average_size = sum(self.batch_sizes) / len(self.batch_sizes)
+        desc = f'{len(self.batch_sizes)} batches' \
+            f' of {min(self.batch_sizes)}-{max(self.batch_sizes)} ops' \
+            f' (avg {average_size:.0f})' \
+            f', {self.ops_per_second:.1f} ops/sec'
+        if self.failure_count:
+            desc += f', {self.failure_count} failed batches'
+        return desc
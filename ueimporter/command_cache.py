@@ -0,0 +1,266 @@
+import gzip
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+
+from ueimporter import STREAM_CHUNK_SIZE
+
+if os.name == 'nt':
+    import msvcrt
+
+    def lock_file(f):
+        f.seek(0)
+        while True:
+            try:
+                # Retries for 10 seconds before raising
+                msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                return
+            except OSError:
+                pass
+
+    def unlock_file(f):
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+else:
+    import fcntl
+
+    def lock_file(f):
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+
+    def unlock_file(f):
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+class FileLock:
+    """Exclusive lock, held by at most one process at a time. Used as a
+    context manager, which blocks until the lock is acquired."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._file = None
+        self._thread_lock = threading.Lock()
+
+    def __enter__(self):
+        self._thread_lock.acquire()
+        try:
+            self._file = open(self.filename, 'a+b')
+            lock_file(self._file)
+        except BaseException:
+            if self._file:
+                self._file.close()
+                self._file = None
+            self._thread_lock.release()
+            raise
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            unlock_file(self._file)
+        finally:
+            self._file.close()
+            self._file = None
+            self._thread_lock.release()
+
+
+class CorruptEntryError(Exception):
+    """Raised while reading an entry that turns out to be corrupt. The
+    entry has been removed, run the command instead."""
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def __str__(self):
+        return f'Corrupt command cache entry {self.filename}'
+
+
+class CommandCacheStats:
+    def __init__(self):
+        self.hit_count = 0
+        self.miss_count = 0
+        self.write_count = 0
+        self.evicted_count = 0
+        self.evicted_byte_count = 0
+
+    def __str__(self):
+        desc = f'{self.hit_count} hits, {self.miss_count} misses' \
+            f', {self.write_count} writes'
+        if self.evicted_count:
+            desc += f', {self.evicted_count} entries' \
+                f' ({self.evicted_byte_count} bytes) evicted'
+        return desc
+
+
+class CommandCache:
+    """Stores the stdout of commands on disc, keyed on the command line.
+
+    The cache directory may be shared between several concurrent imports.
+    Entries are named by a hash of the command, compressed, and written
+    to a temporary file that is renamed into place once complete, so that
+    readers never see a partial entry. Once the cache grows beyond
+    max_size bytes, the least recently used entries are evicted."""
+
+    # Bump to invalidate existing entries when the format changes
+    VERSION = 2
+    ENTRY_SUFFIX = '.gz'
+    TEMP_SUFFIX = '.tmp'
+    # Entries written by versions that stored plain text
+    LEGACY_ENTRY_SUFFIX = '.stdout'
+    LOCK_FILENAME = '.lock'
+    DEFAULT_MAX_SIZE = 1024 * 1024 * 1024
+    COMPRESS_LEVEL = 6
+    # Temporary files older than this are left behind by crashed imports
+    STALE_TEMP_AGE = 24 * 60 * 60
+
+    def __init__(self, command_cache_dir, max_size=DEFAULT_MAX_SIZE):
+        self._command_cache_dir = command_cache_dir
+        self.max_size = max_size
+        self.stats = CommandCacheStats()
+        if not command_cache_dir.is_dir():
+            os.makedirs(command_cache_dir, exist_ok=True)
+        self._lock = FileLock(
+            command_cache_dir.joinpath(CommandCache.LOCK_FILENAME))
+
+    def has_entry(self, command):
+        filename = self.get_entry_filename(command)
+        return filename.is_file()
+
+    def read_entry(self, command):
+        chunks = self.read_entry_chunks(command)
+        if chunks is None:
+            return None
+        try:
+            stdout = b''.join(chunks)
+        except CorruptEntryError:
+            return None
+        try:
+            return stdout.decode('utf-8')
+        except UnicodeDecodeError:
+            self._remove_corrupt_entry(command)
+            return None
+
+    def write_entry(self, command, stdout):
+        for _ in self.write_entry_chunks(command, [stdout.encode('utf-8')]):
+            pass
+
+    def read_entry_chunks(self, command, chunk_size=STREAM_CHUNK_SIZE):
+        """Returns the uncompressed entry of command as an iterator over
+        chunks of bytes, or None if there is no such entry. The iterator
+        raises CorruptEntryError if the entry can not be decompressed."""
+        filename = self.get_entry_filename(command)
+        # Open the entry right away, so that it can not be evicted in
+        # between checking for it and reading it
+        try:
+            f = gzip.open(filename, 'rb')
+        except FileNotFoundError:
+            self.stats.miss_count += 1
+            return None
+        self.stats.hit_count += 1
+        try:
+            # Mark the entry as recently used
+            os.utime(filename)
+        except OSError:
+            pass
+
+        def read_chunks():
+            try:
+                with f:
+                    while True:
+                        chunk = f.read(chunk_size)
+                        if not chunk:
+                            break
+                        yield chunk
+            except (OSError, EOFError):
+                # Truncated or otherwise damaged, for instance by a full
+                # disc. Only noticed once the entry has been read this far.
+                self._remove_corrupt_entry(command)
+                raise CorruptEntryError(filename)
+
+        return read_chunks()
+
+    def _remove_corrupt_entry(self, command):
+        # Treat a corrupt entry as missing, it is replaced once the
+        # command has run
+        self.stats.hit_count -= 1
+        self.stats.miss_count += 1
+        with self._lock:
+            remove_file(self.get_entry_filename(command))
+
+    def write_entry_chunks(self, command, chunks):
+        # Passes chunks through while writing them to the cache. The entry
+        # is written to a temporary file that is only renamed into place
+        # once all chunks have been consumed, so that an interrupted
+        # command never leaves a truncated entry behind
+        filename = self.get_entry_filename(command)
+        temp_filename = filename.with_name(
+            f'{filename.name}.{os.getpid()}-{uuid.uuid4().hex}'
+            f'{CommandCache.TEMP_SUFFIX}')
+        try:
+            with gzip.open(temp_filename, 'wb',
+                           compresslevel=CommandCache.COMPRESS_LEVEL) as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                    yield chunk
+            with self._lock:
+                os.replace(temp_filename, filename)
+                self.stats.write_count += 1
+                self._evict(keep_filename=filename)
+        except BaseException:
+            try:
+                os.remove(temp_filename)
+            except OSError:
+                pass
+            raise
+
+    def get_entry_filename(self, command):
+        key = json.dumps([CommandCache.VERSION] + [str(c) for c in command])
+        entry_name = hashlib.sha256(key.encode('utf-8')).hexdigest()
+        return self._command_cache_dir.joinpath(
+            f'{entry_name}{CommandCache.ENTRY_SUFFIX}')
+
+    def evict(self):
+        with self._lock:
+            self._evict()
+
+    def _evict(self, keep_filename=None):
+        # Must be called with the lock held
+        entries = []
+        total_size = 0
+        now = time.time()
+        with os.scandir(self._command_cache_dir) as it:
+            for entry in it:
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                if entry.name.endswith(CommandCache.TEMP_SUFFIX):
+                    if now - stat.st_mtime > CommandCache.STALE_TEMP_AGE:
+                        remove_file(entry.path)
+                elif entry.name.endswith(CommandCache.LEGACY_ENTRY_SUFFIX):
+                    remove_file(entry.path)
+                elif entry.name.endswith(CommandCache.ENTRY_SUFFIX):
+                    entries.append((stat.st_mtime, entry.path, stat.st_size))
+                    total_size += stat.st_size
+
+        # Least recently used first
+        entries.sort()
+        for (_, path, size) in entries:
+            if total_size <= self.max_size:
+                break
+            if path == str(keep_filename):
+                continue
+            if remove_file(path):
+                total_size -= size
+                self.stats.evicted_count += 1
+                self.stats.evicted_byte_count += size
+
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        # Most likely open by a reader on Windows, try again later
+        return False
+    return True
@@ -0,0 +1,137 @@
+import concurrent.futures
+import os
+import shutil
+import stat
+
+
+def default_worker_count():
+    return min(8, os.cpu_count() or 1)
+
+
+class CopyError:
+    def __init__(self, source_filename, target_filename, error):
+        self.source_filename = source_filename
+        self.target_filename = target_filename
+        self.error = error
+
+    def __str__(self):
+        return f'Failed to copy {self.source_filename}' \
+            f' to {self.target_filename}: {self.error}'
+
+
+class CopyEngine:
+    # Copies files on a bounded pool of worker threads. Copying is mostly
+    # waiting on disc IO, during which the GIL is released, so threads are
+    # enough to keep several requests in flight at once.
+    MAX_PENDING_PER_WORKER = 4
+
+    def __init__(self, worker_count=1):
+        assert worker_count >= 1
+        self.worker_count = worker_count
+        self._executor = None
+
+    def close(self):
+        if self._executor:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def _get_executor(self):
+        if not self._executor:
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.worker_count,
+                thread_name_prefix='ueimporter-copy')
+        return self._executor
+
+    def map(self, fn, items):
+        """Applies fn to all items on the worker threads, returning the
+        results in the same order as items"""
+        if self.worker_count == 1:
+            return [fn(item) for item in items]
+        return list(self._get_executor().map(fn, items))
+
+    def copy_files(self, source_target_pairs):
+        """Copies (source, target) pairs, including file permissions and
+        timestamps, like shutil.copy2. Returns a list of CopyError for the
+        files that failed, instead of stopping at the first failure."""
+        if self.worker_count == 1:
+            errors = [copy_file(source, target)
+                      for (source, target) in source_target_pairs]
+            return [e for e in errors if e]
+
+        executor = self._get_executor()
+
+        # Limit the number of queued copies, so that huge copy lists
+        # do not turn into an equally huge list of pending futures
+        max_pending = self.worker_count * CopyEngine.MAX_PENDING_PER_WORKER
+        errors = []
+        pending = set()
+        for (source, target) in source_target_pairs:
+            if len(pending) >= max_pending:
+                done, pending = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                errors += [f.result() for f in done]
+            pending.add(executor.submit(copy_file, source, target))
+        done, _ = concurrent.futures.wait(pending)
+        errors += [f.result() for f in done]
+        return [e for e in errors if e]
+
+
+def copy_file(source_filename, target_filename):
+    try:
+        shutil.copy2(source_filename, target_filename)
+    except OSError as e:
+        return CopyError(source_filename, target_filename, e)
+    return None
+
+
+COMPARE_CHUNK_SIZE = 1024 * 1024
+EXECUTABLE_BITS = stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH
+
+
+def is_executable_file(filename):
+    # Whether any executable bit of filename is set
+    try:
+        return bool(os.stat(filename).st_mode & EXECUTABLE_BITS)
+    except OSError:
+        return False
+
+
+def set_executable(filename, is_executable):
+    """Sets the executable bits of filename for everyone who may read
+    it, like git does for files with mode 100755, or clears them all"""
+    mode = stat.S_IMODE(os.stat(filename).st_mode)
+    if is_executable:
+        mode |= (mode & (stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)) >> 2
+    else:
+        mode &= ~EXECUTABLE_BITS
+    os.chmod(filename, mode)
+
+
+def is_identical_file(source_target_pair):
+    """Returns True if target exists and has the same permissions and
+    content as source. Sizes and modes are compared first, so that the
+    content is only read for files that might be identical."""
+    (source_filename, target_filename) = source_target_pair
+    try:
+        source_stat = os.stat(source_filename)
+        target_stat = os.stat(target_filename)
+    except OSError:
+        return False
+
+    if stat.S_IMODE(source_stat.st_mode) != stat.S_IMODE(target_stat.st_mode):
+        return False
+    if source_stat.st_size != target_stat.st_size:
+        return False
+
+    try:
+        with open(source_filename, 'rb') as source_file, \
+                open(target_filename, 'rb') as target_file:
+            while True:
+                source_chunk = source_file.read(COMPARE_CHUNK_SIZE)
+                target_chunk = target_file.read(COMPARE_CHUNK_SIZE)
+                if source_chunk != target_chunk:
+                    return False
+                if not source_chunk:
+                    return True
+    except OSError:
+        return False
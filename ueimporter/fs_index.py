@@ -0,0 +1,276 @@
+import concurrent.futures
+import os
+import threading
+
+from pathlib import PurePosixPath
+
+
+def to_key(path):
+    key = str(path)
+    return '' if key == '.' else key
+
+
+def parent_key(key):
+    separator = key.rfind('/')
+    return key[:separator] if separator >= 0 else ''
+
+
+def name_of_key(key):
+    return key[key.rfind('/') + 1:]
+
+
+class DiskTree:
+    """Answers file system queries relative to root by asking the disc.
+    Used whenever no FileSystemIndex has been built."""
+
+    def __init__(self, root):
+        self.root = root
+
+    def __str__(self):
+        return str(self.root)
+
+    def is_file(self, path):
+        return self.root.joinpath(path).is_file()
+
+    def is_dir(self, path):
+        return self.root.joinpath(path).is_dir()
+
+    def is_empty_dir(self, path):
+        directory = self.root.joinpath(path)
+        if not directory.is_dir():
+            return False
+        for _ in directory.iterdir():
+            return False
+        return True
+
+    def child_count(self, path):
+        directory = self.root.joinpath(path)
+        if not directory.is_dir():
+            return 0
+        return sum(1 for _ in directory.iterdir())
+
+    def add_file(self, path):
+        pass
+
+    def add_dir(self, path):
+        pass
+
+    def remove_file(self, path):
+        pass
+
+    def remove_dir(self, path):
+        pass
+
+    def move_file(self, from_path, to_path):
+        pass
+
+    def move_dir(self, from_path, to_path):
+        pass
+
+    def iter_files(self, path):
+        directory = self.root.joinpath(path)
+        for (dirpath, _, filenames) in os.walk(directory):
+            relative_dirpath = PurePosixPath(
+                os.path.relpath(dirpath, self.root).replace(os.sep, '/'))
+            for filename in filenames:
+                yield relative_dirpath.joinpath(filename)
+
+
+class FileSystemIndex:
+    """In-memory snapshot of all files and directories below root.
+
+    Built once with a parallel walk of the file system, after which
+    existence queries are dictionary lookups. Jobs report their own writes
+    to the index, which keeps it in sync with the disc for later phases.
+    Safe to use from multiple threads."""
+
+    def __init__(self, root):
+        self.root = root
+        self._lock = threading.RLock()
+        # Maps the relative key of each directory to the names of its
+        # children, root is stored as ''
+        self._dirs = {'': set()}
+        self._files = set()
+
+    def __str__(self):
+        return str(self.root)
+
+    @property
+    def file_count(self):
+        return len(self._files)
+
+    @property
+    def dir_count(self):
+        return len(self._dirs)
+
+    @classmethod
+    def build(cls, root, worker_count=1, skip_names=()):
+        index = FileSystemIndex(root)
+        skip_names = set(skip_names)
+
+        def scan(key):
+            entries = []
+            directory = root.joinpath(key) if key else root
+            try:
+                with os.scandir(directory) as it:
+                    for entry in it:
+                        if entry.name in skip_names:
+                            continue
+                        try:
+                            is_dir = entry.is_dir()
+                            # Do not descend into symlinked directories,
+                            # they might lead us in circles
+                            is_link = is_dir and entry.is_symlink()
+                        except OSError:
+                            continue
+                        entries.append((entry.name, is_dir, is_link))
+            except OSError:
+                pass
+            return (key, entries)
+
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=max(1, worker_count),
+                thread_name_prefix='ueimporter-index') as executor:
+            pending = {executor.submit(scan, '')}
+            while pending:
+                done, pending = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    (key, entries) = future.result()
+                    children = index._dirs[key]
+                    for (name, is_dir, is_link) in entries:
+                        child_key = f'{key}/{name}' if key else name
+                        children.add(name)
+                        if is_dir:
+                            index._dirs[child_key] = set()
+                            if not is_link:
+                                pending.add(executor.submit(scan, child_key))
+                        else:
+                            index._files.add(child_key)
+        return index
+
+    # Single lookups are atomic, and need no lock
+    def is_file(self, path):
+        return to_key(path) in self._files
+
+    def is_dir(self, path):
+        return to_key(path) in self._dirs
+
+    def is_empty_dir(self, path):
+        with self._lock:
+            children = self._dirs.get(to_key(path))
+            return children is not None and len(children) == 0
+
+    def child_count(self, path):
+        # Number of files and directories directly below directory path
+        with self._lock:
+            return len(self._dirs.get(to_key(path), ()))
+
+    def iter_files(self, path):
+        """Yields relative paths of all files below directory path"""
+        key = to_key(path)
+        with self._lock:
+            # Collect keys up front, so that the index may be modified
+            # while the caller iterates
+            keys = []
+            pending = [key]
+            while pending:
+                directory_key = pending.pop()
+                for name in self._dirs.get(directory_key, ()):
+                    child_key = f'{directory_key}/{name}' \
+                        if directory_key else name
+                    if child_key in self._dirs:
+                        pending.append(child_key)
+                    elif child_key in self._files:
+                        keys.append(child_key)
+        for child_key in keys:
+            yield PurePosixPath(child_key)
+
+    def add_file(self, path):
+        with self._lock:
+            key = to_key(path)
+            if key in self._files:
+                return
+            self._add_to_parent(key)
+            self._files.add(key)
+
+    def add_dir(self, path):
+        with self._lock:
+            key = to_key(path)
+            if key in self._dirs:
+                return
+            self._add_to_parent(key)
+            self._dirs[key] = set()
+
+    def remove_file(self, path):
+        with self._lock:
+            key = to_key(path)
+            if key not in self._files:
+                return
+            self._files.discard(key)
+            self._remove_from_parent(key)
+
+    def remove_dir(self, path):
+        with self._lock:
+            key = to_key(path)
+            if key not in self._dirs or not key:
+                return
+            pending = [key]
+            while pending:
+                directory_key = pending.pop()
+                for name in self._dirs.pop(directory_key, ()):
+                    child_key = f'{directory_key}/{name}'
+                    if child_key in self._dirs:
+                        pending.append(child_key)
+                    else:
+                        self._files.discard(child_key)
+            self._remove_from_parent(key)
+
+    def move_file(self, from_path, to_path):
+        with self._lock:
+            self.remove_file(from_path)
+            self.add_file(to_path)
+
+    def move_dir(self, from_path, to_path):
+        with self._lock:
+            from_key = to_key(from_path)
+            to_key_prefix = to_key(to_path)
+            if from_key not in self._dirs or not from_key:
+                return
+            dirs = []
+            files = []
+            pending = [from_key]
+            while pending:
+                directory_key = pending.pop()
+                dirs.append(directory_key)
+                for name in self._dirs.get(directory_key, ()):
+                    child_key = f'{directory_key}/{name}'
+                    if child_key in self._dirs:
+                        pending.append(child_key)
+                    elif child_key in self._files:
+                        files.append(child_key)
+            self.remove_dir(from_key)
+
+            def relocate(key):
+                return to_key_prefix + key[len(from_key):]
+
+            for key in dirs:
+                self.add_dir(relocate(key))
+            for key in files:
+                self.add_file(relocate(key))
+
+    def _add_to_parent(self, key):
+        # Create missing parents, all the way up to the closest existing one
+        while key:
+            parent = parent_key(key)
+            children = self._dirs.get(parent)
+            if children is not None:
+                children.add(name_of_key(key))
+                return
+            self._dirs[parent] = {name_of_key(key)}
+            key = parent
+
+    def _remove_from_parent(self, key):
+        children = self._dirs.get(parent_key(key))
+        if children is not None:
+            children.discard(name_of_key(key))
@@ -1,7 +1,14 @@
+import hashlib
+import json
 import os
 import re
+import subprocess
+import sys
+import threading
 import ueimporter
-import unicodedata
+
+from ueimporter import trace
+from ueimporter.command_cache import CommandCache, CorruptEntryError
 
 from pathlib import PurePosixPath
 
@@ -16,40 +23,145 @@ class ParseError(Exception):
         return self._message
 
 
+def intern_path(filename):
+    # Paths are stored as interned strings rather than PurePosixPath objects.
+    # A diff between two major releases can hold hundreds of thousands of
+    # changes, where the per object overhead of a path adds up, and the same
+    # path string often shows up in several changes.
+    return sys.intern(str(PurePosixPath(filename)))
+
+
+def path_sort_key(filename):
+    # Orders path strings the same way as PurePosixPath objects
+    return filename.split('/')
+
+
+# Object id git uses for the missing side of an added or deleted file
+NULL_OBJECT_ID_REGEX = re.compile('^0+$')
+REGULAR_FILE_MODES = ('100644', '100755')
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+class RawDiff:
+    """File modes and blob ids of both sides of a change, as reported by
+    'git diff --raw'"""
+    __slots__ = ('old_mode', 'new_mode', 'old_object_id', 'new_object_id')
+
+    def __init__(self, old_mode, new_mode, old_object_id, new_object_id):
+        self.old_mode = old_mode
+        self.new_mode = new_mode
+        self.old_object_id = old_object_id
+        self.new_object_id = new_object_id
+
+    @property
+    def is_new_regular_file(self):
+        # Symlinks and submodules can not be compared with workspace files
+        return self.new_mode in REGULAR_FILE_MODES and \
+            not NULL_OBJECT_ID_REGEX.match(self.new_object_id)
+
+    @property
+    def is_new_executable(self):
+        return self.new_mode == '100755'
+
+
 class Change:
-    def __init__(self, filename):
-        self._filename = PurePosixPath(filename)
+    __slots__ = ('_filename', '_raw')
+
+    def __init__(self, filename, raw=None):
+        self._filename = intern_path(filename)
+        self._raw = raw
 
     @property
     def filename(self):
+        return PurePosixPath(self._filename)
+
+    @property
+    def raw(self):
+        # RawDiff of the change, None unless read from 'git diff --raw'
+        return self._raw
+
+    @property
+    def filename_str(self):
         return self._filename
 
+    @property
+    def sort_key(self):
+        return path_sort_key(self._filename)
+
     def __str__(self):
-        return f'{self.__class__.__name__} {self.filename}'
+        return f'{self.__class__.__name__} {self._filename}'
 
 
 class Add(Change):
-    def __init__(self, filename):
-        Change.__init__(self, filename)
+    __slots__ = ()
+
+    def __init__(self, filename, raw=None):
+        Change.__init__(self, filename, raw)
+
+
+class AddDir(Add):
+    """Add of a whole directory, coalesced from the adds of all files
+    below it"""
+    __slots__ = ('_adds',)
+
+    def __init__(self, directory, adds):
+        Add.__init__(self, directory)
+        self._adds = adds
+
+    @property
+    def adds(self):
+        return self._adds
+
+    def __str__(self):
+        return f'{Add.__str__(self)}\n' \
+            f'  ({len(self._adds)} files)'
 
 
 class Modify(Change):
-    def __init__(self, filename):
-        Change.__init__(self, filename)
+    __slots__ = ()
+
+    def __init__(self, filename, raw=None):
+        Change.__init__(self, filename, raw)
 
 
 class Delete(Change):
-    def __init__(self, filename):
-        Change.__init__(self, filename)
+    __slots__ = ()
+
+    def __init__(self, filename, raw=None):
+        Change.__init__(self, filename, raw)
+
+
+class DeleteDir(Delete):
+    """Delete of a whole directory, coalesced from the deletes of all files
+    below it"""
+    __slots__ = ('_deletes',)
+
+    def __init__(self, directory, deletes):
+        Delete.__init__(self, directory)
+        self._deletes = deletes
+
+    @property
+    def deletes(self):
+        return self._deletes
+
+    def __str__(self):
+        return f'{Delete.__str__(self)}\n' \
+            f'  ({len(self._deletes)} files)'
 
 
 class Move(Change):
-    def __init__(self, source_filename, target_filename):
-        Change.__init__(self, source_filename)
-        self._target_filename = PurePosixPath(target_filename)
+    __slots__ = ('_target_filename',)
+
+    def __init__(self, source_filename, target_filename, raw=None):
+        Change.__init__(self, source_filename, raw)
+        self._target_filename = intern_path(target_filename)
 
     @property
     def target_filename(self):
+        return PurePosixPath(self._target_filename)
+
+    @property
+    def target_filename_str(self):
         return self._target_filename
 
     def __str__(self):
@@ -67,67 +179,151 @@ class Move(Change):
                 f'  to {self.target_filename}'
 
 
-def to_valid_filename(value):
-    value = str(value)
-    value = unicodedata.normalize('NFKD', value).encode(
-        'ascii', 'ignore').decode('ascii')
-    value = re.sub(r'[^\w\s-]', '', value.lower())
-    return re.sub(r'[-\s]+', '-', value).strip('-_')
-
+class MoveDir(Move):
+    """Move of a whole directory, coalesced from the moves of all files
+    below it"""
+    __slots__ = ('_moves',)
 
-class CommandCache:
-    def __init__(self, command_cache_dir):
-        self._command_cache_dir = command_cache_dir
-        if not command_cache_dir.is_dir():
-            os.makedirs(command_cache_dir)
+    def __init__(self, source_dir, target_dir, moves):
+        Move.__init__(self, source_dir, target_dir)
+        self._moves = moves
 
-    def has_entry(self, command):
-        filename = self.get_entry_filename(command)
-        return filename.is_file()
+    @property
+    def moves(self):
+        return self._moves
 
-    def read_entry(self, command):
-        filename = self.get_entry_filename(command)
-        if filename.is_file():
-            return filename.read_text(encoding='utf-8')
+    def __str__(self):
+        return f'{Move.__str__(self)}\n' \
+            f'  ({len(self._moves)} files)'
+
+
+def hash_file(filename, object_id):
+    """Returns the id git would give the content of filename, as 'git
+    hash-object' does, using the same hash function as object_id. Returns
+    None if the file can not be read."""
+    # SHA-256 repositories have 64 character object ids
+    hash_name = 'sha256' if len(object_id) == 64 else 'sha1'
+    try:
+        with open(filename, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            h = hashlib.new(hash_name, f'blob {size}\0'.encode('ascii'))
+            while True:
+                chunk = f.read(HASH_CHUNK_SIZE)
+                if not chunk:
+                    break
+                h.update(chunk)
+    except OSError:
         return None
-
-    def write_entry(self, command, stdout):
-        filename = self.get_entry_filename(command)
-        filename.write_text(stdout, encoding='utf-8')
-        pass
-
-    def get_entry_filename(self, command):
-        entry_name = to_valid_filename("_".join(command))
-        return self._command_cache_dir.joinpath(f'{entry_name}.stdout')
+    return h.hexdigest()
 
 
 class Repo:
-    def __init__(self, repo_root, command_cache):
+    def __init__(self, repo_root, command_cache_dir,
+                 command_cache_max_size=CommandCache.DEFAULT_MAX_SIZE):
         self.repo_root = repo_root
         self.command_cache = CommandCache(
-            command_cache) if command_cache else None
+            command_cache_dir, command_cache_max_size) \
+            if command_cache_dir else None
+        # Maps refs to commit hashes, or None for unknown refs
+        self._resolved_refs = {}
 
     def to_repo_path(self, path):
         return self.repo_root.joinpath(path)
 
     def rev_list(self, ref, logger):
-        return self.run_cmd(['rev-list', '-n', '1', ref], logger).rstrip('\r\n')
+        return self.resolve_refs([ref], logger)[ref] or ''
+
+    def resolve_refs(self, refs, logger):
+        """Returns a dict mapping each of refs to the hash of the commit
+        it points to, or to None if there is no such commit. Each ref is
+        resolved at most once per Repo."""
+        unresolved_refs = [r for r in dict.fromkeys(refs)
+                           if r not in self._resolved_refs]
+        if unresolved_refs:
+            self._resolved_refs.update(
+                self._read_resolved_refs(unresolved_refs, logger))
+        return {ref: self._resolved_refs[ref] for ref in refs}
+
+    def _read_resolved_refs(self, refs, logger):
+        # Refs resolved by an earlier run are only reused as long as none
+        # of the files git might have resolved them from have changed
+        cache_command = None
+        if self.command_cache:
+            cache_command = ['git', 'resolve-refs',
+                             self.get_refs_fingerprint(refs)] + refs
+            stdout = self.command_cache.read_entry(cache_command)
+            if stdout is not None:
+                logger.log_verbose(' '.join(['git', 'resolve-refs'] + refs))
+                logger.log_verbose('Reading resolved refs from command cache')
+                return json.loads(stdout)
+
+        # Resolve all refs with a single git process
+        stdout = self.run_cmd(['cat-file', '--batch-check'], logger,
+                              input_lines=[f'{r}^{{commit}}' for r in refs])
+        resolved_refs = {}
+        for (ref, line) in zip(refs, stdout.splitlines()):
+            # Lines are either '<hash> commit <size>' or '<ref> missing'
+            fields = line.split(' ')
+            is_commit = len(fields) == 3 and fields[1] == 'commit'
+            resolved_refs[ref] = fields[0] if is_commit else None
+
+        if cache_command:
+            self.command_cache.write_entry(cache_command,
+                                           json.dumps(resolved_refs))
+        return resolved_refs
+
+    def get_refs_fingerprint(self, refs):
+        # Hash of the state of every file that refs could be resolved from
+        git_dir = self.to_repo_path('.git')
+        filenames = ['HEAD', 'packed-refs', 'reftable/tables.list']
+        for ref in refs:
+            filenames += [ref,
+                          f'refs/{ref}',
+                          f'refs/tags/{ref}',
+                          f'refs/heads/{ref}',
+                          f'refs/remotes/{ref}',
+                          f'refs/remotes/{ref}/HEAD']
+        states = []
+        for filename in filenames:
+            try:
+                stat = os.stat(git_dir.joinpath(filename))
+                states.append(f'{filename} {stat.st_mtime_ns} {stat.st_size}')
+            except (OSError, ValueError):
+                states.append(f'{filename} -')
+        return hashlib.sha256('\n'.join(states).encode('utf-8')).hexdigest()
 
     def diff(self, from_ref, to_ref, logger):
+        # Yields the NUL-delimited output in chunks of bytes, as git
+        # produces it
         arguments = [
             'diff',
-            '--name-status',
+            '--raw',
+            '-z',
+            '--no-abbrev',
             from_ref,
             to_ref]
-        return self.run_cmd_cached(arguments, logger)
+        return self.run_cmd_cached_streamed(arguments, logger)
+
+    def ls_tree(self, ref, logger):
+        # Yields the NUL-delimited output in chunks of bytes. Pass a commit
+        # hash rather than a tag, so that cached output never goes stale
+        arguments = [
+            'ls-tree',
+            '-r',
+            '-z',
+            '--full-tree',
+            ref]
+        return self.run_cmd_cached_streamed(arguments, logger)
 
     def run_cmd_cached(self, arguments, logger):
         cache_command = ['git'] + arguments
-        if self.command_cache and self.command_cache.has_entry(cache_command):
+        stdout = self.command_cache.read_entry(cache_command) \
+            if self.command_cache else None
+        if stdout is not None:
             logger.log_verbose(' '.join(
                 [str(s) for s in cache_command]))
             logger.log_verbose('Reading stdout from command cache')
-            return self.command_cache.read_entry(cache_command)
+            return stdout
 
         stdout = self.run_cmd(arguments, logger)
 
@@ -137,32 +333,256 @@ class Repo:
 
         return stdout
 
-    def run_cmd(self, arguments, logger):
+    def run_cmd_cached_streamed(self, arguments, logger):
+        cache_command = ['git'] + arguments
+        chunks = self.command_cache.read_entry_chunks(cache_command) \
+            if self.command_cache else None
+        if chunks is not None:
+            logger.log_verbose(' '.join(
+                [str(s) for s in cache_command]))
+            logger.log_verbose('Reading stdout from command cache')
+            return chunks
+
+        chunks = self.run_cmd_streamed(arguments, logger)
+
+        if self.command_cache:
+            logger.log_verbose('Writing stdout to command cache')
+            chunks = self.command_cache.write_entry_chunks(
+                cache_command, chunks)
+
+        return chunks
+
+    def run_cmd(self, arguments, logger, input_lines=None):
         command = ['git'] + arguments
         logger.log_verbose(' '.join([str(s) for s in command]))
-        return ueimporter.run(command, logger, cwd=self.repo_root)
+        return ueimporter.run(command, logger, input_lines=input_lines,
+                              cwd=self.repo_root)
+
+    def run_cmd_streamed(self, arguments, logger):
+        command = ['git'] + arguments
+        logger.log_verbose(' '.join([str(s) for s in command]))
+        return ueimporter.run_streamed(command, logger, cwd=self.repo_root)
+
+
+class BlobReader:
+    """Reads the content of blobs through a single long-lived
+    'git cat-file --batch' process, instead of spawning one git process
+    per file. Blobs are returned exactly as stored in the repo, no
+    line ending conversion or other filters are applied."""
+
+    def __init__(self, repo_root):
+        self._repo_root = repo_root
+        self._process = None
+        self._stderr_chunks = []
+        self._stderr_thread = None
+
+    def start(self, logger):
+        command = ['git', 'cat-file', '--batch']
+        logger.log_verbose(' '.join(command))
+        self._process = subprocess.Popen(
+            command,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            cwd=self._repo_root,
+            **ueimporter.get_child_process_kwargs())
+        self._stderr_thread = threading.Thread(
+            target=lambda: self._stderr_chunks.append(
+                self._process.stderr.read()),
+            daemon=True)
+        self._stderr_thread.start()
+
+    def close(self):
+        if not self._process:
+            return
+        try:
+            self._process.stdin.close()
+        except OSError:
+            pass
+        try:
+            self._process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self._process.kill()
+            self._process.wait()
+        self._process.stdout.close()
+        self._stderr_thread.join()
+        self._process = None
+
+    def read_blobs(self, object_ids):
+        """Yields (object id, content) pairs for object_ids, in order.
+        Raises ParseError if an object does not exist, or is no blob."""
+        object_ids = list(object_ids)
+
+        # Requests are written on a separate thread, so that git can keep
+        # on working while we are busy reading the previous blob
+        def write_requests():
+            try:
+                for object_id in object_ids:
+                    self._process.stdin.write(f'{object_id}\n'.encode())
+                self._process.stdin.flush()
+            except (OSError, ValueError):
+                # Reported by the reader, as a truncated response
+                pass
+
+        command = ['git', 'cat-file', '--batch']
+        writer_thread = threading.Thread(target=write_requests, daemon=True)
+        writer_thread.start()
+        is_complete = False
+        try:
+            with trace.span(trace.command_name(command), 'subprocess',
+                            **trace.command_args(command, len(object_ids))):
+                for object_id in object_ids:
+                    yield (object_id, self._read_blob(object_id))
+            is_complete = True
+        finally:
+            if not is_complete:
+                # Unread responses would leave the process out of sync,
+                # and might block the writer on a full pipe
+                self._process.kill()
+            writer_thread.join()
+            if not is_complete:
+                self.close()
+
+    def _read_blob(self, object_id):
+        stdout = self._process.stdout
+        header = stdout.readline().decode('utf-8', errors='replace')
+        # Headers are either '<oid> <type> <size>' or '<object> missing'
+        fields = header.split()
+        if len(fields) != 3 or fields[1] != 'blob':
+            stderr = b''.join(self._stderr_chunks).decode(
+                'utf-8', errors='replace')
+            raise ParseError(f'Failed to read blob {object_id} from git'
+                             f' cat-file: "{header.strip() or stderr}"')
+        size = int(fields[2])
+        content = stdout.read(size)
+        # Each blob is followed by a newline
+        if len(content) != size or stdout.read(1) != b'\n':
+            raise ParseError(f'Unexpected end of git cat-file output'
+                             f' in blob {object_id}')
+        return content
+
+
+class TreeEntry:
+    __slots__ = ('mode', 'object_type', 'object_id', 'filename')
+
+    def __init__(self, mode, object_type, object_id, filename):
+        self.mode = mode
+        self.object_type = object_type
+        self.object_id = object_id
+        self.filename = filename
+
+    @property
+    def is_executable(self):
+        return self.mode == '100755'
+
+    @property
+    def is_symlink(self):
+        return self.mode == '120000'
+
+
+def parse_tree_entries(chunks):
+    """Parses the output of 'git ls-tree -r -z', given as an iterable of
+    byte chunks, and yields a TreeEntry for each entry"""
+    remainder = b''
+    for chunk in chunks:
+        tokens = (remainder + chunk).split(b'\0')
+        # The last token is incomplete, unless the chunk ended with NUL
+        remainder = tokens.pop()
+        for token in tokens:
+            # '<mode> SP <type> SP <object> TAB <file>'
+            (info, _, filename) = token.decode('utf-8').partition('\t')
+            fields = info.split(' ')
+            if len(fields) != 3 or not filename:
+                raise ParseError(f'Unrecognized git ls-tree entry'
+                                 f' "{token.decode("utf-8", "replace")}"')
+            yield TreeEntry(fields[0], fields[1], fields[2], filename)
+
+    if remainder:
+        raise ParseError('Unexpected end of git ls-tree output')
 
 
 MOVE_REGEX = re.compile('^r[0-9]*$')
 
 
-def parse_change_line(line_number, line):
-    parts = line.split('\t')
-    mode = parts[0].lower()
+def get_change_path_count(mode):
+    # Number of paths following a change mode in git diff output
+    mode = mode.lower()
+    if mode in ('m', 'a', 'd'):
+        return 1
+    elif MOVE_REGEX.match(mode):
+        return 2
+    return 0
+
+
+def create_change(mode, paths, raw=None):
+    mode = mode.lower()
     if mode == 'm':
-        return Modify(parts[1])
+        return Modify(paths[0], raw)
     elif mode == 'a':
-        return Add(parts[1])
+        return Add(paths[0], raw)
     elif mode == 'd':
-        return Delete(parts[1])
+        return Delete(paths[0], raw)
     elif MOVE_REGEX.match(mode):
-        return Move(parts[1], parts[2])
+        return Move(paths[0], paths[1], raw)
+    return None
+
+
+def parse_raw_status(field):
+    """Splits the first field of a change in 'git diff --raw -z' output,
+    ':<old mode> <new mode> <old id> <new id> <status>', into the status
+    and a RawDiff. Fields of 'git diff --name-status -z' output only hold
+    the status, and have no RawDiff."""
+    if not field.startswith(':'):
+        return (field, None)
+    parts = field[1:].split(' ')
+    if len(parts) != 5:
+        return (field, None)
+    return (parts[4], RawDiff(*parts[:4]))
+
+
+def parse_change_line(line_number, line):
+    parts = line.split('\t')
+    change = create_change(parts[0], parts[1:])
+    if change:
+        return change
 
     raise ParseError(
         f'Unrecognized git diff change mode on line {line_number}:'
         f' "{line}"')
 
 
+def parse_changes(chunks):
+    """Parses the output of 'git diff --raw -z' or 'git diff --name-status
+    -z', given as an iterable of byte chunks, and yields each change as
+    soon as all of its fields have arrived"""
+    fields = []
+    expected_field_count = 0
+    change_number = 0
+    remainder = b''
+    for chunk in chunks:
+        tokens = (remainder + chunk).split(b'\0')
+        # The last token is incomplete, unless the chunk ended with NUL
+        remainder = tokens.pop()
+        for token in tokens:
+            field = token.decode('utf-8')
+            if not fields:
+                change_number += 1
+                (field, raw) = parse_raw_status(field)
+                expected_field_count = get_change_path_count(field) + 1
+                if expected_field_count == 1:
+                    raise ParseError(
+                        f'Unrecognized git diff change mode on change'
+                        f' {change_number}: "{field}"')
+            fields.append(field)
+            if len(fields) == expected_field_count:
+                yield create_change(fields[0], fields[1:], raw)
+                fields = []
+
+    if remainder or fields:
+        raise ParseError(
+            f'Unexpected end of git diff output on change {change_number}')
+
+
 class Changes:
     def __init__(self, per_file_changes, modifications, adds, deletes, moves):
         self.per_file_changes = per_file_changes
@@ -172,21 +592,30 @@ class Changes:
         self.moves = moves
 
 
-def read_changes(git_repo, from_release_tag, to_release_tag, logger):
-    stdout = git_repo.diff(from_release_tag,
+def read_filename_to_changes(git_repo, from_release_tag, to_release_tag,
+                             logger):
+    chunks = git_repo.diff(from_release_tag,
                            to_release_tag, logger)
 
     filename_to_changes = {}
-    for line_it, line in enumerate(stdout.split('\n')):
-        if not line:
-            continue
-
-        change = parse_change_line(line_it + 1, line)
-        lower_filename = str(change.filename).lower()
+    for change in parse_changes(chunks):
+        lower_filename = change.filename_str.lower()
         if lower_filename in filename_to_changes:
             filename_to_changes[lower_filename].append(change)
         else:
             filename_to_changes[lower_filename] = [change]
+    return filename_to_changes
+
+
+def read_changes(git_repo, from_release_tag, to_release_tag, logger):
+    try:
+        filename_to_changes = read_filename_to_changes(
+            git_repo, from_release_tag, to_release_tag, logger)
+    except CorruptEntryError as e:
+        # The corrupt entry is gone, so this time git diff is run
+        logger.log_warning(f'Warning: {e}, running git diff instead')
+        filename_to_changes = read_filename_to_changes(
+            git_repo, from_release_tag, to_release_tag, logger)
 
     changes_per_type = {
         Modify: [],
@@ -202,9 +631,9 @@ def read_changes(git_repo, from_release_tag, to_release_tag, logger):
         else:
             per_file_changes[lower_filename] = changes
 
-    mods = sorted(changes_per_type[Modify], key=lambda m: m.filename)
-    adds = sorted(changes_per_type[Add], key=lambda m: m.filename)
-    dels = sorted(changes_per_type[Delete], key=lambda m: m.filename)
-    moves = sorted(changes_per_type[Move], key=lambda m: m.filename)
+    mods = sorted(changes_per_type[Modify], key=lambda m: m.sort_key)
+    adds = sorted(changes_per_type[Add], key=lambda m: m.sort_key)
+    dels = sorted(changes_per_type[Delete], key=lambda m: m.sort_key)
+    moves = sorted(changes_per_type[Move], key=lambda m: m.sort_key)
 
     return Changes(per_file_changes, mods, adds, dels, moves)
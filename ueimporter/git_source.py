@@ -0,0 +1,113 @@
+import os
+import shutil
+
+from pathlib import PurePosixPath
+
+import ueimporter
+import ueimporter.fs_index as fs_index
+import ueimporter.git as git
+
+EOLS = ['lf', 'crlf']
+DEFAULT_FILE_MODE = 0o644
+EXECUTABLE_FILE_MODE = 0o755
+# Same heuristic as git uses to tell binary files from text
+BINARY_PROBE_SIZE = 8000
+
+
+class GitSourceError(Exception):
+    def __init__(self, message):
+        self._message = message
+
+    def __str__(self):
+        return self._message
+
+
+def convert_eol(content, eol):
+    """Returns content with line endings converted to eol. Binary files,
+    and files that already hold CRLF line endings, are left untouched."""
+    if eol == 'lf' or b'\r' in content or \
+            b'\0' in content[:BINARY_PROBE_SIZE]:
+        return content
+    return content.replace(b'\n', b'\r\n')
+
+
+class GitSource:
+    """Release package read straight from the object store of the git
+    repo, at the commit of a release tag.
+
+    The tree of the commit is indexed once, and the index answers the same
+    existence queries as a FileSystemIndex of an extracted package. Only
+    the files that ops actually copy are read, through a single
+    'git cat-file --batch' process, into a staging directory that then
+    serves as the source root path of jobs. Executable bits are taken from
+    the tree modes, and line endings are written as eol."""
+
+    def __init__(self, git_repo, ref, staging_root, eol='lf'):
+        assert eol in EOLS
+        self.git_repo = git_repo
+        self.ref = ref
+        self.staging_root = staging_root
+        self.eol = eol
+        self.tree = fs_index.FileSystemIndex(git_repo.repo_root)
+        self.extracted_count = 0
+        self.extracted_byte_count = 0
+
+    @property
+    def desc(self):
+        return f'{self.ref} in {self.git_repo.repo_root}'
+
+    def extract(self, filenames, copier, logger):
+        """Indexes the tree and extracts filenames, which are paths
+        relative to the repo root, into the staging directory. Names not
+        in the tree are ignored, validation reports them later."""
+        wanted_names = set([str(f) for f in filenames])
+        os.makedirs(self.staging_root, exist_ok=True)
+        try:
+            entries_to_extract = self._index_tree(wanted_names, logger)
+            self._extract_entries(entries_to_extract, logger)
+        except (OSError, git.ParseError, ueimporter.CommandError) as e:
+            raise GitSourceError(f'Failed to read {self.desc}: {e}')
+
+    def close(self):
+        shutil.rmtree(self.staging_root, ignore_errors=True)
+
+    def _index_tree(self, wanted_names, logger):
+        entries_to_extract = []
+        chunks = self.git_repo.ls_tree(self.ref, logger)
+        for entry in git.parse_tree_entries(chunks):
+            if entry.object_type != 'blob':
+                # Submodules have no content of their own to copy
+                logger.log_verbose(f'Skipping {entry.filename} in'
+                                   f' {self.ref}, it is a'
+                                   f' {entry.object_type}')
+                continue
+            self.tree.add_file(PurePosixPath(entry.filename))
+            if entry.filename in wanted_names:
+                entries_to_extract.append(entry)
+        return entries_to_extract
+
+    def _extract_entries(self, entries, logger):
+        reader = git.BlobReader(self.git_repo.repo_root)
+        reader.start(logger)
+        try:
+            blobs = reader.read_blobs([e.object_id for e in entries])
+            # Blobs come first, so that the reader runs to completion
+            for ((_, content), entry) in zip(blobs, entries):
+                # Symlinks are written as files holding the link target,
+                # like git does on file systems without symlinks
+                if not entry.is_symlink:
+                    content = convert_eol(content, self.eol)
+                mode = EXECUTABLE_FILE_MODE if entry.is_executable \
+                    else DEFAULT_FILE_MODE
+                self._write_staged_file(entry.filename, content, mode)
+                self.extracted_count += 1
+                self.extracted_byte_count += len(content)
+        finally:
+            reader.close()
+
+    def _write_staged_file(self, name, content, mode):
+        filename = self.staging_root.joinpath(name)
+        os.makedirs(filename.parent, exist_ok=True)
+        with open(filename, 'wb') as f:
+            f.write(content)
+        os.chmod(filename, mode)
@@ -1,27 +1,47 @@
+import collections
+import concurrent.futures
+import heapq
 import os
 import re
-import shutil
-
+import sys
+import threading
+import time
+
+import ueimporter
+import ueimporter.batch as batch
+import ueimporter.copy_engine as copy_engine
+import ueimporter.fs_index as fs_index
 import ueimporter.git as git
 import ueimporter.op as op
 import ueimporter.path_util as path_util
+import ueimporter.plastic as plastic
+import ueimporter.trace as trace
+
 
+def create_jobs(changes, plastic_repo, source_root_path, pretend, logger,
+                copier=None, source_tree=None, workspace_tree=None,
+                batch_size=None, pipelined=False, compare_object_ids=True):
+    if not workspace_tree:
+        workspace_tree = fs_index.DiskTree(plastic_repo.workspace_root)
+
+    # The changes of each type are sorted by read_changes. Changes created
+    # below are collected separately, and merged into them, rather than
+    # sorting every list again.
 
-def create_jobs(changes, plastic_repo, source_root_path, pretend, logger):
     # Convert Del + Add of the same file to a Move
     logger.log('Finding deletes followed by adds on the same file')
     logger.indent()
     change_type_to_changes = {
-        git.Add: changes.adds,
-        git.Delete: changes.deletes,
-        git.Modify: changes.modifications,
-        git.Move: changes.moves
+        git.Add: [],
+        git.Delete: [],
+        git.Modify: [],
+        git.Move: []
     }
     for lower_filename, per_file_changes in changes.per_file_changes.items():
         for change in per_file_changes:
-            line = f'{type(change).__name__} {change.filename}'
+            line = f'{type(change).__name__} {change.filename_str}'
             if type(change) == git.Move:
-                line += f' -> {change.target_filename}'
+                line += f' -> {change.target_filename_str}'
             logger.log(line)
 
         for i in range(0, len(per_file_changes) - 1):
@@ -31,18 +51,22 @@ def create_jobs(changes, plastic_repo, source_root_path, pretend, logger):
 
             next_change = per_file_changes[i+1]
             if type(change) == git.Delete and type(next_change) == git.Add:
-                move = git.Move(change.filename, next_change.filename)
+                raw = git.RawDiff(change.raw.old_mode,
+                                  next_change.raw.new_mode,
+                                  change.raw.old_object_id,
+                                  next_change.raw.new_object_id) \
+                    if change.raw and next_change.raw else None
+                move = git.Move(change.filename_str, next_change.filename_str,
+                                raw)
 
                 logger.log('Replacing')
                 logger.indent()
                 for change_to_log in [change, next_change]:
-                    for line in str(change_to_log).split('\n'):
-                        logger.log(line)
+                    log_change(logger, change_to_log)
                 logger.deindent()
                 logger.log('With')
                 logger.indent()
-                for line in str(move).split('\n'):
-                    logger.log(line)
+                log_change(logger, move)
                 logger.deindent()
 
                 change = move
@@ -52,6 +76,14 @@ def create_jobs(changes, plastic_repo, source_root_path, pretend, logger):
             assert job_changes != None
             job_changes.append(change)
 
+    changes.adds = merge_changes(changes.adds,
+                                 change_type_to_changes[git.Add])
+    changes.deletes = merge_changes(changes.deletes,
+                                    change_type_to_changes[git.Delete])
+    changes.modifications = merge_changes(changes.modifications,
+                                          change_type_to_changes[git.Modify])
+    changes.moves = merge_changes(changes.moves,
+                                  change_type_to_changes[git.Move])
     logger.deindent()
 
     # Convert Move to Modify if move appears to already happened
@@ -60,24 +92,87 @@ def create_jobs(changes, plastic_repo, source_root_path, pretend, logger):
     logger.indent()
     moves_already_existing_in_target = [
             move for move in changes.moves
-            if not plastic_repo.to_workspace_path(move.filename).is_file()
-            and plastic_repo.to_workspace_path(move.target_filename).is_file()]
+            if not workspace_tree.is_file(move.filename_str)
+            and workspace_tree.is_file(move.target_filename_str)]
+    modifications = []
     for move in moves_already_existing_in_target:
-        modify = git.Modify(move.target_filename)
+        modify = git.Modify(move.target_filename_str, move.raw)
 
         logger.log('Replacing')
         logger.indent()
-        for line in str(move).split('\n'):
-            logger.log(line)
+        log_change(logger, move)
         logger.deindent()
         logger.log('With')
         logger.indent()
-        for line in str(modify).split('\n'):
-            logger.log(line)
+        log_change(logger, modify)
         logger.deindent()
 
-        changes.modifications.append(modify)
-        changes.moves.remove(move)
+        modifications.append(modify)
+    if moves_already_existing_in_target:
+        replaced_moves = set(id(m) for m in moves_already_existing_in_target)
+        changes.moves = [m for m in changes.moves
+                         if id(m) not in replaced_moves]
+        changes.modifications = merge_changes(changes.modifications,
+                                              modifications)
+    logger.deindent()
+
+    # Coalesce deletes of all files in a directory into a single delete of
+    # the directory itself
+    logger.log('Finding directories that have been deleted as a whole')
+    logger.indent()
+    dir_deletes = find_directory_deletes(changes, workspace_tree)
+    if dir_deletes:
+        deleted_file_count = 0
+        coalesced_deletes = set()
+        for dir_delete in dir_deletes:
+            log_change(logger, dir_delete)
+            deleted_file_count += len(dir_delete.deletes)
+            coalesced_deletes.update(id(d) for d in dir_delete.deletes)
+        changes.deletes = merge_changes(
+            [d for d in changes.deletes if id(d) not in coalesced_deletes],
+            dir_deletes)
+        logger.log(f'Replaced {deleted_file_count} file deletes'
+                   f' with {len(dir_deletes)} directory deletes')
+    logger.deindent()
+
+    # Coalesce adds of all files in a new directory into a single add of
+    # the directory itself
+    logger.log('Finding directories that have been added as a whole')
+    logger.indent()
+    dir_adds = find_directory_adds(
+        changes, workspace_tree,
+        plastic.IgnoreRules.read(plastic_repo.workspace_root))
+    if dir_adds:
+        added_file_count = 0
+        coalesced_adds = set()
+        for dir_add in dir_adds:
+            log_change(logger, dir_add)
+            added_file_count += len(dir_add.adds)
+            coalesced_adds.update(id(a) for a in dir_add.adds)
+        changes.adds = merge_changes(
+            [a for a in changes.adds if id(a) not in coalesced_adds],
+            dir_adds)
+        logger.log(f'Replaced {added_file_count} file adds'
+                   f' with {len(dir_adds)} directory adds')
+    logger.deindent()
+
+    # Coalesce moves of all files in a directory into a single move of
+    # the directory itself
+    logger.log('Finding directories that have been moved as a whole')
+    logger.indent()
+    dir_moves = find_directory_moves(changes, workspace_tree)
+    if dir_moves:
+        moved_file_count = 0
+        coalesced_moves = set()
+        for dir_move in dir_moves:
+            log_change(logger, dir_move)
+            moved_file_count += len(dir_move.moves)
+            coalesced_moves.update(id(m) for m in dir_move.moves)
+        changes.moves = merge_changes(
+            [m for m in changes.moves if id(m) not in coalesced_moves],
+            dir_moves)
+        logger.log(f'Replaced {moved_file_count} file moves'
+                   f' with {len(dir_moves)} directory moves')
     logger.deindent()
 
     jobs = []
@@ -92,8 +187,13 @@ def create_jobs(changes, plastic_repo, source_root_path, pretend, logger):
         job = job_class(logger=logger,
                         plastic_repo=plastic_repo,
                         source_root_path=source_root_path,
-                        pretend=pretend)
-        job_changes = sorted(job_changes, key=lambda m: m.filename)
+                        pretend=pretend,
+                        copier=copier,
+                        source_tree=source_tree,
+                        workspace_tree=workspace_tree,
+                        batch_size=batch_size,
+                        pipelined=pipelined,
+                        compare_object_ids=compare_object_ids)
         for change in job_changes:
             job.add_change(change)
         jobs.append(job)
@@ -101,16 +201,300 @@ def create_jobs(changes, plastic_repo, source_root_path, pretend, logger):
     return jobs
 
 
-def find_dirs_to_create(target_root, filenames):
+def log_change(logger, change):
+    # Moves and coalesced changes span several lines
+    if logger.is_enabled(ueimporter.LogLevel.NORMAL):
+        logger.print_lines(ueimporter.LogLevel.NORMAL,
+                           str(change).split('\n'))
+
+
+def merge_changes(sorted_changes, other_changes):
+    # Merges changes in any order into a list of changes that is already
+    # sorted, in O(n + m log m) rather than sorting all of them again
+    if not other_changes:
+        return sorted_changes
+    other_changes = sorted(other_changes, key=lambda c: c.sort_key)
+    return list(heapq.merge(sorted_changes, other_changes,
+                            key=lambda c: c.sort_key))
+
+
+def restore_jobs(job_states, plastic_repo, source_root_path, pretend, logger,
+                 copier=None, source_tree=None, workspace_tree=None,
+                 batch_size=None, pipelined=False, compare_object_ids=True):
+    """Recreates jobs from the ops and progress recorded in a journal"""
+    desc_to_job_class = {c.job_desc: c for c in JOB_CLASSES}
+    jobs = []
+    for job_state in job_states:
+        job_class = desc_to_job_class[job_state.desc]
+        job = job_class(logger=logger,
+                        plastic_repo=plastic_repo,
+                        source_root_path=source_root_path,
+                        pretend=pretend,
+                        copier=copier,
+                        source_tree=source_tree,
+                        workspace_tree=workspace_tree,
+                        batch_size=batch_size,
+                        pipelined=pipelined,
+                        compare_object_ids=compare_object_ids)
+        for job_op in job_state.ops:
+            job.add_op(job_op)
+        job.mark_processed(job_state.processed_op_count)
+        jobs.append(job)
+    return jobs
+
+
+def find_directory_moves(changes, workspace_tree):
+    """Finds directories where every file is moved to the same relative
+    location below a single target directory, and no other change touches
+    either directory. Returns a MoveDir change for each such directory,
+    with nested directories folded into their outermost moved ancestor."""
+    # Count moves per candidate (source directory, target directory) pair.
+    # A move of a/b/c/f to x/y/c/f is a candidate for moving a/b/c to
+    # x/y/c as well as a/b to x/y
+    candidates = collections.defaultdict(list)
+    for move in changes.moves:
+        source_parts = move.filename_str.split('/')
+        target_parts = move.target_filename_str.split('/')
+        suffix_length = 1
+        while suffix_length < min(len(source_parts), len(target_parts)) and \
+                source_parts[-suffix_length] == target_parts[-suffix_length]:
+            source_dir = '/'.join(source_parts[:-suffix_length])
+            target_dir = '/'.join(target_parts[:-suffix_length])
+            if source_dir == target_dir:
+                break
+            candidates[(source_dir, target_dir)].append(move)
+            suffix_length += 1
+
+    if not candidates:
+        return []
+
+    move_sources_per_dir = path_util.count_per_ancestor(
+        [m.filename_str for m in changes.moves])
+    move_targets_per_dir = path_util.count_per_ancestor(
+        [m.target_filename_str for m in changes.moves])
+    others_per_dir = path_util.count_per_ancestor(
+        [c.filename_str for c in
+         changes.adds + changes.deletes + changes.modifications])
+
+    def is_below(path, directory):
+        return path.startswith(directory + '/')
+
+    def is_candidate_valid(source_dir, target_dir, moves):
+        move_count = len(moves)
+        if is_below(source_dir, target_dir) or \
+                is_below(target_dir, source_dir):
+            return False
+        # Every move below source_dir must belong to this candidate, and
+        # nothing may be moved into it, or otherwise touch it
+        if move_sources_per_dir[source_dir] != move_count or \
+                move_targets_per_dir[source_dir] != 0 or \
+                others_per_dir[source_dir] != 0:
+            return False
+        # target_dir must only receive the files of this candidate
+        if move_targets_per_dir[target_dir] != move_count or \
+                move_sources_per_dir[target_dir] != 0 or \
+                others_per_dir[target_dir] != 0:
+            return False
+        if workspace_tree.is_dir(target_dir) or \
+                workspace_tree.is_file(target_dir) or \
+                not workspace_tree.is_dir(source_dir):
+            return False
+        # Finally, the moves must cover all files in the workspace
+        workspace_file_count = 0
+        for _ in workspace_tree.iter_files(source_dir):
+            workspace_file_count += 1
+            if workspace_file_count > move_count:
+                return False
+        return workspace_file_count == move_count
+
+    # Visit outermost directories first, so that nested candidates can be
+    # skipped once an ancestor has been selected
+    dir_moves = []
+    selected_source_dirs = set()
+    for (source_dir, target_dir) in sorted(
+            candidates.keys(), key=lambda c: (c[0].count('/'), c)):
+        if any(d in selected_source_dirs
+               for d in path_util.iter_parent_strs(source_dir)):
+            continue
+        moves = candidates[(source_dir, target_dir)]
+        if not is_candidate_valid(source_dir, target_dir, moves):
+            continue
+        selected_source_dirs.add(source_dir)
+        dir_moves.append(git.MoveDir(source_dir, target_dir, moves))
+    return dir_moves
+
+
+def find_directory_adds(changes, workspace_tree, ignore_rules):
+    """Finds directories that do not exist in the workspace, where every
+    file is added and no other change touches the directory. Returns an
+    AddDir change for each such directory, with nested directories folded
+    into their outermost added ancestor."""
+    if not changes.adds:
+        return []
+
+    adds_per_dir = collections.defaultdict(list)
+    for add in changes.adds:
+        for directory in path_util.iter_parent_strs(add.filename_str):
+            adds_per_dir[directory].append(add)
+    others_per_dir = path_util.count_per_ancestor(
+        [c.filename_str for c in changes.deletes + changes.modifications] +
+        [m.filename_str for m in changes.moves] +
+        [m.target_filename_str for m in changes.moves])
+
+    def is_candidate_valid(directory, adds):
+        if others_per_dir[directory] != 0 or \
+                workspace_tree.is_dir(directory) or \
+                workspace_tree.is_file(directory):
+            return False
+        # A recursive add skips ignored items, which adding them one by
+        # one does not
+        return not any(ignore_rules.is_ignored(a.filename_str, False)
+                       for a in adds)
+
+    # Visit outermost directories first, so that nested candidates can be
+    # skipped once an ancestor has been selected
+    dir_adds = []
+    selected_dirs = set()
+    for directory in sorted(adds_per_dir.keys(),
+                            key=lambda d: (d.count('/'), d)):
+        if any(d in selected_dirs
+               for d in path_util.iter_parent_strs(directory)):
+            continue
+        adds = adds_per_dir[directory]
+        # A single file gains nothing from being added as a directory
+        if len(adds) < 2 or not is_candidate_valid(directory, adds):
+            continue
+        selected_dirs.add(directory)
+        dir_adds.append(git.AddDir(directory, adds))
+    return dir_adds
+
+
+def find_directory_deletes(changes, workspace_tree):
+    """Finds directories where every file in the workspace is deleted, and
+    no other change touches the directory. Returns a DeleteDir change for
+    each such directory, with nested directories folded into their
+    outermost deleted ancestor."""
+    if not changes.deletes:
+        return []
+
+    deletes_per_dir = collections.defaultdict(list)
+    for delete in changes.deletes:
+        for directory in path_util.iter_parent_strs(delete.filename_str):
+            deletes_per_dir[directory].append(delete)
+    others_per_dir = path_util.count_per_ancestor(
+        [c.filename_str for c in changes.adds + changes.modifications] +
+        [m.filename_str for m in changes.moves] +
+        [m.target_filename_str for m in changes.moves])
+
+    def is_candidate_valid(directory, deletes):
+        if others_per_dir[directory] != 0 or \
+                not workspace_tree.is_dir(directory):
+            return False
+        # The deletes must cover all files in the workspace, as cm remove
+        # takes everything below the directory along with it
+        deleted_filenames = set(d.filename_str for d in deletes)
+        workspace_file_count = 0
+        for filename in workspace_tree.iter_files(directory):
+            if str(filename) not in deleted_filenames:
+                return False
+            workspace_file_count += 1
+        return workspace_file_count == len(deleted_filenames)
+
+    # Visit outermost directories first, so that nested candidates can be
+    # skipped once an ancestor has been selected
+    dir_deletes = []
+    selected_dirs = set()
+    for directory in sorted(deletes_per_dir.keys(),
+                            key=lambda d: (d.count('/'), d)):
+        if any(d in selected_dirs
+               for d in path_util.iter_parent_strs(directory)):
+            continue
+        deletes = deletes_per_dir[directory]
+        # A single file gains nothing from being removed as a directory
+        if len(deletes) < 2 or not is_candidate_valid(directory, deletes):
+            continue
+        selected_dirs.add(directory)
+        dir_deletes.append(git.DeleteDir(directory, deletes))
+    return dir_deletes
+
+
+def find_dirs_to_create(target_tree, filenames):
     dirs_to_add = set()
     for filename in filenames:
         directory = filename.parent
         while not directory in dirs_to_add and \
-                not target_root.joinpath(directory).is_dir():
+                not target_tree.is_dir(directory):
             dirs_to_add.add(directory)
+            directory = directory.parent
     return sorted(dirs_to_add)
 
 
+def find_emptied_dirs(target_tree, filenames):
+    """Finds the directories left without any files or directories once
+    filenames have been removed from target_tree. Returns the outermost
+    of them, which take the rest along when removed, and the total number
+    of emptied directories."""
+    # Relative paths, the workspace root itself is PurePosixPath('.')
+    def is_workspace_root(p):
+        return p == p.parent
+
+    # Visit the deepest directories first, a directory is emptied when
+    # all its children are emptied directories
+    pending_per_depth = collections.defaultdict(set)
+    for filename in filenames:
+        if not is_workspace_root(filename.parent):
+            pending_per_depth[len(filename.parent.parts)].add(filename.parent)
+    emptied_child_counts = collections.Counter()
+    emptied_dirs = set()
+    depth = max(pending_per_depth.keys(), default=0)
+    while depth > 0:
+        for directory in pending_per_depth.pop(depth, ()):
+            if not target_tree.is_dir(directory) or \
+                    target_tree.child_count(directory) != \
+                    emptied_child_counts[directory]:
+                continue
+            emptied_dirs.add(directory)
+            if not is_workspace_root(directory.parent):
+                emptied_child_counts[directory.parent] += 1
+                pending_per_depth[depth - 1].add(directory.parent)
+        depth -= 1
+
+    outermost_dirs = sorted([d for d in emptied_dirs
+                             if d.parent not in emptied_dirs])
+    return (outermost_dirs, len(emptied_dirs))
+
+
+class OpsView:
+    """Read only view of the ops in [start, stop) of a list, that avoids
+    copying the list when slicing"""
+    __slots__ = ('_ops', '_start', '_stop')
+
+    def __init__(self, ops, start, stop):
+        self._ops = ops
+        self._start = start
+        self._stop = stop
+
+    def __len__(self):
+        return self._stop - self._start
+
+    def __iter__(self):
+        for i in range(self._start, self._stop):
+            yield self._ops[i]
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            (start, stop, step) = key.indices(len(self))
+            assert step == 1, 'OpsView does not support stepped slices'
+            return OpsView(self._ops,
+                           self._start + start,
+                           self._start + max(start, stop))
+        if key < 0:
+            key += len(self)
+        if key < 0 or key >= len(self):
+            raise IndexError('OpsView index out of range')
+        return self._ops[self._start + key]
+
+
 class JobProgressListener:
     def __init__(self):
         pass
@@ -127,6 +511,15 @@ class JobProgressListener:
     def end_batch(self):
         pass
 
+    def abort_batch(self):
+        pass
+
+    def start_stage(self, desc):
+        pass
+
+    def end_stage(self, elapsed_time):
+        pass
+
     def start_step(self, desc):
         pass
 
@@ -134,22 +527,63 @@ class JobProgressListener:
         pass
 
 
+class PreparedBatch:
+    """Result of running the prepare stage of a batch on a worker thread.
+    Log lines are captured, to be written once the batch is reported."""
+
+    def __init__(self, ops, state, log_records, elapsed_time, error):
+        self.ops = ops
+        self.state = state
+        self.log_records = log_records
+        self.elapsed_time = elapsed_time
+        self.error = error
+
+
 class Job:
     _JOB_DESC = ''
+    BATCH_SIZE_LIMITS = batch.BatchSizeLimits(
+        min_size=1, initial_size=20, max_size=2000)
+    # Jobs that split each batch into a prepare and a commit stage can
+    # prepare the next batch while the current one is committed
+    IS_PIPELINED = False
+    # Max number of batches prepared ahead of the one being committed
+    PIPELINE_DEPTH = 1
 
     @classmethod
     @property
     def job_desc(cls):
         return cls._JOB_DESC
 
-    def __init__(self, op_class, plastic_repo, source_root_path, pretend, logger):
+    def __init__(self, op_class, plastic_repo, source_root_path, pretend, logger,
+                 copier=None, source_tree=None, workspace_tree=None,
+                 batch_size=None, pipelined=False, compare_object_ids=True):
         self._op_class = op_class
         self.plastic_repo = plastic_repo
         self.source_root_path = source_root_path
         self.pretend = pretend
         self.logger = logger
+        self.copier = copier if copier else copy_engine.CopyEngine()
+        self.source_tree = source_tree if source_tree \
+            else fs_index.DiskTree(source_root_path)
+        self.workspace_tree = workspace_tree if workspace_tree \
+            else fs_index.DiskTree(plastic_repo.workspace_root)
+        if batch_size:
+            self.batcher = batch.AdaptiveBatcher.fixed(
+                batch_size, plastic_repo.input_byte_budget)
+        else:
+            self.batcher = batch.AdaptiveBatcher(
+                self.BATCH_SIZE_LIMITS, plastic_repo.input_byte_budget)
+        self.pipelined = pipelined and self.IS_PIPELINED
+        # Whether files of the release package have the content of the
+        # blobs in the git repo, so that workspace files can be compared
+        # with the blob ids of changes instead of the package
+        self.compare_object_ids = compare_object_ids
+        # Ids of ops of a failed batch that went through anyway, and must
+        # not be sent to plastic again when the batch is retried
+        self._applied_op_ids = set()
         self._ops = []
         self._processed_op_count = 0
+        self._elided_op_count = 0
 
     @property
     def desc(self):
@@ -159,66 +593,318 @@ class Job:
     def ops(self):
         return self._ops
 
+    @property
+    def processed_op_count(self):
+        return self._processed_op_count
+
+    @property
+    def elided_op_count(self):
+        # Number of processed ops that turned out to be no-ops
+        return self._elided_op_count
+
     @property
     def unprocessed_ops(self):
-        return self._ops[self._processed_op_count:]
+        return OpsView(self._ops, self._processed_op_count, len(self._ops))
 
     def add_change(self, change):
         op = self._op_class(change)
         self._ops.append(op)
 
+    def add_op(self, op):
+        self._ops.append(op)
+
+    def mark_processed(self, processed_op_count):
+        # Used when resuming, to skip ops processed by an earlier run
+        assert 0 <= processed_op_count <= len(self._ops)
+        self._processed_op_count = processed_op_count
+
     def trim_trailing_ops(self, max_op_count):
         assert max_op_count >= 0
         max_op_count = min(len(self._ops), max_op_count)
-        self._ops = self._ops[0:max_op_count]
+        del self._ops[max_op_count:]
 
-    def remove_op(self, op):
-        self._ops.remove(op)
+    def remove_ops(self, ops):
+        # Removes all of ops at once, in a single pass over the ops
+        removed_ops = set(id(op) for op in ops)
+        self._ops[:] = [op for op in self._ops if id(op) not in removed_ops]
 
-    def process(self, batch_size, max_op_count, listener):
+    def process(self, max_op_count, listener, journal=None, stop_event=None,
+                gate=None):
+        # gate is an optional JobScheduler, that holds back ops depending
+        # on ops of other jobs being processed concurrently
         ops = self.unprocessed_ops
         op_count = len(ops)
         if max_op_count > 0:
             op_count = min(op_count, max_op_count)
-        for batch_start in range(0, op_count, batch_size):
-            batch_end = min(batch_start + batch_size, op_count)
-            batch_ops = ops[batch_start:batch_end]
+        ops = ops[0:op_count]
+
+        with trace.span(self.desc, 'job', op_count=op_count):
+            if self.pipelined:
+                self._process_pipelined(ops, listener, journal, stop_event,
+                                        gate)
+            else:
+                self._process_sequential(ops, listener, journal,
+                                         stop_event, gate)
+
+    def _process_sequential(self, ops, listener, journal, stop_event, gate):
+        op_count = len(ops)
+        batch_start = 0
+        while batch_start < op_count:
+            # Only stop in between batches, to leave the workspace in a
+            # state that the journal can describe
+            if stop_event and stop_event.is_set():
+                break
+
+            remaining_ops = ops[batch_start:]
+            batch_size = self.batcher.next_batch_size(remaining_ops)
+            if gate:
+                batch_size = gate.wait(self, self._processed_op_count,
+                                       self._processed_op_count + batch_size)
+                if batch_size == 0:
+                    break
+            batch_ops = remaining_ops[0:batch_size]
+            if journal:
+                journal.record_batch_start(
+                    self, self._processed_op_count,
+                    self._processed_op_count + batch_size)
             listener.start_batch(self, batch_ops)
-            self.process_ops(batch_ops, listener)
+            start_timestamp = time.time()
+            try:
+                self.process_ops(batch_ops, listener)
+            except ueimporter.CommandError:
+                listener.abort_batch()
+                if not self.batcher.record_failure():
+                    raise
+                self.recover_failed_batch(batch_ops)
+                self.logger.log_warning(
+                    f'Warning: Batch failed, retrying with batches of'
+                    f' {self.batcher.size} ops')
+                continue
+            self.batcher.record_batch(batch_size,
+                                      time.time() - start_timestamp)
             listener.end_batch()
-        self._processed_op_count += op_count
+            batch_start += batch_size
+            self._processed_op_count += batch_size
+            if journal:
+                journal.record_batch_end(self, self._processed_op_count)
+            if gate:
+                gate.notify(self)
+
+    def _process_pipelined(self, ops, listener, journal, stop_event, gate):
+        # The prepare stage of the next batches runs on a worker thread,
+        # while the commit stage of the current batch runs on this one.
+        # Stages of the same kind still run one batch at a time, in order.
+        op_count = len(ops)
+        first_op_index = self._processed_op_count
+        pending = collections.deque()
+        prepare_start = 0
+        commit_start = 0
+        commit_timestamp = time.time()
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=1,
+                thread_name_prefix='ueimporter-prepare') as executor:
+            while commit_start < op_count:
+                # Once stopped, only commit the batches already prepared
+                is_stopping = stop_event and stop_event.is_set()
+                while not is_stopping and prepare_start < op_count and \
+                        len(pending) <= self.PIPELINE_DEPTH:
+                    remaining_ops = ops[prepare_start:]
+                    batch_size = self.batcher.next_batch_size(remaining_ops)
+                    start = first_op_index + prepare_start
+                    if gate and pending:
+                        # Do not block while there are batches to commit
+                        batch_size = gate.ready_op_count(
+                            self, start, start + batch_size)
+                    elif gate:
+                        batch_size = gate.wait(self, start,
+                                               start + batch_size)
+                        commit_timestamp = time.time()
+                    if batch_size == 0:
+                        break
+                    batch_ops = remaining_ops[0:batch_size]
+                    if journal:
+                        journal.record_batch_start(self, start,
+                                                   start + batch_size)
+                    pending.append(executor.submit(
+                        self._prepare_batch, batch_ops, listener))
+                    prepare_start += batch_size
+                if not pending:
+                    break
+
+                prepared = pending.popleft().result()
+                batch_size = len(prepared.ops)
+                listener.start_batch(self, prepared.ops)
+                try:
+                    listener.start_stage('Prepare')
+                    self.logger.replay(prepared.log_records)
+                    listener.end_stage(prepared.elapsed_time)
+                    if prepared.error:
+                        raise prepared.error
+
+                    listener.start_stage('Commit')
+                    start_timestamp = time.time()
+                    with trace.span('Commit', 'stage', job=self.desc,
+                                    op_count=batch_size):
+                        self.commit_ops(prepared.ops, prepared.state,
+                                        listener)
+                    listener.end_stage(time.time() - start_timestamp)
+                except ueimporter.CommandError:
+                    listener.abort_batch()
+                    # Batches prepared ahead are discarded, and prepared
+                    # again along with the failed one
+                    for future in pending:
+                        future.result()
+                    pending.clear()
+                    prepare_start = commit_start
+                    if not self.batcher.record_failure():
+                        raise
+                    self.recover_failed_batch(prepared.ops)
+                    self.logger.log_warning(
+                        f'Warning: Batch failed, retrying with batches of'
+                        f' {self.batcher.size} ops')
+                    continue
+
+                # With stages overlapping, the time between two commits is
+                # what a batch costs
+                now = time.time()
+                self.batcher.record_batch(batch_size, now - commit_timestamp)
+                commit_timestamp = now
+                listener.end_batch()
+                commit_start += batch_size
+                self._processed_op_count += batch_size
+                if journal:
+                    journal.record_batch_end(self, self._processed_op_count)
+                if gate:
+                    gate.notify(self)
+
+    def _prepare_batch(self, ops, listener):
+        state = None
+        error = None
+        start_timestamp = time.time()
+        with self.logger.capture() as log_records, \
+                trace.span('Prepare', 'stage', job=self.desc,
+                           op_count=len(ops)):
+            try:
+                state = self.prepare_ops(ops, listener)
+            except BaseException as e:
+                error = e
+        return PreparedBatch(ops, state, log_records,
+                             time.time() - start_timestamp, error)
 
     def process_ops(self, ops, listener):
+        state = self.prepare_ops(ops, listener)
+        self.commit_ops(ops, state, listener)
+
+    def prepare_ops(self, ops, listener):
+        """First stage of processing a batch. Must not depend on the commit
+        stage of the previous batch having completed. Returns state that is
+        passed on to commit_ops."""
+        return None
+
+    def commit_ops(self, ops, state, listener):
         pass
 
-    def find_invalid_ops(self):
+    def find_invalid_ops(self, worker_count=1):
+        def validate(op):
+            return op.validate(self.source_tree, self.workspace_tree)
+
+        # Validation is dominated by file system stat calls, which release
+        # the GIL, so they can overlap on a pool of threads.
+        # Results are returned in op order regardless of worker count.
+        if worker_count > 1 and len(self.ops) > 1:
+            with concurrent.futures.ThreadPoolExecutor(
+                    max_workers=worker_count,
+                    thread_name_prefix='ueimporter-validate') as executor:
+                validations = list(executor.map(validate, self.ops))
+        else:
+            validations = [validate(op) for op in self.ops]
+
         invalid_ops = []
-        for op in self.ops:
-            validation = op.validate(self.source_root_path,
-                                     self.plastic_repo.workspace_root)
+        for (op, validation) in zip(self.ops, validations):
             if not validation:
                 invalid_ops.append((op, validation))
         return invalid_ops
 
     def copy(self, filenames):
         # Copy files from source to target plastic workspace
+        source_target_pairs = []
         for filename in filenames:
             self.logger.log_verbose(filename)
-            if self.pretend:
-                continue
-
             source_filename = self.source_root_path.joinpath(filename)
             target_filename = self.plastic_repo.to_workspace_path(filename)
+            source_target_pairs.append((source_filename, target_filename))
 
-            # Copy file including file permissions and create/modify timstamps
-            shutil.copy2(source_filename, target_filename)
+        for filename in filenames:
+            self.workspace_tree.add_file(filename)
+
+        if self.pretend:
+            return
+
+        # Copy files including file permissions and create/modify timstamps
+        errors = self.copier.copy_files(source_target_pairs)
+        if errors:
+            for error in sorted(errors, key=lambda e: str(e.target_filename)):
+                self.logger.log_error(f'Error: {error}')
+            sys.exit(1)
+
+    def recover_failed_batch(self, ops):
+        # Called before a failed batch is processed again. Adding and
+        # checking out files can safely be repeated, jobs running commands
+        # that can not override this.
+        pass
+
+    def find_applied_ops(self, ops):
+        """Remembers which of ops have been applied to the workspace on
+        disc, even though their batch failed. The workspace index is only
+        updated once a batch succeeds, and can not tell."""
+        if self.pretend:
+            return
+        disk_tree = fs_index.DiskTree(self.plastic_repo.workspace_root)
+        for applied_op in ops:
+            if applied_op.is_applied(disk_tree):
+                self.logger.log_verbose(
+                    f'{applied_op.filename} (already applied)')
+                self._applied_op_ids.add(id(applied_op))
+
+    def pop_applied(self, job_op):
+        # Whether job_op was found applied after a failed batch
+        if id(job_op) not in self._applied_op_ids:
+            return False
+        self._applied_op_ids.discard(id(job_op))
+        return True
+
+    def find_files_matching_object_ids(self, changes, filenames):
+        """Returns, for each of changes, whether the workspace file at the
+        corresponding one of filenames already has the content of the new
+        blob of the change. Files are hashed on the copier threads."""
+        is_matching = [False] * len(changes)
+        if not self.compare_object_ids:
+            return is_matching
+        indices = [i for (i, change) in enumerate(changes)
+                   if change.raw and change.raw.is_new_regular_file]
+        object_ids = self.copier.map(
+            lambda i: git.hash_file(
+                self.plastic_repo.to_workspace_path(filenames[i]),
+                changes[i].raw.new_object_id),
+            indices)
+        for (i, object_id) in zip(indices, object_ids):
+            is_matching[i] = object_id == changes[i].raw.new_object_id
+        return is_matching
+
+    def has_new_mode(self, filename, change):
+        # Whether the executable bit of the workspace file matches the new
+        # mode of change. Windows has no executable bit to compare.
+        if os.name == 'nt':
+            return True
+        return change.raw.is_new_executable == copy_engine.is_executable_file(
+            self.plastic_repo.to_workspace_path(filename))
 
     def create_target_parent_dirs(self, filenames):
         # Ensure that all parent directories exist in plastic workspace
-        dirs_to_create = find_dirs_to_create(
-            self.plastic_repo.workspace_root, filenames)
+        dirs_to_create = find_dirs_to_create(self.workspace_tree, filenames)
         for directory in dirs_to_create:
             self.logger.log(directory)
+            self.workspace_tree.add_dir(directory)
             if self.pretend:
                 continue
 
@@ -227,82 +913,232 @@ class Job:
         return dirs_to_create
 
     def remove_empty_parent_dirs(self, filenames):
-        remove_count = 0
-        parents = set([filename.parent for filename in filenames])
-
-        plastic_workspace_root = self.plastic_repo.workspace_root
-
-        def is_existing_dir_empty(p):
-            workspace_path = plastic_workspace_root.joinpath(p)
-            if not workspace_path.exists():
-                return False
-            for _ in workspace_path.iterdir():
-                return False
-            return workspace_path.is_dir()
-
-        while len(parents) > 0:
-            empty_parents = [p for p in parents if is_existing_dir_empty(p)]
-            if len(empty_parents) == 0:
-                break
-
-            for directory in empty_parents:
-                self.logger.log(directory)
-
-            remove_count += len(empty_parents)
-            self.plastic_repo.remove_multiple(empty_parents, self.logger)
-            grand_parents = set([p.parent for p in empty_parents
-                                 if not p.parent == plastic_workspace_root])
-            parents = (parents - set(empty_parents)) | grand_parents
+        # Removing the outermost emptied directories takes the emptied
+        # directories below them along, all with a single cm remove
+        (empty_dirs, remove_count) = find_emptied_dirs(self.workspace_tree,
+                                                       filenames)
+        if not empty_dirs:
+            return 0
+
+        for directory in empty_dirs:
+            self.logger.log(directory)
 
+        self.plastic_repo.remove_multiple(empty_dirs, self.logger)
+        for directory in empty_dirs:
+            self.workspace_tree.remove_dir(directory)
         return remove_count
 
 
 class AddJob(Job):
+    # Files of the next batch are copied while cm adds the current one
+    IS_PIPELINED = True
+
     def __init__(self, **kwargs):
         Job.__init__(self, op.AddOp, **kwargs)
+        # Directories created on disc but not yet added to plastic. Kept
+        # across batches, so that a batch that is prepared again after a
+        # failure still adds the directories created the first time around
+        self._unadded_dirs = set()
+        self._unadded_dirs_lock = threading.Lock()
 
-    def process_ops(self, ops, listener):
-        filenames = [op.filename for op in ops]
+    def add_change(self, change):
+        if type(change) == git.AddDir:
+            self.add_op(op.AddDirOp(change))
+        else:
+            Job.add_change(self, change)
+
+    def prepare_ops(self, ops, listener):
+        # Files of directory adds are copied like any other file, along
+        # with all directories below the added directory
+        filenames = [filename for add_op in ops
+                     for filename in add_op.source_filenames]
 
         listener.start_step('Create missing parent directories')
-        dirs_to_add = self.create_target_parent_dirs(filenames)
+        created_dirs = self.create_target_parent_dirs(filenames)
+        with self._unadded_dirs_lock:
+            self._unadded_dirs.update(created_dirs)
         listener.end_step()
 
         listener.start_step('Copy files from source')
         self.copy(filenames)
         listener.end_step()
 
-        paths_to_add = sorted(dirs_to_add + filenames)
-        listener.start_step(f'Add {len(filenames)} files and'
-                            f' {len(dirs_to_add)} directories to plastic')
-        self.plastic_repo.add_multiple(paths_to_add, self.logger)
-        listener.end_step()
+    def commit_ops(self, ops, state, listener):
+        filenames = [add_op.filename for add_op in ops
+                     if type(add_op) != op.AddDirOp]
+        added_dirs = [add_op.filename for add_op in ops
+                      if type(add_op) == op.AddDirOp]
+        added_dir_set = set(added_dirs)
+
+        def is_added_recursively(directory):
+            return directory in added_dir_set or \
+                any(d in added_dir_set for d in directory.parents)
+
+        with self._unadded_dirs_lock:
+            # Directories at or below an added directory are added along
+            # with it by the recursive add
+            recursive_dirs = set([directory
+                                  for directory in self._unadded_dirs
+                                  if is_added_recursively(directory)])
+            dirs_to_add = set([directory
+                               for filename in filenames + added_dirs
+                               for directory in filename.parents
+                               if directory in self._unadded_dirs and
+                               directory not in recursive_dirs])
+            self._unadded_dirs -= dirs_to_add | recursive_dirs
+
+        try:
+            paths_to_add = sorted(list(dirs_to_add) + filenames)
+            if paths_to_add:
+                listener.start_step(
+                    f'Add {len(filenames)} files and'
+                    f' {len(dirs_to_add)} directories to plastic')
+                self.plastic_repo.add_multiple(paths_to_add, self.logger)
+                listener.end_step()
+
+            if added_dirs:
+                listener.start_step(f'Add {len(added_dirs)} directories'
+                                    f' recursively to plastic')
+                self.plastic_repo.add_recursive_multiple(sorted(added_dirs),
+                                                         self.logger)
+                listener.end_step()
+        except ueimporter.CommandError:
+            with self._unadded_dirs_lock:
+                self._unadded_dirs |= dirs_to_add | recursive_dirs
+            raise
 
 
 class ModifyJob(Job):
+    # The next batch is checked out while files of the current one are
+    # copied
+    IS_PIPELINED = True
+
     def __init__(self, **kwargs):
         Job.__init__(self, op.ModifyOp, **kwargs)
 
-    def process_ops(self, ops, listener):
-        filenames = [op.filename for op in ops]
+    def prepare_ops(self, ops, listener):
+        listener.start_step('Find files that are identical to source')
+        (filenames, chmod_filenames, elided_count) = \
+            self.filter_identical_files(ops)
+        listener.end_step()
+
+        # Identical files are only counted as elided once the batch has
+        # been committed, as a prepared batch might be discarded
+        if not filenames and not chmod_filenames:
+            return (filenames, chmod_filenames, elided_count)
 
         listener.start_step('Checkout files in plastic')
-        self.plastic_repo.checkout_multiple(filenames, self.logger)
+        self.plastic_repo.checkout_multiple(
+            sorted(filenames + [f for (f, _) in chmod_filenames]),
+            self.logger)
         listener.end_step()
+        return (filenames, chmod_filenames, elided_count)
 
-        listener.start_step('Copy files from source')
-        self.copy(filenames)
-        listener.end_step()
+    def commit_ops(self, ops, state, listener):
+        (filenames, chmod_filenames, elided_count) = state
+        if filenames:
+            listener.start_step('Copy files from source')
+            self.copy(filenames)
+            listener.end_step()
+
+        if chmod_filenames:
+            listener.start_step('Change mode of files')
+            self.chmod(chmod_filenames)
+            listener.end_step()
+
+        self._elided_op_count += elided_count
+
+    def filter_identical_files(self, ops):
+        """Returns the filenames of ops to check out and copy,
+        (filename, is_executable) pairs of files that already have the new
+        content, and only need their mode changed, and the number of ops
+        that need neither."""
+        # Git reports files as modified even if the release package
+        # contains the same bytes as the workspace, for instance due to
+        # line ending only changes, or when an earlier import was
+        # interrupted. Skip those, there is no need to check them out or
+        # copy them. Files that have the content of the new blob in the
+        # git repo are found without reading the release package.
+        filenames = [op.filename for op in ops]
+        changes = [op.change for op in ops]
+        is_matching = self.find_files_matching_object_ids(changes, filenames)
+
+        modified_filenames = []
+        chmod_filenames = []
+        unmatched_filenames = []
+        elided_count = 0
+        for (filename, change, matching) in zip(filenames, changes,
+                                                 is_matching):
+            if not matching:
+                unmatched_filenames.append(filename)
+                continue
+            if self.has_new_mode(filename, change):
+                self.logger.log_verbose(f'{filename} (identical, skipping)')
+                elided_count += 1
+            else:
+                self.logger.log_verbose(f'{filename} (mode change only)')
+                chmod_filenames.append((filename,
+                                        change.raw.is_new_executable))
+
+        source_target_pairs = [
+            (self.source_root_path.joinpath(filename),
+             self.plastic_repo.to_workspace_path(filename))
+            for filename in unmatched_filenames]
+        is_identical = self.copier.map(copy_engine.is_identical_file,
+                                       source_target_pairs)
+        for (filename, identical) in zip(unmatched_filenames, is_identical):
+            if identical:
+                self.logger.log_verbose(f'{filename} (identical, skipping)')
+                elided_count += 1
+            else:
+                modified_filenames.append(filename)
+        return (modified_filenames, chmod_filenames, elided_count)
+
+    def chmod(self, filename_modes):
+        # Sets or clears the executable bits of (filename, is_executable)
+        # pairs, the content of the files is already up to date
+        for (filename, is_executable) in filename_modes:
+            self.logger.log_verbose(filename)
+            if self.pretend:
+                continue
+            try:
+                copy_engine.set_executable(
+                    self.plastic_repo.to_workspace_path(filename),
+                    is_executable)
+            except OSError as e:
+                self.logger.log_error(
+                    f'Error: Failed to change mode of {filename}: {e}')
+                sys.exit(1)
 
 
 class DeleteJob(Job):
     def __init__(self, **kwargs):
         Job.__init__(self, op.DeleteOp, **kwargs)
 
+    def add_change(self, change):
+        if type(change) == git.DeleteDir:
+            self.add_op(op.DeleteDirOp(change))
+        else:
+            Job.add_change(self, change)
+
+    def recover_failed_batch(self, ops):
+        # Removing a file that is already gone fails
+        self.find_applied_ops(ops)
+
     def process_ops(self, ops, listener):
+        # Directory deletes remove a whole directory, including all files
+        # and directories below it, with a single path passed to cm remove
         filenames = [op.filename for op in ops]
+        paths_to_remove = [op.filename for op in ops
+                           if not self.pop_applied(op)]
         listener.start_step('Remove files from plastic')
-        self.plastic_repo.remove_multiple(filenames, self.logger)
+        if paths_to_remove:
+            self.plastic_repo.remove_multiple(paths_to_remove, self.logger)
+        for delete_op in ops:
+            if type(delete_op) == op.DeleteDirOp:
+                self.workspace_tree.remove_dir(delete_op.filename)
+            else:
+                self.workspace_tree.remove_file(delete_op.filename)
         listener.end_step()
 
         listener.start_step(f'Remove empty directories from plastic')
@@ -311,25 +1147,70 @@ class DeleteJob(Job):
 
 
 class MoveJob(Job):
+    # cm move does not accept paths via STDIN, so every op is a separate
+    # command regardless of batch size. Keep batches small enough for
+    # progress reporting to stay meaningful.
+    BATCH_SIZE_LIMITS = batch.BatchSizeLimits(
+        min_size=1, initial_size=20, max_size=200)
+
     def __init__(self, **kwargs):
         Job.__init__(self, op.MoveOp, **kwargs)
+        # Directories created on disc but not yet added to plastic. Kept
+        # across batches, as a batch that failed to add them finds them in
+        # the workspace index when it is retried
+        self._unadded_dirs = set()
+
+    def add_change(self, change):
+        if type(change) == git.MoveDir:
+            self.add_op(op.MoveDirOp(change))
+        else:
+            Job.add_change(self, change)
 
     def process_ops(self, ops, listener):
-        target_filenames = [op.target_filename for op in ops]
+        # Directory moves move a whole directory with a single cm move,
+        # but files still need to be copied one by one, as their contents
+        # might have changed along with the move
+        target_filenames = []
+        moves = []
+        for move_op in ops:
+            if type(move_op) == op.MoveDirOp:
+                target_filenames += move_op.target_filenames
+                moves += move_op.moves
+            else:
+                target_filenames.append(move_op.target_filename)
+                moves.append(move_op.change)
 
         listener.start_step('Create missing parent directories')
-        dirs_to_add = self.create_target_parent_dirs(target_filenames)
+        self._unadded_dirs.update(self.create_target_parent_dirs(
+            [op.target_filename for op in ops]))
         listener.end_step()
 
-        if dirs_to_add:
+        if self._unadded_dirs:
             listener.start_step('Add created parent directories to plastic')
-            self.plastic_repo.add_multiple(dirs_to_add, self.logger)
+            self.plastic_repo.add_multiple(sorted(self._unadded_dirs),
+                                           self.logger)
+            self._unadded_dirs.clear()
             listener.end_step()
 
         listener.start_step(f'Move files in plastic')
 
-        from_to_pairs = [(op.filename, op.target_filename) for op in ops]
+        # Moves that went through in a failed batch are not repeated, but
+        # their files are still copied
+        from_to_pairs = [(op.filename, op.target_filename) for op in ops
+                         if not self.pop_applied(op)]
         self.plastic_repo.move_multiple(from_to_pairs, self.logger)
+        for move_op in ops:
+            if type(move_op) == op.MoveDirOp:
+                self.workspace_tree.move_dir(move_op.filename,
+                                             move_op.target_filename)
+            else:
+                self.workspace_tree.move_file(move_op.filename,
+                                              move_op.target_filename)
+        listener.end_step()
+
+        listener.start_step('Find files that are identical to source')
+        target_filenames = self.filter_identical_files(moves,
+                                                       target_filenames)
         listener.end_step()
 
         listener.start_step('Copy files from source')
@@ -341,6 +1222,26 @@ class MoveJob(Job):
         self.remove_empty_parent_dirs(source_filenames)
         listener.end_step()
 
+    def recover_failed_batch(self, ops):
+        # Each op is a separate cm move, the ops before the failing one
+        # have been moved, and moving them again fails
+        self.find_applied_ops(ops)
+
+    def filter_identical_files(self, moves, target_filenames):
+        # Files that are renamed without being modified already have the
+        # content of the new blob once moved, and need no copy. Files
+        # with a changed mode are copied, to get the mode of the release.
+        is_matching = self.find_files_matching_object_ids(moves,
+                                                          target_filenames)
+        modified_filenames = []
+        for (filename, move, matching) in zip(target_filenames, moves,
+                                              is_matching):
+            if matching and self.has_new_mode(filename, move):
+                self.logger.log_verbose(f'{filename} (identical, skipping)')
+            else:
+                modified_filenames.append(filename)
+        return modified_filenames
+
 
 # Register operations, and set up descriptions
 _JOB_DESC_REGEX = re.compile('^([a-zA-Z]*)Job$')
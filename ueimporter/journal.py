@@ -0,0 +1,158 @@
+import json
+import os
+import threading
+
+import ueimporter.op as op
+
+# Bump whenever the format of op records changes
+JOURNAL_VERSION = 2
+
+
+class JournalError(Exception):
+    def __init__(self, message):
+        self._message = message
+
+    def __str__(self):
+        return self._message
+
+
+class Journal:
+    """Append-only record of an import, written as one JSON object per line.
+
+    The first record holds the plan, i.e. every op of every job. Each batch
+    is then bracketed by a batch_start and a batch_end record, so that a
+    batch that was interrupted halfway can be told apart from a completed
+    one. Pipelined jobs start the next batch before the current one ends,
+    so several batches of a job may be in flight at once.
+    Records are flushed to disc as they are written."""
+
+    def __init__(self, filename, job_indices):
+        self.filename = filename
+        self._job_indices = job_indices
+        self._lock = threading.Lock()
+        self._file = open(filename, 'a', encoding='utf-8')
+
+    @classmethod
+    def create(cls, filename, from_release_tag, to_release_tag, jobs):
+        if not filename.parent.is_dir():
+            os.makedirs(filename.parent)
+        # Start from scratch, any previous journal is for a different plan
+        with open(filename, 'w', encoding='utf-8'):
+            pass
+        journal = Journal(filename,
+                          {job: i for (i, job) in enumerate(jobs)})
+        journal._write({
+            'record': 'plan',
+            'version': JOURNAL_VERSION,
+            'from_release_tag': from_release_tag,
+            'to_release_tag': to_release_tag,
+            'jobs': [{'desc': job.desc,
+                      'processed_op_count': job.processed_op_count,
+                      'ops': [o.to_record() for o in job.ops]}
+                     for job in jobs]
+        })
+        return journal
+
+    @classmethod
+    def reopen(cls, filename, jobs):
+        return Journal(filename, {job: i for (i, job) in enumerate(jobs)})
+
+    def record_batch_start(self, job, start, end):
+        self._write({'record': 'batch_start',
+                     'job': self._job_indices[job],
+                     'start': start,
+                     'end': end})
+
+    def record_batch_end(self, job, processed_op_count):
+        self._write({'record': 'batch_end',
+                     'job': self._job_indices[job],
+                     'processed_op_count': processed_op_count})
+
+    def record_done(self):
+        self._write({'record': 'done'})
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    def _write(self, record):
+        line = json.dumps(record, separators=(',', ':')) + '\n'
+        # Jobs processed concurrently share the journal
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+
+class JournalJobState:
+    def __init__(self, desc, ops, processed_op_count):
+        self.desc = desc
+        self.ops = ops
+        self.processed_op_count = processed_op_count
+        # End of the last batch that was started
+        self.started_op_count = processed_op_count
+
+    @property
+    def interrupted_batch(self):
+        # [start, end) of ops in batches that were started, but never
+        # completed
+        if self.started_op_count <= self.processed_op_count:
+            return None
+        return (self.processed_op_count, self.started_op_count)
+
+
+class JournalState:
+    def __init__(self, from_release_tag, to_release_tag, jobs, is_done):
+        self.from_release_tag = from_release_tag
+        self.to_release_tag = to_release_tag
+        self.jobs = jobs
+        self.is_done = is_done
+
+
+def read(filename):
+    """Reads a journal written by Journal, and returns the state of the
+    import at the time of the last record"""
+    if not filename.is_file():
+        raise JournalError(f'Failed to find journal {filename}')
+
+    records = []
+    with open(filename, 'r', encoding='utf-8') as f:
+        lines = f.readlines()
+    for line_number, line in enumerate(lines):
+        try:
+            records.append(json.loads(line))
+        except json.JSONDecodeError:
+            # A crash while writing leaves a truncated last line behind
+            if line_number == len(lines) - 1:
+                break
+            raise JournalError(
+                f'Failed to parse line {line_number + 1} of {filename}')
+
+    if not records or records[0].get('record') != 'plan':
+        raise JournalError(f'{filename} does not start with a plan')
+    plan = records[0]
+    if plan.get('version') != JOURNAL_VERSION:
+        raise JournalError(f'{filename} has unsupported version'
+                           f' {plan.get("version")}')
+
+    jobs = [JournalJobState(job['desc'],
+                            [op.from_record(r) for r in job['ops']],
+                            job['processed_op_count'])
+            for job in plan['jobs']]
+    is_done = False
+    for record in records[1:]:
+        record_type = record.get('record')
+        if record_type == 'batch_start':
+            job = jobs[record['job']]
+            job.started_op_count = max(job.started_op_count, record['end'])
+        elif record_type == 'batch_end':
+            job = jobs[record['job']]
+            job.processed_op_count = record['processed_op_count']
+        elif record_type == 'done':
+            is_done = True
+
+    return JournalState(plan['from_release_tag'],
+                        plan['to_release_tag'],
+                        jobs,
+                        is_done)
@@ -1,27 +1,45 @@
 import argparse
 import datetime
 import enum
+import os
+import signal
 import sys
+import tempfile
+import threading
 import time
 
 from pathlib import Path
 
+import ueimporter
+import ueimporter.archive as archive
+import ueimporter.copy_engine as copy_engine
+import ueimporter.fs_index as fs_index
 import ueimporter.git as git
+import ueimporter.git_source as git_source
 import ueimporter.job
+import ueimporter.journal as journal
 import ueimporter.path_util as path_util
 import ueimporter.plastic as plastic
+import ueimporter.scheduler as scheduler
+import ueimporter.trace as trace
+import ueimporter.verify as verify
 import ueimporter.version as version
 from ueimporter import Logger
 from ueimporter import LogLevel
 
 SEPARATOR = '-' * 80
-BATCH_SIZE = 20
 MAX_OPS_PER_JOB = -1
+DEFAULT_VALIDATION_WORKERS = 16
+DEFAULT_GIT_COMMAND_CACHE_SIZE = 1024
+DEFAULT_LOG_FILE_BACKUPS = 5
+SOURCE_BACKENDS = ['auto', 'directory', 'archive', 'git']
 
 
 def create_parser():
     parser = argparse.ArgumentParser(
-        description='Imports Unreal Engine releases into plastic vendor branches'
+        description='Imports Unreal Engine releases into plastic vendor branches',
+        epilog=f'Run "ueimporter {verify.COMMAND_NAME} --help" to learn how'
+        f' to verify a workspace against a release'
     )
     parser.add_argument('--pretend',
                         action='store_true',
@@ -46,11 +64,41 @@ def create_parser():
                         Required whenever a ueimporter.json file does not exist.
                         """)
     parser.add_argument('--zip-package-root',
-                        required=True,
                         type=lambda p: Path(p).absolute(),
                         help="""
                         Specifies where release zip files have been extracted.
                         See https://github.com/EpicGames/UnrealEngine/releases
+                        Not needed when files are read from the git repo
+                        """)
+    parser.add_argument('--source-backend',
+                        choices=SOURCE_BACKENDS,
+                        default='auto',
+                        help="""
+                        How to read the release package below
+                        --zip-package-root. "directory" reads an extracted
+                        UnrealEngine-<tag> directory, "archive" reads an
+                        UnrealEngine-<tag> .zip or .tar.gz archive without
+                        extracting it, and "git" reads files straight from
+                        the git repo at --to-release-tag instead.
+                        Default is "auto", which uses the directory if there
+                        is one, the archive otherwise, and git if no
+                        --zip-package-root is given
+                        """)
+    parser.add_argument('--git-source-eol',
+                        choices=git_source.EOLS,
+                        default='lf',
+                        help="""
+                        Line endings of text files read from the git repo.
+                        Files are written as stored in the repo with "lf",
+                        while "crlf" converts them to CRLF line endings.
+                        Default is lf
+                        """)
+    parser.add_argument('--staging-dir',
+                        type=lambda p: Path(p).absolute(),
+                        help="""
+                        Directory below which files read from a release
+                        archive or the git repo are staged, before they are copied into the
+                        workspace. Default is the system temporary directory
                         """)
     parser.add_argument('--plastic-workspace-root',
                         type=lambda p: Path(p).absolute(),
@@ -82,6 +130,35 @@ def create_parser():
                         in STDOUT. All levels always ends up in the logfile.
                         Default is normal
                         """)
+    parser.add_argument('--log-file-level',
+                        default=str(LogLevel.DEBUG).lower(),
+                        choices=[str(l).lower() for l in list(LogLevel)],
+                        help="""
+                        Controls the detail level of logs that end up in the
+                        logfile. Lines below the levels of both STDOUT and
+                        the logfile are never formatted.
+                        Default is debug
+                        """)
+    parser.add_argument('--log-file-max-size',
+                        type=int,
+                        default=0,
+                        help="""
+                        Max size of the log file in MiB, before it is rotated
+                        into <log-file>.1, <log-file>.2 and so on.
+                        Default is 0, which never rotates it
+                        """)
+    parser.add_argument('--log-file-backups',
+                        type=int,
+                        default=DEFAULT_LOG_FILE_BACKUPS,
+                        help=f"""
+                        Number of rotated log files to keep.
+                        Default is {DEFAULT_LOG_FILE_BACKUPS}
+                        """)
+    parser.add_argument('--compress-log-files',
+                        action='store_true',
+                        help="""
+                        If set, rotated log files are gzip compressed
+                        """)
     parser.add_argument('--skip-invalid-ops',
                         action='store_true',
                         help="""
@@ -97,6 +174,96 @@ def create_parser():
                         If set, results of heavy git commands will be stored
                         in this directory
                         """)
+    parser.add_argument('--git-command-cache-size',
+                        type=int,
+                        default=DEFAULT_GIT_COMMAND_CACHE_SIZE,
+                        help=f"""
+                        Max size of the git command cache in MiB. Least
+                        recently used entries are evicted once the cache
+                        grows larger.
+                        Default is {DEFAULT_GIT_COMMAND_CACHE_SIZE}
+                        """)
+    parser.add_argument('--cm-shell',
+                        action='store_true',
+                        help="""
+                        If set, all plastic commands are sent to a single
+                        long-lived "cm shell" process, instead of spawning
+                        one cm process per command. Falls back to one process
+                        per command if the shell fails to start
+                        """)
+    parser.add_argument('--copy-workers',
+                        type=int,
+                        default=copy_engine.default_worker_count(),
+                        help="""
+                        Number of threads used to copy files from the release
+                        into the plastic workspace.
+                        Default is the number of CPUs, capped at 8
+                        """)
+    parser.add_argument('--validation-workers',
+                        type=int,
+                        default=DEFAULT_VALIDATION_WORKERS,
+                        help=f"""
+                        Number of threads used to index and validate ops
+                        against the release package and plastic workspace
+                        before processing starts. Set to 1 to do it serially.
+                        Default is {DEFAULT_VALIDATION_WORKERS}
+                        """)
+    parser.add_argument('--batch-size',
+                        type=int,
+                        default=0,
+                        help="""
+                        Number of ops passed to each cm command.
+                        Default is 0, which adapts the batch size to the
+                        measured cm latency of each job
+                        """)
+    parser.add_argument('--job-parallelism',
+                        type=int,
+                        default=1,
+                        help="""
+                        Max number of jobs processed concurrently. Ops that
+                        touch the same files or directories are still
+                        processed in job order.
+                        Default is 1, which processes one job at a time
+                        """)
+    parser.add_argument('--no-pipeline',
+                        action='store_true',
+                        help="""
+                        If set, each batch is processed from start to end
+                        before the next one starts. By default, files of
+                        the next batch are copied or checked out while cm
+                        processes the current batch
+                        """)
+    parser.add_argument('--no-object-id-compare',
+                        action='store_true',
+                        help="""
+                        If set, workspace files are only compared with the
+                        release package. By default, files that already
+                        have the content of their blob in the git repo are
+                        neither checked out nor copied
+                        """)
+    parser.add_argument('--journal-file',
+                        type=lambda p: Path(p).absolute(),
+                        default=Path('.ueimporter/journal.jsonl'),
+                        help="""
+                        Name of file where the import plan and progress
+                        is recorded after each batch.
+                        Default is .ueimporter/journal.jsonl
+                        """)
+    parser.add_argument('--trace-file',
+                        type=lambda p: Path(p).absolute(),
+                        help="""
+                        If set, a timeline of the import is written to this
+                        file, as Chrome trace events. It holds spans for each
+                        phase, job, batch and step, and for every command
+                        run. Open it in chrome://tracing or
+                        https://ui.perfetto.dev
+                        """)
+    parser.add_argument('--resume',
+                        action='store_true',
+                        help="""
+                        Resume an import that was interrupted, from the
+                        plan and progress recorded in the journal file
+                        """)
     return parser
 
 
@@ -104,9 +271,11 @@ def read_change_jobs(config, logger):
     try:
         logger.log('Resolving git hashes of release tags')
         logger.indent()
-        from_git_hash = config.git_repo.rev_list(
-            config.from_release_tag, logger)
-        to_git_hash = config.git_repo.rev_list(config.to_release_tag, logger)
+        # Already resolved by create_config
+        git_hashes = config.git_repo.resolve_refs(
+            [config.from_release_tag, config.to_release_tag], logger)
+        from_git_hash = git_hashes[config.from_release_tag]
+        to_git_hash = git_hashes[config.to_release_tag]
         logger.log(f'{config.from_release_tag} <=> {from_git_hash}')
         logger.log(f'{config.to_release_tag} <=> {to_git_hash}')
         logger.deindent()
@@ -122,12 +291,150 @@ def read_change_jobs(config, logger):
         logger.log_error(f'Error: {e}')
         sys.exit(1)
 
+    if config.git_repo.command_cache:
+        logger.log(f'Git command cache:'
+                   f' {config.git_repo.command_cache.stats}')
+
     return ueimporter.job.create_jobs(
         changes,
         plastic_repo=config.plastic_repo,
         source_root_path=config.source_root_path,
         pretend=config.pretend,
-        logger=logger)
+        logger=logger,
+        copier=config.copier,
+        source_tree=config.source_tree,
+        workspace_tree=config.workspace_tree,
+        batch_size=config.batch_size,
+        pipelined=config.pipelined,
+        compare_object_ids=config.compare_object_ids)
+
+
+def index_file_systems(config, worker_count, logger):
+    logger.log('Indexing release package and plastic workspace')
+    logger.indent()
+    start_timestamp = time.time()
+    if config.source_package:
+        # Filled in by extract_source_files, once jobs are known
+        config.source_tree = config.source_package.tree
+    else:
+        config.source_tree = fs_index.FileSystemIndex.build(
+            config.source_root_path, worker_count)
+        logger.log(f'{config.source_root_path}:'
+                   f' {config.source_tree.file_count} files,'
+                   f' {config.source_tree.dir_count} directories')
+    config.workspace_tree = fs_index.FileSystemIndex.build(
+        config.plastic_repo.workspace_root, worker_count,
+        skip_names=['.plastic'])
+    logger.log(f'{config.plastic_repo.workspace_root}:'
+               f' {config.workspace_tree.file_count} files,'
+               f' {config.workspace_tree.dir_count} directories')
+    logger.log(f'Elapsed time {get_elapsed_time(start_timestamp)}')
+    logger.deindent()
+
+
+def extract_source_files(config, jobs, logger):
+    # Index the release archive or git tree, and extract the files that
+    # jobs will copy
+    source_package = config.source_package
+    logger.log(f'Reading release package {source_package.desc}')
+    logger.indent()
+    start_timestamp = time.time()
+    filenames = [filename
+                 for job in jobs
+                 for job_op in job.unprocessed_ops
+                 for filename in job_op.source_filenames]
+    try:
+        source_package.extract(filenames, config.copier, logger)
+    except (archive.ArchiveError, git_source.GitSourceError) as e:
+        logger.log_error(f'Error: {e}')
+        sys.exit(1)
+    logger.log(f'{source_package.desc}:'
+               f' {source_package.tree.file_count} files,'
+               f' {source_package.tree.dir_count} directories')
+    logger.log(f'Extracted {source_package.extracted_count} files'
+               f' ({source_package.extracted_byte_count} bytes)'
+               f' to {source_package.staging_root}')
+    logger.log(f'Elapsed time {get_elapsed_time(start_timestamp)}')
+    logger.deindent()
+
+
+def resume_change_jobs(args, config, logger):
+    logger.log(f'Reading journal {args.journal_file}')
+    try:
+        state = journal.read(args.journal_file)
+    except journal.JournalError as e:
+        logger.log_error(f'Error: {e}')
+        return None
+
+    if state.is_done:
+        logger.log_error(f'Error: {args.journal_file} describes an import'
+                         f' that has already completed')
+        return None
+
+    if state.from_release_tag != config.from_release_tag or \
+            state.to_release_tag != config.to_release_tag:
+        logger.log_error(f'Error: {args.journal_file} describes an import'
+                         f' from {state.from_release_tag}'
+                         f' to {state.to_release_tag}, expected'
+                         f' {config.from_release_tag}'
+                         f' to {config.to_release_tag}')
+        return None
+
+    jobs = ueimporter.job.restore_jobs(
+        state.jobs,
+        plastic_repo=config.plastic_repo,
+        source_root_path=config.source_root_path,
+        pretend=config.pretend,
+        logger=logger,
+        copier=config.copier,
+        source_tree=config.source_tree,
+        workspace_tree=config.workspace_tree,
+        batch_size=config.batch_size,
+        pipelined=config.pipelined,
+        compare_object_ids=config.compare_object_ids)
+
+    logger.indent()
+    for (job, job_state) in zip(jobs, state.jobs):
+        logger.log(f'{job.desc}: {job.processed_op_count}'
+                   f' of {len(job.ops)} ops processed')
+    logger.deindent()
+
+    # A batch that was started but never completed might have been
+    # partially applied. Ops that look like they have already been applied
+    # would fail if processed again, so offer to skip them.
+    for (job, job_state) in zip(jobs, state.jobs):
+        if not job_state.interrupted_batch:
+            continue
+        (start, end) = job_state.interrupted_batch
+        applied_ops = [o for o in job.ops[start:end]
+                       if o.is_applied(config.workspace_tree)]
+        logger.log(SEPARATOR)
+        logger.log(f'{job.desc} batch [{start},{end}) was interrupted,'
+                   f' {len(applied_ops)} of its {end - start} ops appear'
+                   f' to have been applied')
+        if not applied_ops:
+            continue
+
+        logger.indent()
+        for applied_op in applied_ops:
+            for line in str(applied_op).split('\n'):
+                logger.log_warning(line)
+        logger.deindent()
+        logger.log('Please verify their pending changes in plastic.')
+
+        if args.skip_invalid_ops:
+            response = ContinuePromptResponse.CONTINUE
+        else:
+            response = prompt_user_continue(
+                question='Do you want to skip these ops?',
+                logger=logger)
+        if response == ContinuePromptResponse.ABORT:
+            logger.log('Processing them again')
+        else:
+            job.remove_ops(applied_ops)
+            logger.log('Skipping them')
+
+    return jobs
 
 
 def verify_plastic_repo_state(config, logger):
@@ -176,7 +483,12 @@ class Config:
                  to_release_tag,
                  source_root_path,
                  ueimporter_json_filename,
-                 pretend):
+                 pretend,
+                 copier,
+                 batch_size,
+                 pipelined,
+                 source_package,
+                 compare_object_ids):
         self.git_repo = git_repo
         self.plastic_repo = plastic_repo
         self.from_release_tag = from_release_tag
@@ -184,16 +496,36 @@ class Config:
         self.source_root_path = source_root_path
         self.ueimporter_json_filename = ueimporter_json_filename
         self.pretend = pretend
+        self.copier = copier
+        self.batch_size = batch_size
+        self.pipelined = pipelined
+        # ArchiveSource or GitSource when reading the release package from
+        # an archive or the git repo, rather than from a directory
+        self.source_package = source_package
+        # Whether release files have the content of the blobs in the git
+        # repo, which lets jobs compare workspace files with blob ids
+        self.compare_object_ids = compare_object_ids
+        self.source_tree = None
+        self.workspace_tree = None
 
 
 def create_config(args, logger):
-    plastic_repo = plastic.Repo(args.plastic_workspace_root, args.pretend)
+    plastic_repo = plastic.Repo(args.plastic_workspace_root,
+                                args.pretend,
+                                use_shell=args.cm_shell)
     if not plastic_repo.to_workspace_path('.plastic').is_dir():
         logger.log_error(
             f'Error: Failed to find plastic repo at {args.plastic_workspace_root}')
         sys.exit(1)
 
-    git_repo = git.Repo(args.git_repo_root, args.git_command_cache)
+    if args.git_command_cache_size < 1:
+        logger.log_error(
+            f'Error: --git-command-cache-size must be at least 1')
+        sys.exit(1)
+
+    git_repo = git.Repo(args.git_repo_root,
+                        args.git_command_cache,
+                        args.git_command_cache_size * 1024 * 1024)
     if not git_repo.to_repo_path('.git').is_dir():
         logger.log_error(
             f'Error: Failed to find git repo at {args.git_repo_root}')
@@ -218,36 +550,117 @@ def create_config(args, logger):
             f'Error: Please specify a git release tag with --to-release-tag')
         sys.exit(1)
 
-    if not git_repo.rev_list(from_release_tag, logger):
+    git_hashes = git_repo.resolve_refs([from_release_tag,
+                                        args.to_release_tag], logger)
+    if not git_hashes[from_release_tag]:
         logger.log_error(
             f'Error: Failed to find release tag named {from_release_tag}')
         sys.exit(1)
 
-    if not git_repo.rev_list(args.to_release_tag, logger):
+    if not git_hashes[args.to_release_tag]:
         logger.log_error(
             f'Error: Failed to find release tag named {args.to_release_tag}')
         sys.exit(1)
 
-    if not args.zip_package_root.is_dir():
+    if args.copy_workers < 1:
+        logger.log_error(
+            f'Error: --copy-workers must be at least 1')
+        sys.exit(1)
+
+    if args.batch_size < 0:
         logger.log_error(
-            f'Error: Failed to find zip package root {args.zip_package_root}')
+            f'Error: --batch-size must not be negative')
         sys.exit(1)
 
-    source_release_zip_path = args.zip_package_root.joinpath(
-        f'UnrealEngine-{args.to_release_tag }')
-    if not source_release_zip_path.is_dir():
+    if args.job_parallelism < 1:
         logger.log_error(
-            f'Error: Failed to find release zip package'
-            f' {source_release_zip_path}')
+            f'Error: --job-parallelism must be at least 1')
         sys.exit(1)
 
+    if args.validation_workers < 1:
+        logger.log_error(
+            f'Error: --validation-workers must be at least 1')
+        sys.exit(1)
+
+    source_backend = args.source_backend
+    if source_backend == 'auto' and not args.zip_package_root:
+        source_backend = 'git'
+
+    if source_backend != 'git':
+        if not args.zip_package_root:
+            logger.log_error(
+                f'Error: Please specify where release packages are with'
+                f' --zip-package-root')
+            sys.exit(1)
+
+        if not args.zip_package_root.is_dir():
+            logger.log_error(
+                f'Error: Failed to find zip package root'
+                f' {args.zip_package_root}')
+            sys.exit(1)
+
+        source_release_name = f'UnrealEngine-{args.to_release_tag }'
+        source_release_zip_path = args.zip_package_root.joinpath(
+            source_release_name)
+        source_archive_filename = archive.find_archive(
+            args.zip_package_root, source_release_name)
+        if source_backend == 'auto':
+            source_backend = 'archive' \
+                if source_archive_filename and \
+                not source_release_zip_path.is_dir() \
+                else 'directory'
+
+    source_package = None
+    if source_backend == 'directory':
+        if not source_release_zip_path.is_dir():
+            logger.log_error(
+                f'Error: Failed to find release zip package'
+                f' {source_release_zip_path}')
+            sys.exit(1)
+    else:
+        if source_backend == 'archive' and not source_archive_filename:
+            logger.log_error(
+                f'Error: Failed to find release archive'
+                f' {source_release_zip_path}'
+                f'[{"|".join(archive.ARCHIVE_SUFFIXES)}]')
+            sys.exit(1)
+        # Always stage in a new directory, that can be removed afterwards
+        if args.staging_dir:
+            os.makedirs(args.staging_dir, exist_ok=True)
+        staging_dir = Path(tempfile.mkdtemp(prefix='ueimporter-staging-',
+                                            dir=args.staging_dir))
+        if source_backend == 'archive':
+            source_package = archive.ArchiveSource(
+                source_archive_filename,
+                staging_dir,
+                prefix=source_release_name)
+        else:
+            # The commit hash, as the tag might move during the import
+            source_package = git_source.GitSource(
+                git_repo,
+                git_hashes[args.to_release_tag],
+                staging_dir,
+                eol=args.git_source_eol)
+        # Jobs copy the files extracted from the package
+        source_release_zip_path = staging_dir
+
+    # Files read from the git repo with CRLF line endings differ from
+    # their blobs
+    compare_object_ids = not args.no_object_id_compare and \
+        not (source_backend == 'git' and args.git_source_eol == 'crlf')
+
     return Config(git_repo,
                   plastic_repo,
                   from_release_tag,
                   args.to_release_tag,
                   source_release_zip_path,
                   ueimporter_json_filename,
-                  args.pretend)
+                  args.pretend,
+                  copy_engine.CopyEngine(args.copy_workers),
+                  args.batch_size,
+                  not args.no_pipeline,
+                  source_package,
+                  compare_object_ids)
 
 
 def update_ueimporter_json(config, logger):
@@ -298,6 +711,8 @@ def prompt_user_continue(logger,
         legend += 'no]'
 
         logger.log(f'{question} {legend}: ', new_line=False)
+        # The question must be on screen before waiting for an answer
+        logger.flush()
         user_input = input()
         response = user_input_map.get(user_input.lower())
         if response:
@@ -325,6 +740,9 @@ class JobTimeEstimate:
         self._batch_size = batch_size
         self._batch_start_timestamp = time.time()
 
+    def abort_batch(self):
+        self._batch_size = 0
+
     def end_batch(self):
         self._processed_op_count += self._batch_size
         batch_elapsed_time = time.time() - self._batch_start_timestamp
@@ -342,17 +760,23 @@ class JobTimeEstimate:
 
 
 class ProgressListener(ueimporter.job.JobProgressListener):
-    def __init__(self, logger, start_timestamp, total_op_count):
+    def __init__(self, logger, start_timestamp, total_op_count,
+                 processed_op_count=0, buffer_batches=False):
         self._start_timestamp = start_timestamp
         self._logger = logger
         self._total_op_count = total_op_count
-        self._processed_op_count = 0
+        self._processed_op_count = processed_op_count
         self._time_estimates = {}
-        self._active_time_estimate = None
+        # Jobs processed concurrently report batches from different
+        # threads. When buffering, the output of each batch is written
+        # in one go once the batch is done, instead of interleaved.
+        self._buffer_batches = buffer_batches
+        self._lock = threading.Lock()
+        self._local = threading.local()
 
     def register_job(self, job):
         assert job not in self._time_estimates
-        op_count = len(job.ops)
+        op_count = len(job.unprocessed_ops)
         self._time_estimates[job] = JobTimeEstimate(op_count)
 
     def start_batch(self, job, ops):
@@ -360,15 +784,27 @@ class ProgressListener(ueimporter.job.JobProgressListener):
         time_estimate = self._time_estimates.get(job)
         assert time_estimate
         time_estimate.start_batch(batch_size)
-        self._active_time_estimate = time_estimate
+        self._local.active_time_estimate = time_estimate
         remaining_time = self.estimate_remaining_time()
 
         total_elapsed_time = get_elapsed_time(self._start_timestamp)
-        batch_start = self._processed_op_count
+        with self._lock:
+            batch_start = self._processed_op_count
+            self._processed_op_count += batch_size
         batch_end = batch_start + batch_size
-        self._processed_op_count += batch_size
+        self._local.active_batch_size = batch_size
+        self._local.batch_indentation = self._logger.indentation
+        # Spans of batches and steps are only recorded once they end, so
+        # that a failed step never leaves a span open
+        self._local.batch_trace = (f'{job.desc} [{batch_start},{batch_end})',
+                                   trace.timestamp())
+        self._local.step_traces = []
+        if self._buffer_batches:
+            self._logger.start_capture()
         self._logger.log(SEPARATOR)
-        self._logger.log(f'Processing '
+        # Name the job, when batches of several jobs are interleaved
+        job_desc = f'{job.desc.lower()} ' if self._buffer_batches else ''
+        self._logger.log(f'Processing {job_desc}'
                          f'[{batch_start},{batch_end})'
                          f' / {self._total_op_count}'
                          f' - Elapsed {total_elapsed_time}'
@@ -380,19 +816,55 @@ class ProgressListener(ueimporter.job.JobProgressListener):
                 self._logger.log(line)
         self._logger.log('')
 
+    def abort_batch(self):
+        assert self._local.active_time_estimate
+        self._local.active_time_estimate.abort_batch()
+        self._local.active_time_estimate = None
+        with self._lock:
+            self._processed_op_count -= self._local.active_batch_size
+        self._logger.indentation = self._local.batch_indentation
+        self._logger.log('Batch failed')
+        self._flush_batch()
+        self._trace_batch(failed=True)
+
     def end_batch(self):
-        assert self._active_time_estimate
-        batch_elapsed_time = self._active_time_estimate.end_batch()
-        self._active_time_estimate = None
+        assert self._local.active_time_estimate
+        batch_elapsed_time = self._local.active_time_estimate.end_batch()
+        self._local.active_time_estimate = None
         self._logger.deindent()
         self._logger.log('')
         self._logger.log(f'Batch time {batch_elapsed_time}')
+        self._flush_batch()
+        self._trace_batch(failed=False)
+
+    def _trace_batch(self, failed):
+        (name, start_timestamp) = self._local.batch_trace
+        trace.complete(name, 'batch', start_timestamp, failed=failed)
+
+    def _flush_batch(self):
+        if self._buffer_batches:
+            self._logger.replay(self._logger.stop_capture())
+
+    def start_stage(self, desc):
+        self._logger.log(f'{desc}')
+        self._logger.indent()
+
+    def end_stage(self, elapsed_time):
+        self._logger.deindent()
+        elapsed_time = datetime.timedelta(seconds=round(elapsed_time))
+        self._logger.log(f'Stage time {elapsed_time}')
 
     def start_step(self, desc):
         self._logger.log(f'* {desc}')
         self._logger.indent()
+        # Steps of the prepare stage run on other threads than the batch
+        if not hasattr(self._local, 'step_traces'):
+            self._local.step_traces = []
+        self._local.step_traces.append((desc, trace.timestamp()))
 
     def end_step(self):
+        (desc, start_timestamp) = self._local.step_traces.pop()
+        trace.complete(desc, 'step', start_timestamp)
         self._logger.deindent()
 
     def estimate_remaining_time(self):
@@ -402,45 +874,14 @@ class ProgressListener(ueimporter.job.JobProgressListener):
         return remaining_time
 
 
-def main():
-    parser = create_parser()
-    args = parser.parse_args()
-
-    log_level = LogLevel.from_string(args.log_level)
-    logger = Logger(args.log_file, log_level)
-    config = create_config(args, logger)
-
-    if not config.pretend and not verify_plastic_repo_state(config, logger):
-        return 1
-
-    if not path_util.is_directory_on_case_sensitive_filesystem(
-            config.plastic_repo.workspace_root):
-        logger.log_warning('Warning: Case insensitive filesystem detected.\n'
-                           'ueimporter has no way of correctly replicating'
-                           ' case changes of files and directories from git.\n'
-                           'You are advised to run ueimporter from an OS'
-                           ' with a case sensitive file system instead'
-                           ', such as Linux.')
-
-        response = prompt_user_continue(
-            question='Do you want to continue anyway?',
-            logger=logger)
-        if response == ContinuePromptResponse.ABORT:
-            logger.log("Aborting")
-            return 1
-        else:
-            logger.log('Beware, yonder there be dragons.')
-
-    start_timestamp = time.time()
-    jobs = read_change_jobs(config, logger)
-    logger.log(f'Processing {len(jobs)} jobs')
-
+def skip_invalid_ops(jobs, args, logger):
+    # Returns the number of skipped ops, or None if the user aborted
     logger.log(f'Validating ops')
     skip_all_invalid_ops = args.skip_invalid_ops
     invalid_ops = []
     invalid_op_count = 0
     for job in jobs:
-        ops = job.find_invalid_ops()
+        ops = job.find_invalid_ops(args.validation_workers)
         invalid_ops.append((job, ops))
         invalid_op_count += len(ops)
 
@@ -448,6 +889,7 @@ def main():
         logger.indent()
         logger.log(f'Found {invalid_op_count} invalid ops')
         for job, ops in invalid_ops:
+            skipped_ops = []
             for (op, err) in ops:
                 logger.log(SEPARATOR)
                 logger.log_error(f'{op}')
@@ -464,17 +906,122 @@ def main():
 
                 if response == ContinuePromptResponse.ABORT:
                     logger.log("Aborting")
-                    return 1
+                    return None
                 elif response == ContinuePromptResponse.CONTINUE or \
                         response == ContinuePromptResponse.CONTINUE_ALWAYS:
-                    job.remove_op(op)
+                    skipped_ops.append(op)
                     logger.log("Skipping operation")
                     skip_all_invalid_ops = \
                         response == ContinuePromptResponse.CONTINUE_ALWAYS
                 logger.deindent()
+            job.remove_ops(skipped_ops)
 
         logger.deindent()
 
+    return invalid_op_count
+
+
+def main():
+    # 'ueimporter verify ...' compares a workspace with a release, any other
+    # command line imports a release
+    if len(sys.argv) > 1 and sys.argv[1] == verify.COMMAND_NAME:
+        return verify.main(sys.argv[2:])
+
+    parser = create_parser()
+    args = parser.parse_args()
+
+    if args.log_file_max_size < 0 or args.log_file_backups < 0:
+        parser.error('--log-file-max-size and --log-file-backups must not'
+                     ' be negative')
+
+    log_level = LogLevel.from_string(args.log_level)
+    logger = Logger(args.log_file, log_level,
+                    log_file_level=LogLevel.from_string(args.log_file_level),
+                    log_file_max_size=args.log_file_max_size * 1024 * 1024,
+                    log_file_backup_count=args.log_file_backups,
+                    compress_log_files=args.compress_log_files)
+    if args.trace_file:
+        trace.start(args.trace_file)
+    try:
+        try:
+            with trace.span('Configure', 'phase'):
+                config = create_config(args, logger)
+        except ueimporter.CommandError as e:
+            return log_command_error(e, logger)
+        return run_import(args, config, logger)
+    finally:
+        trace.stop()
+        logger.close()
+
+
+def log_command_error(error, logger):
+    # Returns the return code ueimporter exits with
+    logger.log_error(f'Error: {error}')
+    return error.returncode if error.returncode != 0 else 1
+
+
+def run_import(args, config, logger):
+    config.plastic_repo.start_shell(logger)
+    try:
+        return import_release(args, config, logger)
+    except ueimporter.CommandError as e:
+        return log_command_error(e, logger)
+    finally:
+        config.copier.close()
+        config.plastic_repo.close()
+        if config.source_package:
+            config.source_package.close()
+
+
+def import_release(args, config, logger):
+    # A resumed import has pending changes from the interrupted run,
+    # and might already have checked out a newer Build.version
+    if not config.pretend and not args.resume and \
+            not verify_plastic_repo_state(config, logger):
+        return 1
+
+    if not path_util.is_directory_on_case_sensitive_filesystem(
+            config.plastic_repo.workspace_root):
+        logger.log_warning('Warning: Case insensitive filesystem detected.\n'
+                           'ueimporter has no way of correctly replicating'
+                           ' case changes of files and directories from git.\n'
+                           'You are advised to run ueimporter from an OS'
+                           ' with a case sensitive file system instead'
+                           ', such as Linux.')
+
+        response = prompt_user_continue(
+            question='Do you want to continue anyway?',
+            logger=logger)
+        if response == ContinuePromptResponse.ABORT:
+            logger.log("Aborting")
+            return 1
+        else:
+            logger.log('Beware, yonder there be dragons.')
+
+    start_timestamp = time.time()
+    with trace.span('Index file systems', 'phase'):
+        index_file_systems(config, args.validation_workers, logger)
+    if args.resume:
+        with trace.span('Resume jobs', 'phase'):
+            jobs = resume_change_jobs(args, config, logger)
+        if jobs is None:
+            return 1
+    else:
+        with trace.span('Read changes and plan jobs', 'phase'):
+            jobs = read_change_jobs(config, logger)
+    if config.source_package:
+        with trace.span('Extract release package', 'phase'):
+            extract_source_files(config, jobs, logger)
+    logger.log(f'Processing {len(jobs)} jobs')
+
+    if args.resume:
+        invalid_op_count = 0
+    else:
+        with trace.span('Validate ops', 'phase'):
+            invalid_op_count = skip_invalid_ops(jobs, args, logger)
+        if invalid_op_count is None:
+            return 1
+
     job_op_counts = {}
     for job in jobs:
         op_count = job_op_counts.get(job.__class__, 0)
@@ -493,6 +1040,13 @@ def main():
         line = f'(Skip: {invalid_op_count} invalid ops)'
         logger.log(line)
         max_line_length = max(len(line), max_line_length)
+        for job in jobs:
+            if job.elided_op_count == 0:
+                continue
+            line = f'(Elided: {job.elided_op_count} {job.desc.lower()} ops' \
+                ' already identical to source)'
+            logger.log(line)
+            max_line_length = max(len(line), max_line_length)
         logger.log('=' * max_line_length)
         logger.log(f'{total_op_count} ops in total')
         logger.deindent()
@@ -506,29 +1060,91 @@ def main():
             job.trim_trailing_ops(MAX_OPS_PER_JOB)
 
     total_op_count = sum([len(j.ops) for j in jobs])
+    processed_op_count = sum([j.processed_op_count for j in jobs])
     progress_listener = ProgressListener(
-        logger, start_timestamp, total_op_count)
-
-    # Register jobs and process one batch each, to seed time estimates with
-    # real world measurements
-    for job in jobs:
-        progress_listener.register_job(job)
-        job.process(BATCH_SIZE, BATCH_SIZE, progress_listener)
-
-    # Process the rest of ops for each job in turn
-    for job in jobs:
-        job.process(BATCH_SIZE, -1, progress_listener)
+        logger, start_timestamp, total_op_count, processed_op_count,
+        buffer_batches=args.job_parallelism > 1)
+
+    job_scheduler = None
+    if args.job_parallelism > 1:
+        job_scheduler = scheduler.JobScheduler(jobs,
+                                               config.workspace_tree,
+                                               args.job_parallelism)
+        logger.log(f'Processing up to {args.job_parallelism} jobs'
+                   f' concurrently, {job_scheduler.dependent_op_count}'
+                   f' ops depend on ops of earlier jobs')
+
+    import_journal = None
+    if not config.pretend:
+        import_journal = journal.Journal.create(args.journal_file,
+                                                config.from_release_tag,
+                                                config.to_release_tag,
+                                                jobs)
+
+    # The first Ctrl-C lets the current batch finish, so that the journal
+    # describes the state of the workspace. The second one aborts at once.
+    stop_event = threading.Event()
+
+    def request_stop(signum, frame):
+        if stop_event.is_set():
+            raise KeyboardInterrupt()
+        stop_event.set()
+        logger.log_warning('Interrupted, stopping after the current batch.'
+                           ' Press Ctrl-C again to abort immediately')
+
+    previous_sigint_handler = signal.signal(signal.SIGINT, request_stop)
+    try:
+        with trace.span('Process jobs', 'phase'):
+            if job_scheduler:
+                for job in jobs:
+                    progress_listener.register_job(job)
+                job_scheduler.run(progress_listener, import_journal,
+                                  stop_event)
+            else:
+                # Register jobs and process one batch each, to seed time
+                # estimates with real world measurements
+                for job in jobs:
+                    progress_listener.register_job(job)
+                    job.process(job.batcher.size, progress_listener,
+                                import_journal, stop_event)
+
+                # Process the rest of ops for each job in turn
+                for job in jobs:
+                    job.process(-1, progress_listener, import_journal,
+                                stop_event)
+    finally:
+        signal.signal(signal.SIGINT, previous_sigint_handler)
+        if import_journal:
+            import_journal.close()
+
+    if stop_event.is_set():
+        logger.log(SEPARATOR)
+        logger.log(f'Stopped. Progress has been saved to'
+                   f' {args.journal_file}, run again with --resume'
+                   f' to continue')
+        return 130
 
     logger.log(SEPARATOR)
     logger.log(f'Updating {config.ueimporter_json_filename}'
                f' with release tag {config.to_release_tag}')
 
-    update_ueimporter_json(config, logger)
+    with trace.span('Update ueimporter json', 'phase'):
+        update_ueimporter_json(config, logger)
     logger.log('')
 
+    if not config.pretend:
+        import_journal = journal.Journal.reopen(args.journal_file, jobs)
+        import_journal.record_done()
+        import_journal.close()
+
     logger.log(SEPARATOR)
     logger.log('Summary')
     print_stats()
+    logger.log('Batches')
+    logger.indent()
+    for job in jobs:
+        logger.log(f'{job.desc}: {job.batcher}')
+    logger.deindent()
     total_elapsed_time = get_elapsed_time(start_timestamp)
     logger.log(f'Total elapsed time {total_elapsed_time}')
 
@@ -1,5 +1,6 @@
 import re
 
+import ueimporter.git as git
 import ueimporter.path_util as path_util
 
 
@@ -37,6 +38,8 @@ class OpValidation:
 
 
 class Operation:
+    __slots__ = ('_change',)
+
     def __init__(self, change):
         self._change = change
 
@@ -47,47 +50,176 @@ class Operation:
     def filename(self):
         return self._change.filename
 
-    def validate(self, source_root, target_root):
+    @property
+    def change(self):
+        return self._change
+
+    @property
+    def input_size(self):
+        # Approximate number of bytes this op adds to cm input
+        return len(self._change.filename_str) + 1
+
+    @property
+    def source_filenames(self):
+        # Files this op copies from the release package
+        return [self.filename]
+
+    def validate(self, source_tree, target_tree):
+        # Trees are FileSystemIndex or DiskTree instances, rooted in the
+        # release package and plastic workspace respectively
         assert False, f'{self.__class__} does not implement validate()'
 
+    def is_applied(self, target_tree):
+        # Whether the workspace looks like this op has already been
+        # processed. Used to inspect batches interrupted by a crash.
+        return False
+
+    def to_record(self):
+        return [type(self._change).__name__,
+                to_raw_record(self._change.raw),
+                self._change.filename_str]
+
 
 class AddOp(Operation):
+    __slots__ = ()
+
     def __init__(self, change):
         Operation.__init__(self, change)
 
-    def validate(self, source_root, target_root):
-        if not source_root.joinpath(self.filename).is_file():
-            return OpValidation.invalid_not_exist(self.filename, source_root)
-        if target_root.joinpath(self.filename).is_file():
-            return OpValidation.invalid_exist(self.filename, target_root)
+    def validate(self, source_tree, target_tree):
+        if not source_tree.is_file(self.filename):
+            return OpValidation.invalid_not_exist(
+                self.filename, source_tree.root)
+        if target_tree.is_file(self.filename):
+            return OpValidation.invalid_exist(
+                self.filename, target_tree.root)
+        return OpValidation.valid()
+
+    def is_applied(self, target_tree):
+        # Files are copied before they are added to plastic, so a file on
+        # disc might still be private. Copying and adding a private file
+        # again is safe, so adds are always processed again.
+        return False
+
+
+class AddDirOp(AddOp):
+    __slots__ = ()
+
+    def __init__(self, change):
+        AddOp.__init__(self, change)
+
+    @property
+    def adds(self):
+        return self._change.adds
+
+    @property
+    def source_filenames(self):
+        return [add.filename for add in self._change.adds]
+
+    def to_record(self):
+        return AddOp.to_record(self) + \
+            [[[to_raw_record(a.raw), a.filename_str]
+              for a in self._change.adds]]
+
+    def validate(self, source_tree, target_tree):
+        for add in self._change.adds:
+            if not source_tree.is_file(add.filename):
+                return OpValidation.invalid_not_exist(
+                    add.filename, source_tree.root)
+        if target_tree.is_dir(self.filename) or \
+                target_tree.is_file(self.filename):
+            return OpValidation.invalid_exist(
+                self.filename, target_tree.root)
         return OpValidation.valid()
 
 
 class DeleteOp(Operation):
+    __slots__ = ()
+
     def __init__(self, change):
         Operation.__init__(self, change)
 
-    def validate(self, source_root, target_root):
-        if source_root.joinpath(self.filename).is_file():
-            return OpValidation.invalid_exist(self.filename, source_root)
-        if not target_root.joinpath(self.filename).is_file():
-            return OpValidation.invalid_not_exist(self.filename, target_root)
+    @property
+    def source_filenames(self):
+        return []
+
+    def validate(self, source_tree, target_tree):
+        if source_tree.is_file(self.filename):
+            return OpValidation.invalid_exist(
+                self.filename, source_tree.root)
+        if not target_tree.is_file(self.filename):
+            return OpValidation.invalid_not_exist(
+                self.filename, target_tree.root)
+        return OpValidation.valid()
+
+    def is_applied(self, target_tree):
+        return not target_tree.is_file(self.filename)
+
+
+class DeleteDirOp(DeleteOp):
+    __slots__ = ()
+
+    def __init__(self, change):
+        DeleteOp.__init__(self, change)
+
+    @property
+    def deletes(self):
+        return self._change.deletes
+
+    def is_applied(self, target_tree):
+        return not target_tree.is_dir(self.filename)
+
+    def to_record(self):
+        return DeleteOp.to_record(self) + \
+            [[[to_raw_record(d.raw), d.filename_str]
+              for d in self._change.deletes]]
+
+    def validate(self, source_tree, target_tree):
+        deleted_filenames = set()
+        for delete in self._change.deletes:
+            if source_tree.is_file(delete.filename):
+                return OpValidation.invalid_exist(
+                    delete.filename, source_tree.root)
+            deleted_filenames.add(delete.filename)
+        if not target_tree.is_dir(self.filename):
+            return OpValidation.invalid(
+                f'Directory {self.filename} does not exist'
+                f' in {target_tree.root}')
+        # cm remove takes everything below the directory along with it,
+        # including files that are not part of the diff
+        workspace_file_count = 0
+        for filename in target_tree.iter_files(self.filename):
+            if filename not in deleted_filenames:
+                return OpValidation.invalid(
+                    f'{filename} is not deleted along with {self.filename}'
+                    f' in {target_tree.root}')
+            workspace_file_count += 1
+        if workspace_file_count != len(deleted_filenames):
+            return OpValidation.invalid(
+                f'Not all files deleted from {self.filename}'
+                f' exist in {target_tree.root}')
         return OpValidation.valid()
 
 
 class ModifyOp(Operation):
+    __slots__ = ()
+
     def __init__(self, change):
         Operation.__init__(self, change)
 
-    def validate(self, source_root, target_root):
-        if not source_root.joinpath(self.filename).is_file():
-            return OpValidation.invalid_not_exist(self.filename, source_root)
-        if not target_root.joinpath(self.filename).is_file():
-            return OpValidation.invalid_not_exist(self.filename, target_root)
+    def validate(self, source_tree, target_tree):
+        if not source_tree.is_file(self.filename):
+            return OpValidation.invalid_not_exist(
+                self.filename, source_tree.root)
+        if not target_tree.is_file(self.filename):
+            return OpValidation.invalid_not_exist(
+                self.filename, target_tree.root)
         return OpValidation.valid()
 
 
 class MoveOp(Operation):
+    __slots__ = ()
+
     def __init__(self, change):
         Operation.__init__(self, change)
 
@@ -95,18 +227,35 @@ class MoveOp(Operation):
     def target_filename(self):
         return self._change.target_filename
 
-    def validate(self, source_root, target_root):
+    @property
+    def input_size(self):
+        return len(self._change.filename_str) + \
+            len(self._change.target_filename_str) + 2
+
+    @property
+    def source_filenames(self):
+        return [self.target_filename]
+
+    def is_applied(self, target_tree):
+        return not target_tree.is_file(self.filename) and \
+            target_tree.is_file(self.target_filename)
+
+    def to_record(self):
+        return Operation.to_record(self) + \
+            [self._change.target_filename_str]
+
+    def validate(self, source_tree, target_tree):
         if self.filename == self.target_filename:
             return OpValidation.invalid(
                 f'{self.filename} is moved to the same file')
-        if not source_root.joinpath(self.target_filename).is_file():
+        if not source_tree.is_file(self.target_filename):
             return OpValidation.invalid_not_exist(
                 self.target_filename,
-                source_root)
+                source_tree.root)
         source_exist_in_target = \
-            target_root.joinpath(self.filename).is_file()
+            target_tree.is_file(self.filename)
         target_exist_in_target = \
-            target_root.joinpath(self.target_filename).is_file()
+            target_tree.is_file(self.target_filename)
         if not source_exist_in_target and not target_exist_in_target:
             # Even though the source file does not exist in the target root,
             # we might still have a valid move, if the target file
@@ -114,7 +263,7 @@ class MoveOp(Operation):
             # but the contents of the file will be copied from source.
             return OpValidation.invalid_not_exist(
                 self.filename,
-                target_root)
+                target_tree.root)
         if target_exist_in_target and source_exist_in_target:
             # Even though the target file already exist in the target root,
             # we might still have a valid move, if the source file
@@ -122,6 +271,90 @@ class MoveOp(Operation):
             # but the contents of the file will be copied from source.
             return OpValidation.invalid_exist(
                 self.target_filename,
-                source_root)
+                source_tree.root)
 
         return OpValidation.valid()
+
+
+class MoveDirOp(MoveOp):
+    __slots__ = ()
+
+    def __init__(self, change):
+        MoveOp.__init__(self, change)
+
+    @property
+    def moves(self):
+        return self._change.moves
+
+    @property
+    def target_filenames(self):
+        return [move.target_filename for move in self._change.moves]
+
+    @property
+    def source_filenames(self):
+        return self.target_filenames
+
+    def is_applied(self, target_tree):
+        return not target_tree.is_dir(self.filename) and \
+            target_tree.is_dir(self.target_filename)
+
+    def to_record(self):
+        return MoveOp.to_record(self) + \
+            [[[to_raw_record(m.raw), m.filename_str,
+               m.target_filename_str]
+              for m in self._change.moves]]
+
+    def validate(self, source_tree, target_tree):
+        for move in self._change.moves:
+            if not source_tree.is_file(move.target_filename):
+                return OpValidation.invalid_not_exist(
+                    move.target_filename, source_tree.root)
+        if not target_tree.is_dir(self.filename):
+            return OpValidation.invalid(
+                f'Directory {self.filename} does not exist'
+                f' in {target_tree.root}')
+        if target_tree.is_dir(self.target_filename) or \
+                target_tree.is_file(self.target_filename):
+            return OpValidation.invalid(
+                f'{self.target_filename} already exist'
+                f' in {target_tree.root}')
+        return OpValidation.valid()
+
+
+def to_raw_record(raw):
+    # Modes and blob ids are kept, so that resumed ops skip identical files
+    # and change modes like the ops of the interrupted import
+    if raw is None:
+        return None
+    return [raw.old_mode, raw.new_mode, raw.old_object_id,
+            raw.new_object_id]
+
+
+def from_raw_record(record):
+    return git.RawDiff(*record) if record else None
+
+
+def from_record(record):
+    """Recreates an op from the output of Operation.to_record()"""
+    change_type = record[0]
+    raw = from_raw_record(record[1])
+    if change_type == 'Add':
+        return AddOp(git.Add(record[2], raw))
+    elif change_type == 'AddDir':
+        adds = [git.Add(f, from_raw_record(r)) for (r, f) in record[3]]
+        return AddDirOp(git.AddDir(record[2], adds))
+    elif change_type == 'Delete':
+        return DeleteOp(git.Delete(record[2], raw))
+    elif change_type == 'DeleteDir':
+        deletes = [git.Delete(f, from_raw_record(r))
+                   for (r, f) in record[3]]
+        return DeleteDirOp(git.DeleteDir(record[2], deletes))
+    elif change_type == 'Modify':
+        return ModifyOp(git.Modify(record[2], raw))
+    elif change_type == 'Move':
+        return MoveOp(git.Move(record[2], record[3], raw))
+    elif change_type == 'MoveDir':
+        moves = [git.Move(f, t, from_raw_record(r))
+                 for (r, f, t) in record[4]]
+        return MoveDirOp(git.MoveDir(record[2], record[3], moves))
+    raise ValueError(f'Unrecognized op record {record}')
@@ -1,3 +1,5 @@
+import collections
+
 from pathlib import PurePosixPath
 
 
@@ -15,6 +17,24 @@ def commonpath(filename, target_filename):
         return None
 
 
+def iter_parent_strs(filename):
+    # Yields all ancestors of a relative posix path string, closest first
+    separator = filename.rfind('/')
+    while separator > 0:
+        filename = filename[:separator]
+        yield filename
+        separator = filename.rfind('/')
+
+
+def count_per_ancestor(filenames):
+    # Maps each directory to the number of filenames below it
+    counts = collections.Counter()
+    for filename in filenames:
+        for directory in iter_parent_strs(filename):
+            counts[directory] += 1
+    return counts
+
+
 def is_directory_on_case_sensitive_filesystem(directory):
     assert directory.is_dir()
 
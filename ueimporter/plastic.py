@@ -1,14 +1,206 @@
+import fnmatch
+import subprocess
+import threading
+
 import ueimporter
+from ueimporter import trace
+
+
+class ShellTerminatedError(ueimporter.CommandError):
+    """Raised when cm shell terminates while running a command, which
+    might have been partly applied"""
+    pass
+
+
+def quote_shell_argument(argument):
+    argument = str(argument)
+    if argument and not any(c.isspace() or c in '"\\' for c in argument):
+        return argument
+    # Backslashes are escaped first, so that a trailing backslash does not
+    # escape the closing quote
+    escaped = argument.replace('\\', '\\\\').replace('"', '\\"')
+    return f'"{escaped}"'
+
+
+class Shell:
+    # 'cm shell' terminates the output of each command with a line
+    # holding the return code of that command
+    RESULT_PREFIX = 'CommandResult '
+    # Seconds without new lines on STDERR after which the errors of a
+    # command are considered complete
+    STDERR_QUIET_TIME = 0.01
+
+    def __init__(self, workspace_root):
+        self._workspace_root = workspace_root
+        self._process = None
+        self._stderr_lines = []
+        self._stderr_condition = threading.Condition()
+        self._stderr_thread = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_running(self):
+        return self._process is not None and self._process.poll() is None
+
+    def start(self, logger):
+        logger.log_verbose('cm shell')
+        try:
+            self._process = subprocess.Popen(
+                ['cm', 'shell'],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                encoding='utf-8',
+                bufsize=1,
+                cwd=self._workspace_root,
+                **ueimporter.get_child_process_kwargs())
+        except OSError as e:
+            logger.log_warning(f'Warning: Failed to start cm shell: {e}')
+            self._process = None
+            return False
+
+        self._stderr_thread = threading.Thread(target=self._read_stderr,
+                                               daemon=True)
+        self._stderr_thread.start()
+
+        # Make sure the shell is responsive before we start to rely on it
+        returncode, _, stderr, _ = self._execute(['version'])
+        if returncode != 0:
+            logger.log_warning(f'Warning: cm shell is not responding'
+                               f' (returncode {returncode})')
+            if stderr:
+                logger.log_warning(stderr)
+            self.close()
+            return False
+        return True
+
+    def close(self):
+        if not self._process:
+            return
+        if self._process.poll() is None:
+            try:
+                self._process.stdin.write('exit\n')
+                self._process.stdin.flush()
+                self._process.stdin.close()
+                self._process.wait(timeout=10)
+            except (OSError, ValueError, subprocess.TimeoutExpired):
+                self._process.kill()
+        self._process = None
+
+    def run(self, arguments, logger, path_count=0):
+        command = ['cm'] + arguments
+        with trace.span(trace.command_name(command), 'cm shell',
+                        **trace.command_args(command, path_count)):
+            returncode, stdout, stderr, is_terminated = \
+                self._execute(arguments)
+        if is_terminated:
+            # Not logged as an error, the caller decides whether to run
+            # the command again without the shell
+            raise ShellTerminatedError(command, returncode, stderr)
+        if returncode != 0 or stderr:
+            logger.log_error(f'Error: returncode {returncode}')
+            logger.log_error(stderr)
+            raise ueimporter.CommandError(['cm'] + arguments,
+                                          returncode, stderr)
+        return stdout
+
+    def _execute(self, arguments):
+        # Returns the return code, STDOUT and STDERR of the command, and
+        # whether the shell terminated while running it
+        command_line = ' '.join([quote_shell_argument(a) for a in arguments])
+        with self._lock:
+            with self._stderr_condition:
+                self._stderr_lines.clear()
+            try:
+                self._process.stdin.write(command_line + '\n')
+                self._process.stdin.flush()
+            except (OSError, ValueError):
+                return (-1, '', 'cm shell terminated unexpectedly', True)
+
+            stdout_lines = []
+            returncode = None
+            for line in self._process.stdout:
+                if line.startswith(Shell.RESULT_PREFIX):
+                    returncode = int(line[len(Shell.RESULT_PREFIX):].strip())
+                    break
+                stdout_lines.append(line)
+
+            stderr = self._drain_stderr()
+            # STDOUT ended without a CommandResult line
+            is_terminated = returncode is None or \
+                self._process.poll() is not None
+            if returncode is None:
+                returncode = -1
+                if not stderr:
+                    stderr = 'cm shell terminated unexpectedly'
+            return (returncode, ''.join(stdout_lines), stderr,
+                    is_terminated)
+
+    def _drain_stderr(self):
+        # cm writes the errors of a command before its CommandResult line,
+        # but STDERR is read on another thread, and the lines might not
+        # have been read yet. Wait for STDERR to go quiet, so that they are
+        # not blamed on the next command.
+        with self._stderr_condition:
+            line_count = -1
+            while line_count != len(self._stderr_lines):
+                line_count = len(self._stderr_lines)
+                self._stderr_condition.wait(Shell.STDERR_QUIET_TIME)
+            stderr = ''.join(self._stderr_lines)
+            self._stderr_lines.clear()
+        return stderr
+
+    def _read_stderr(self):
+        for line in self._process.stderr:
+            with self._stderr_condition:
+                self._stderr_lines.append(line)
+                self._stderr_condition.notify_all()
 
 
 class Repo:
-    def __init__(self, workspace_root, pretend):
+    # Upper bounds on the number of path bytes passed to a single command,
+    # via STDIN or as arguments to a cm shell command respectively
+    STDIN_BYTE_BUDGET = 256 * 1024
+    SHELL_ARGUMENT_BYTE_BUDGET = 32 * 1024
+    # Commands that are run again without the shell, if the shell
+    # terminates while running them. Moves and removes that were partly
+    # applied would fail if repeated, those are left to the caller.
+    REPEATABLE_COMMANDS = ('add', 'checkout', 'status')
+
+    def __init__(self, workspace_root, pretend, use_shell=False):
         self.workspace_root = workspace_root
         self.pretend = pretend
+        self.use_shell = use_shell
+        self._shell = None
 
     def to_workspace_path(self, path):
         return self.workspace_root.joinpath(path)
 
+    @property
+    def input_byte_budget(self):
+        if self._shell:
+            return Repo.SHELL_ARGUMENT_BYTE_BUDGET
+        return Repo.STDIN_BYTE_BUDGET
+
+    def start_shell(self, logger):
+        # Keep a single 'cm shell' process alive for the whole import,
+        # instead of paying the cm startup cost for every command.
+        # Falls back to one process per command if the shell fails to start.
+        if not self.use_shell or self.pretend or self._shell:
+            return
+        shell = Shell(self.workspace_root)
+        if shell.start(logger):
+            self._shell = shell
+        else:
+            logger.log_warning('Warning: Falling back to one cm process'
+                               ' per command')
+            self.use_shell = False
+
+    def close(self):
+        if self._shell:
+            self._shell.close()
+            self._shell = None
+
     def is_workspace_clean(self, logger):
         arguments = ['status',
                      '--machinereadable']
@@ -36,6 +228,10 @@ class Repo:
     def add_multiple(self, paths, logger):
         return self.run_cmd(['add'], logger, paths)
 
+    def add_recursive_multiple(self, paths, logger):
+        # Adds directories along with everything below them
+        return self.run_cmd(['add', '-R'], logger, paths)
+
     def remove_multiple(self, paths, logger):
         return self.run_cmd(['remove'], logger, paths)
 
@@ -45,38 +241,137 @@ class Repo:
     def move_multiple(self, from_to_path_pairs, logger):
         # Unfortunately, we have to process each move as
         # separate commands, as 'cm move' does not support
-        # passing input via STDIN
+        # passing input via STDIN. With a cm shell running this is cheap,
+        # as no new process is spawned per move
         for (from_p, to_p) in from_to_path_pairs:
             self.move(from_p, to_p, logger)
 
     def run_cmd(self, arguments, logger, paths=None):
         command = ['cm'] + arguments
 
-        if paths:
+        # The shell reads commands from STDIN, so paths are passed
+        # as arguments instead
+        use_shell = self._shell is not None
+        if paths and not use_shell:
             command.append('-')
 
-        logger.log_verbose(' '.join([str(s) for s in command]))
+        logger.log_verbose(lambda: ' '.join([str(s) for s in command]))
 
         input_lines = [str(p) for p in paths] if paths else None
-        if input_lines:
-            logger.log_debug('STDIN:')
+        # Batches pass thousands of paths, only log them when asked to
+        is_debug_enabled = logger.is_enabled(ueimporter.LogLevel.DEBUG)
+        if input_lines and is_debug_enabled:
+            logger.log_debug('STDIN:' if not use_shell else 'ARGUMENTS:')
             logger.indent()
-            for line in input_lines:
-                logger.log_debug(line)
+            logger.log_debug_lines(input_lines)
             logger.deindent()
 
         if self.pretend:
             return ''
 
-        stdout = ueimporter.run(command,
-                                logger,
-                                cwd=self.workspace_root,
-                                input_lines=input_lines)
+        if use_shell:
+            try:
+                stdout = self._shell.run(arguments + (input_lines or []),
+                                         logger,
+                                         path_count=len(input_lines or []))
+            except ShellTerminatedError as e:
+                # Retrying against a dead shell would fail every time
+                logger.log_warning('Warning: cm shell terminated'
+                                   ' unexpectedly, falling back to one cm'
+                                   ' process per command')
+                self.close()
+                self.use_shell = False
+                if arguments[0] not in Repo.REPEATABLE_COMMANDS:
+                    logger.log_error(f'Error: {e}')
+                    logger.log_error(e.stderr)
+                    raise
+                return self.run_cmd(arguments, logger, paths)
+        else:
+            stdout = ueimporter.run(command,
+                                    logger,
+                                    cwd=self.workspace_root,
+                                    input_lines=input_lines)
 
-        logger.indent()
-        for line in stdout.split('\n'):
-            if len(line) > 0:
-                logger.log_debug(line)
-        logger.deindent()
+        if is_debug_enabled:
+            logger.indent()
+            logger.log_debug_lines([line for line in stdout.split('\n')
+                                    if len(line) > 0])
+            logger.deindent()
 
         return stdout
+
+
+class IgnoreRule:
+    __slots__ = ('pattern', 'is_exception', 'is_path', 'is_dir_only')
+
+    def __init__(self, line):
+        self.is_exception = line.startswith('!')
+        if self.is_exception:
+            line = line[1:]
+        self.is_dir_only = line.endswith('/')
+        line = line.rstrip('/')
+        # Rules holding a slash match paths relative to the workspace root,
+        # other rules match the name of an item anywhere in the workspace
+        self.is_path = '/' in line
+        self.pattern = line.lstrip('/')
+
+    def matches(self, key, is_dir):
+        if self.is_dir_only and not is_dir:
+            return False
+        name = key if self.is_path else key[key.rfind('/') + 1:]
+        return fnmatch.fnmatchcase(name, self.pattern)
+
+
+class IgnoreRules:
+    """Rules of a plastic ignore.conf file, telling which workspace items
+    are kept out of version control. Items below an ignored directory are
+    ignored too, unless they, or a directory above them, match an
+    exception rule starting with '!'."""
+
+    FILENAME = 'ignore.conf'
+
+    def __init__(self, lines=()):
+        self._rules = []
+        self._exceptions = []
+        for line in lines:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            rule = IgnoreRule(line)
+            if not rule.pattern:
+                continue
+            if rule.is_exception:
+                self._exceptions.append(rule)
+            else:
+                self._rules.append(rule)
+
+    @classmethod
+    def read(cls, workspace_root):
+        filename = workspace_root.joinpath(IgnoreRules.FILENAME)
+        if not filename.is_file():
+            return IgnoreRules()
+        return IgnoreRules(filename.read_text(encoding='utf-8').splitlines())
+
+    @property
+    def has_exceptions(self):
+        return len(self._exceptions) > 0
+
+    def is_ignored(self, key, is_dir):
+        """Returns True if the item at key, a path relative to the
+        workspace root, is ignored"""
+        if not self._rules:
+            return False
+        is_ignored = False
+        is_excepted = False
+        parts = key.split('/')
+        for i in range(1, len(parts) + 1):
+            # All items above key are directories
+            sub_key = '/'.join(parts[:i])
+            sub_is_dir = is_dir or i < len(parts)
+            if not is_ignored:
+                is_ignored = any(r.matches(sub_key, sub_is_dir)
+                                 for r in self._rules)
+            if not is_excepted:
+                is_excepted = any(r.matches(sub_key, sub_is_dir)
+                                  for r in self._exceptions)
+        return is_ignored and not is_excepted
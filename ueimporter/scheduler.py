@@ -0,0 +1,214 @@
+import bisect
+import collections
+import concurrent.futures
+import threading
+
+import ueimporter.op as op
+import ueimporter.path_util as path_util
+
+
+def find_created_region(filename, workspace_tree):
+    # Highest directory that has to be created to hold filename,
+    # or filename itself if its parent already exists
+    region = filename
+    for directory in path_util.iter_parent_strs(filename):
+        if workspace_tree.is_dir(directory):
+            break
+        region = directory
+    return region
+
+
+def find_removed_region(filename, removed_counts, file_counts):
+    # Highest directory that might be left empty, and thus be removed,
+    # once filename is gone. filename itself if no directory will be.
+    region = filename
+    for directory in path_util.iter_parent_strs(filename):
+        file_count = file_counts[directory]
+        if file_count == 0 or removed_counts[directory] < file_count:
+            break
+        region = directory
+    return region
+
+
+class RegionMap:
+    """Regions touched by the ops of a job, mapped to the index of the
+    last op touching them. A region is the path of a file or directory,
+    and covers everything below it."""
+
+    def __init__(self):
+        self._last_at = {}
+        self._last_at_or_below = {}
+
+    def add(self, region, op_index):
+        # Ops are added in order, so the last index is the highest one
+        self._last_at[region] = op_index
+        self._last_at_or_below[region] = op_index
+        for directory in path_util.iter_parent_strs(region):
+            self._last_at_or_below[directory] = op_index
+
+    def find_last_overlap(self, region):
+        # Regions overlap if one of them is at or below the other
+        last = self._last_at_or_below.get(region, -1)
+        for directory in path_util.iter_parent_strs(region):
+            last = max(last, self._last_at.get(directory, -1))
+        return last
+
+
+class JobScheduler:
+    """Processes jobs concurrently, one thread per job, while keeping the
+    order between ops that touch the same files or directories.
+
+    Each op is assigned the regions of the workspace it might change, i.e.
+    its files plus any parent directories it might create or remove. An op
+    overlapping with an op of an earlier job must wait for that op to be
+    processed, as if the jobs were processed one after another. Ops that
+    overlap with nothing are free to run in any order."""
+
+    WAIT_TIMEOUT = 0.5
+
+    def __init__(self, jobs, workspace_tree, parallelism):
+        assert parallelism >= 1
+        self.jobs = jobs
+        self.parallelism = parallelism
+        self._condition = threading.Condition()
+        self._finished_jobs = set()
+        self._stop_event = None
+        # Maps each job to a list of (earlier job, required) pairs, where
+        # required[i] is the number of ops the earlier job must have
+        # processed before ops [0, i] of the job may be processed
+        # dependent_op_count is the number of ops overlapping with an op of
+        # an earlier job
+        (self._requirements, self.dependent_op_count) = \
+            find_requirements(jobs, workspace_tree)
+
+    def run(self, listener, journal=None, stop_event=None):
+        self._stop_event = stop_event
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.parallelism,
+                thread_name_prefix='ueimporter-job') as executor:
+            # Jobs only wait for earlier jobs, which are submitted first,
+            # so the jobs that are waited for are always running
+            futures = [executor.submit(self._run_job, job, listener, journal,
+                                       stop_event)
+                       for job in self.jobs]
+            concurrent.futures.wait(futures)
+        for future in futures:
+            future.result()
+
+    def _run_job(self, job, listener, journal, stop_event):
+        try:
+            job.process(-1, listener, journal, stop_event, gate=self)
+        finally:
+            with self._condition:
+                self._finished_jobs.add(job)
+                self._condition.notify_all()
+
+    def ready_op_count(self, job, start, stop):
+        """Returns how many of the ops [start, stop) of job that may be
+        processed right now"""
+        with self._condition:
+            return self._find_ready_stop(job, start, stop) - start
+
+    def wait(self, job, start, stop):
+        """Blocks until at least one of the ops [start, stop) of job may be
+        processed, and returns how many that may. Returns 0 if the ops will
+        never be ready, since an earlier job stopped or failed."""
+        with self._condition:
+            while True:
+                ready_stop = self._find_ready_stop(job, start, stop)
+                if ready_stop > start:
+                    return ready_stop - start
+                if self._stop_event and self._stop_event.is_set():
+                    return 0
+                if self._is_blocked_by_finished_job(job, start):
+                    return 0
+                self._condition.wait(JobScheduler.WAIT_TIMEOUT)
+
+    def notify(self, job):
+        # Called by jobs when they have processed more ops
+        with self._condition:
+            self._condition.notify_all()
+
+    def _find_ready_stop(self, job, start, stop):
+        ready_stop = stop
+        for (earlier_job, required) in self._requirements.get(job, ()):
+            # required never decreases, so the ready ops form a prefix
+            ready_stop = bisect.bisect_right(
+                required, earlier_job.processed_op_count, start, ready_stop)
+        return ready_stop
+
+    def _is_blocked_by_finished_job(self, job, start):
+        for (earlier_job, required) in self._requirements.get(job, ()):
+            if earlier_job in self._finished_jobs and \
+                    earlier_job.processed_op_count < required[start]:
+                return True
+        return False
+
+
+def find_op_regions(job_op, workspace_tree, removed_counts, file_counts):
+    if isinstance(job_op, op.MoveOp):
+        return [find_removed_region(job_op.change.filename_str,
+                                    removed_counts, file_counts),
+                find_created_region(job_op.change.target_filename_str,
+                                    workspace_tree)]
+    elif isinstance(job_op, op.AddOp):
+        return [find_created_region(job_op.change.filename_str,
+                                    workspace_tree)]
+    elif isinstance(job_op, op.DeleteOp):
+        return [find_removed_region(job_op.change.filename_str,
+                                    removed_counts, file_counts)]
+    return [job_op.change.filename_str]
+
+
+def find_requirements(jobs, workspace_tree):
+    # Count the files that disappear from each directory, to tell which
+    # directories might end up empty
+    removed_filenames = []
+    for job in jobs:
+        for job_op in job.ops:
+            if isinstance(job_op, op.MoveDirOp):
+                removed_filenames += [m.filename_str for m in job_op.moves]
+            elif isinstance(job_op, op.DeleteDirOp):
+                removed_filenames += [d.filename_str
+                                      for d in job_op.deletes]
+            elif isinstance(job_op, op.MoveOp) or \
+                    isinstance(job_op, op.DeleteOp):
+                removed_filenames.append(job_op.change.filename_str)
+    removed_counts = path_util.count_per_ancestor(removed_filenames)
+    file_counts = path_util.count_per_ancestor(
+        [str(f) for f in workspace_tree.iter_files('')]) \
+        if removed_filenames else collections.Counter()
+
+    job_regions = []
+    region_maps = []
+    for job in jobs:
+        regions = [find_op_regions(job_op, workspace_tree,
+                                   removed_counts, file_counts)
+                   for job_op in job.ops]
+        region_map = RegionMap()
+        for (op_index, op_regions) in enumerate(regions):
+            for region in op_regions:
+                region_map.add(region, op_index)
+        job_regions.append(regions)
+        region_maps.append(region_map)
+
+    requirements = {}
+    dependent_op_count = 0
+    for (job_index, job) in enumerate(jobs):
+        is_dependent = [False] * len(job.ops)
+        for earlier_index in range(0, job_index):
+            region_map = region_maps[earlier_index]
+            required = []
+            max_required = 0
+            for (op_index, op_regions) in enumerate(job_regions[job_index]):
+                for region in op_regions:
+                    last_overlap = region_map.find_last_overlap(region)
+                    if last_overlap >= 0:
+                        is_dependent[op_index] = True
+                        max_required = max(max_required, last_overlap + 1)
+                required.append(max_required)
+            if max_required > 0:
+                requirements.setdefault(job, []).append(
+                    (jobs[earlier_index], required))
+        dependent_op_count += sum(is_dependent)
+    return (requirements, dependent_op_count)
@@ -0,0 +1,124 @@
+import contextlib
+import json
+import os
+import threading
+import time
+
+# Longest command line attached to a span, full command lines of batches
+# can hold thousands of paths
+MAX_COMMAND_LENGTH = 256
+
+
+class TraceRecorder:
+    """Writes spans as Chrome trace events, in the JSON array format that
+    chrome://tracing and https://ui.perfetto.dev open.
+
+    Events are written as they happen, rather than kept in memory, so that
+    the trace of an import that is interrupted is still readable. The
+    closing bracket of the array is optional in this format."""
+
+    def __init__(self, filename):
+        if not filename.parent.is_dir():
+            os.makedirs(filename.parent)
+        self._file = open(filename, 'w', encoding='utf-8')
+        self._file.write('[\n')
+        self._lock = threading.Lock()
+        self._start_timestamp = time.perf_counter()
+        self._pid = os.getpid()
+        self._named_thread_ids = set()
+        self._event_count = 0
+
+    def timestamp(self):
+        # Microseconds since the recorder was created
+        return (time.perf_counter() - self._start_timestamp) * 1e6
+
+    def complete(self, name, category, start_timestamp, args=None):
+        # Span from start_timestamp until now, given by timestamp()
+        end_timestamp = self.timestamp()
+        self._write({'name': name, 'cat': category, 'ph': 'X',
+                     'ts': start_timestamp,
+                     'dur': end_timestamp - start_timestamp}, args)
+
+    def close(self):
+        with self._lock:
+            if self._file:
+                self._file.write('\n]\n')
+                self._file.close()
+                self._file = None
+
+    def _write(self, event, args):
+        thread = threading.current_thread()
+        event['pid'] = self._pid
+        event['tid'] = thread.ident
+        if args:
+            event['args'] = args
+        with self._lock:
+            if not self._file:
+                return
+            if thread.ident not in self._named_thread_ids:
+                self._named_thread_ids.add(thread.ident)
+                self._write_line({'name': 'thread_name', 'ph': 'M',
+                                  'pid': self._pid, 'tid': thread.ident,
+                                  'args': {'name': thread.name}})
+            self._write_line(event)
+
+    def _write_line(self, event):
+        if self._event_count > 0:
+            self._file.write(',\n')
+        self._file.write(json.dumps(event))
+        self._event_count += 1
+
+
+_recorder = None
+
+
+def start(filename):
+    global _recorder
+    assert _recorder is None
+    _recorder = TraceRecorder(filename)
+
+
+def stop():
+    global _recorder
+    if _recorder:
+        _recorder.close()
+        _recorder = None
+
+
+def timestamp():
+    # Start of a span passed to complete(), None when no trace is recorded
+    return _recorder.timestamp() if _recorder else None
+
+
+def complete(name, category, start_timestamp, **args):
+    if _recorder and start_timestamp is not None:
+        _recorder.complete(name, category, start_timestamp, args)
+
+
+@contextlib.contextmanager
+def span(name, category, **args):
+    """Records the time spent in the body of the with statement. Costs a
+    single check when no trace is recorded."""
+    recorder = _recorder
+    if not recorder:
+        yield
+        return
+    start_timestamp = recorder.timestamp()
+    try:
+        yield
+    finally:
+        recorder.complete(name, category, start_timestamp, args)
+
+
+def command_name(command):
+    # For instance 'cm add' or 'git diff'
+    return ' '.join([str(s) for s in command[:2]])
+
+
+def command_args(command, path_count=0):
+    if not _recorder:
+        return {}
+    command_line = ' '.join([str(s) for s in command])
+    if len(command_line) > MAX_COMMAND_LENGTH:
+        command_line = command_line[:MAX_COMMAND_LENGTH] + '...'
+    return {'command': command_line, 'path_count': path_count}
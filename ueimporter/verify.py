@@ -0,0 +1,261 @@
+import argparse
+import concurrent.futures
+import datetime
+import hashlib
+import os
+import stat
+import time
+
+from pathlib import Path
+
+import ueimporter.plastic as plastic
+from ueimporter import Logger
+from ueimporter import LogLevel
+
+COMMAND_NAME = 'verify'
+HASH_CHUNK_SIZE = 1024 * 1024
+# Files hashed per task sent to a worker process, large enough to make
+# the cost of passing a task between processes negligible
+FILES_PER_TASK = 64
+MAX_PENDING_PER_WORKER = 4
+# Items in the workspace root that are not part of any release
+SKIP_WORKSPACE_NAMES = ['.plastic', '.ueimporter', '.ueimporter.json']
+
+
+def default_worker_count():
+    return os.cpu_count() or 1
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(
+        prog=f'ueimporter {COMMAND_NAME}',
+        description="""
+        Verifies that a plastic workspace is identical to a release, by
+        comparing the content and executable bits of all files
+        """)
+    parser.add_argument('--source-root',
+                        required=True,
+                        type=lambda p: Path(p).absolute(),
+                        help="""
+                        Root of the release to compare with, for instance
+                        an extracted UnrealEngine-<tag> release package
+                        """)
+    parser.add_argument('--plastic-workspace-root',
+                        type=lambda p: Path(p).absolute(),
+                        default=Path.cwd(),
+                        help="""
+                        Specifies the root of the UE plastic workspace on disc.
+                        Default is current working directory (CWD)
+                        """)
+    parser.add_argument('--workers',
+                        type=int,
+                        default=default_worker_count(),
+                        help="""
+                        Number of processes used to hash files.
+                        Default is the number of CPUs
+                        """)
+    parser.add_argument('--log-file',
+                        type=lambda p: Path(p).absolute(),
+                        default=Path('.ueimporter/verify.log'),
+                        help="""
+                        Name of log file where all output is saved.
+                        Default is .ueimporter/verify.log
+                        """)
+    parser.add_argument('--log-level',
+                        default=str(LogLevel.NORMAL).lower(),
+                        choices=[str(l).lower() for l in list(LogLevel)],
+                        help="""
+                        Controls the detail level of logs that show up
+                        in STDOUT. All levels always ends up in the logfile.
+                        Default is normal
+                        """)
+    return parser
+
+
+class VerifyResult:
+    def __init__(self):
+        # Relative paths of files only found in the release
+        self.missing = []
+        # Relative paths of files only found in the workspace
+        self.extra = []
+        self.content_mismatches = []
+        self.mode_mismatches = []
+        self.compared_count = 0
+
+    @property
+    def is_identical(self):
+        return not (self.missing or self.extra or
+                    self.content_mismatches or self.mode_mismatches)
+
+
+def list_files(root, ignore_rules, skip_names=()):
+    """Returns the set of paths, relative to root, of all files below root
+    that are not ignored"""
+    keys = set()
+    skip_names = set(skip_names)
+    # Ignored directories are skipped as a whole, unless an exception
+    # rule might bring back something below them
+    prune_ignored_dirs = not ignore_rules.has_exceptions
+    for (dirpath, dirnames, filenames) in os.walk(root):
+        relative_dirpath = os.path.relpath(dirpath, root).replace(os.sep, '/')
+        prefix = '' if relative_dirpath == '.' else f'{relative_dirpath}/'
+        if not prefix:
+            dirnames[:] = [d for d in dirnames if d not in skip_names]
+            filenames = [f for f in filenames if f not in skip_names]
+        if prune_ignored_dirs:
+            dirnames[:] = [d for d in dirnames
+                           if not ignore_rules.is_ignored(f'{prefix}{d}',
+                                                          is_dir=True)]
+        for filename in filenames:
+            key = f'{prefix}{filename}'
+            if not ignore_rules.is_ignored(key, is_dir=False):
+                keys.add(key)
+    return keys
+
+
+def hash_file(filename):
+    digest = hashlib.blake2b()
+    with open(filename, 'rb') as f:
+        while True:
+            chunk = f.read(HASH_CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.digest()
+
+
+def is_executable(file_stat):
+    return (file_stat.st_mode & stat.S_IXUSR) != 0
+
+
+def compare_files(source_root, workspace_root, keys):
+    """Compares files present in both trees. Returns a list of
+    (key, is_content_mismatch, is_mode_mismatch) for the files that
+    differ. Runs in a worker process."""
+    mismatches = []
+    for key in keys:
+        source_filename = os.path.join(source_root, key)
+        workspace_filename = os.path.join(workspace_root, key)
+        try:
+            source_stat = os.stat(source_filename)
+            workspace_stat = os.stat(workspace_filename)
+            # Files of different sizes never need to be read
+            is_content_mismatch = \
+                source_stat.st_size != workspace_stat.st_size or \
+                hash_file(source_filename) != hash_file(workspace_filename)
+        except OSError:
+            mismatches.append((key, True, False))
+            continue
+        # Windows has no executable bits to compare
+        is_mode_mismatch = os.name != 'nt' and \
+            is_executable(source_stat) != is_executable(workspace_stat)
+        if is_content_mismatch or is_mode_mismatch:
+            mismatches.append((key, is_content_mismatch, is_mode_mismatch))
+    return mismatches
+
+
+def verify(source_root, workspace_root, worker_count, logger):
+    ignore_rules = plastic.IgnoreRules.read(workspace_root)
+    source_keys = list_files(source_root, ignore_rules)
+    workspace_keys = list_files(workspace_root, ignore_rules,
+                                skip_names=SKIP_WORKSPACE_NAMES)
+    logger.log(f'{source_root}: {len(source_keys)} files')
+    logger.log(f'{workspace_root}: {len(workspace_keys)} files')
+
+    result = VerifyResult()
+    result.missing = sorted(source_keys - workspace_keys)
+    result.extra = sorted(workspace_keys - source_keys)
+    common_keys = sorted(source_keys & workspace_keys)
+    result.compared_count = len(common_keys)
+
+    tasks = [common_keys[i:i + FILES_PER_TASK]
+             for i in range(0, len(common_keys), FILES_PER_TASK)]
+    mismatches = []
+    if worker_count == 1:
+        for keys in tasks:
+            mismatches += compare_files(source_root, workspace_root, keys)
+    else:
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=worker_count) as executor:
+            # Limit the number of queued tasks, so that memory use stays
+            # bounded however many files there are
+            max_pending = worker_count * MAX_PENDING_PER_WORKER
+            pending = set()
+            for keys in tasks:
+                if len(pending) >= max_pending:
+                    done, pending = concurrent.futures.wait(
+                        pending,
+                        return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        mismatches += future.result()
+                pending.add(executor.submit(compare_files, str(source_root),
+                                            str(workspace_root), keys))
+            done, _ = concurrent.futures.wait(pending)
+            for future in done:
+                mismatches += future.result()
+
+    mismatches.sort()
+    result.content_mismatches = [k for (k, is_content, _) in mismatches
+                                 if is_content]
+    result.mode_mismatches = [k for (k, _, is_mode) in mismatches
+                              if is_mode]
+    return result
+
+
+def log_result(result, logger):
+    categories = [
+        ('missing from workspace', result.missing),
+        ('only in workspace', result.extra),
+        ('with different content', result.content_mismatches),
+        ('with different executable bit', result.mode_mismatches)]
+    for (desc, keys) in categories:
+        if not keys:
+            continue
+        logger.log_warning(f'{len(keys)} files {desc}')
+        logger.indent()
+        for key in keys:
+            logger.log_warning(key)
+        logger.deindent()
+
+    if result.is_identical:
+        logger.log(f'Workspace is identical to release'
+                   f' ({result.compared_count} files compared)')
+    else:
+        logger.log_error(f'Error: Workspace differs from release')
+
+
+def main(argv):
+    parser = create_parser()
+    args = parser.parse_args(argv)
+
+    log_level = LogLevel.from_string(args.log_level)
+    logger = Logger(args.log_file, log_level)
+    try:
+        return verify_workspace(args, logger)
+    finally:
+        logger.close()
+
+
+def verify_workspace(args, logger):
+    if args.workers < 1:
+        logger.log_error(f'Error: --workers must be at least 1')
+        return 1
+
+    for (desc, root) in [('release', args.source_root),
+                         ('plastic workspace', args.plastic_workspace_root)]:
+        if not root.is_dir():
+            logger.log_error(f'Error: Failed to find {desc} at {root}')
+            return 1
+
+    logger.log(f'Verifying {args.plastic_workspace_root}'
+               f' against {args.source_root}')
+    logger.indent()
+    start_timestamp = time.time()
+    result = verify(args.source_root, args.plastic_workspace_root,
+                    args.workers, logger)
+    log_result(result, logger)
+    elapsed_time = datetime.timedelta(
+        seconds=round(time.time() - start_timestamp))
+    logger.log(f'Elapsed time {elapsed_time}')
+    logger.deindent()
+    return 0 if result.is_identical else 1